@@ -0,0 +1,324 @@
+"""
+Load generator and benchmarks.
+
+``load`` starts server.py on a scratch database (or uses ``--connect``) and
+drives a mix of operations from concurrent clients::
+
+    python bench.py load --ops 20000 --concurrency 8 \
+        --mix insert=20,search=60,update=15,remove=5 --table-size 10000
+
+``micro`` times the storage engines and the LRU cache in process::
+
+    python bench.py micro --records 10000
+
+Both print throughput and p50/p99/p999 latencies.
+"""
+from __future__ import print_function
+
+import argparse
+import logging
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import zmq
+
+from client import Client, Query
+from pykv.storage.compressedstorage import CompressedStorage
+from pykv.storage.jsonstorage import JSONStorage
+from pykv.storage.memorystorage import MemoryStorage
+from pykv.storage.recordstorage import RecordStorage
+from pykv.storage.walstorage import WALStorage
+from pykv.utils import LRUCache, chunked
+
+clock = getattr(time, 'perf_counter', time.time)
+
+OPERATIONS = ("insert", "search", "update", "remove")
+
+
+def percentile(samples, p):
+    """
+    ``p``-th percentile of an already sorted list.
+    """
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(p / 100.0 * len(samples)))]
+
+
+def report(name, samples, elapsed):
+    samples = sorted(samples)
+    rate = len(samples) / elapsed if elapsed else 0.0
+    print("%-14s %8d ops %11.1f ops/s   p50 %8.3f ms   p99 %8.3f ms   "
+          "p999 %8.3f ms" % (name, len(samples), rate,
+                             percentile(samples, 50) * 1000,
+                             percentile(samples, 99) * 1000,
+                             percentile(samples, 99.9) * 1000))
+
+
+def timed(func, count):
+    samples = []
+    for i in range(count):
+        start = clock()
+        func(i)
+        samples.append(clock() - start)
+    return samples
+
+
+def parse_mix(text):
+    """
+    Parse ``"insert=20,search=80"`` into ``[(op, weight), ...]``.
+    """
+    mix = []
+    for part in text.split(","):
+        op, _, weight = part.partition("=")
+        op = op.strip()
+        if op not in OPERATIONS:
+            raise ValueError("Unknown operation {0!r}".format(op))
+        mix.append((op, float(weight or 1)))
+    if not mix or sum(weight for _, weight in mix) <= 0:
+        raise ValueError("Empty operation mix")
+    return mix
+
+
+def make_record(key, size):
+    return {"key": key, "n": random.randint(0, 1000), "pad": "x" * size}
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def connect(uri):
+    context = zmq.Context.instance()
+    sock = context.socket(zmq.REQ)
+    # Fail instead of hanging forever if the server dies
+    sock.setsockopt(zmq.RCVTIMEO, 30000)
+    sock.setsockopt(zmq.LINGER, 0)
+    sock.connect(uri)
+    return Client("db", sock)
+
+
+def start_server(workdir, server_args):
+    ports = [free_port() for _ in range(3)]
+    server = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "server.py")
+    command = [sys.executable, server, os.path.join(workdir, "bench.json")]
+    command += ["tcp://*:%d" % port for port in ports]
+    command += server_args
+    process = subprocess.Popen(command)
+    uri = "tcp://localhost:%d" % ports[0]
+
+    deadline = time.time() + 30
+    while True:
+        if process.poll() is not None:
+            raise RuntimeError("server.py exited with %s" % process.returncode)
+        client = connect(uri)
+        client._socket.setsockopt(zmq.RCVTIMEO, 500)
+        try:
+            len(client)
+            break
+        except zmq.ZMQError:
+            if time.time() > deadline:
+                process.kill()
+                raise RuntimeError("server.py did not answer")
+        finally:
+            client._socket.close()
+    return process, uri
+
+
+class Worker(threading.Thread):
+    def __init__(self, uri, args, mix, ops):
+        super(Worker, self).__init__()
+        self.daemon = True
+        self.client = connect(uri)
+        self.args = args
+        self.ops = ops
+        self.choices = []
+        total = sum(weight for _, weight in mix)
+        acc = 0.0
+        for op, weight in mix:
+            acc += weight / total
+            self.choices.append((acc, op))
+        self.samples = dict((op, []) for op in OPERATIONS)
+        self.errors = 0
+
+    def pick(self):
+        r = random.random()
+        for bound, op in self.choices:
+            if r <= bound:
+                return op
+        return self.choices[-1][1]
+
+    def run(self):
+        query = Query()
+        keyspace = self.args.keyspace
+        for i in range(self.ops):
+            op = self.pick()
+            key = random.randint(0, keyspace - 1)
+            start = clock()
+            try:
+                if op == "insert":
+                    self.client.insert([make_record(key, self.args.record_size)])
+                elif op == "search":
+                    self.client.search(query.key == key)
+                elif op == "update":
+                    self.client.update("increment", query.key == key, "n")
+                else:
+                    self.client.remove(query.key == key)
+            except Exception:
+                self.errors += 1
+                continue
+            self.samples[op].append(clock() - start)
+        self.client._socket.close()
+
+
+def run_load(args):
+    mix = parse_mix(args.mix)
+    workdir = None
+    process = None
+    if args.connect:
+        uri = args.connect
+    else:
+        workdir = tempfile.mkdtemp(prefix="pykv-bench-")
+        process, uri = start_server(workdir, args.server_args)
+
+    try:
+        loader = connect(uri)
+        records = [make_record(i % args.keyspace, args.record_size)
+                   for i in range(args.table_size)]
+        start = clock()
+        for chunk in chunked(records, 1000):
+            loader.insert(chunk)
+        if records:
+            print("loaded %d records in %.2f s" % (len(records), clock() - start))
+        loader._socket.close()
+
+        per_worker = max(args.ops // args.concurrency, 1)
+        workers = [Worker(uri, args, mix, per_worker)
+                   for _ in range(args.concurrency)]
+        start = clock()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = clock() - start
+
+        everything = []
+        for op in OPERATIONS:
+            samples = sum((worker.samples[op] for worker in workers), [])
+            if samples:
+                report(op, samples, elapsed)
+                everything.extend(samples)
+        report("total", everything, elapsed)
+        errors = sum(worker.errors for worker in workers)
+        if errors:
+            print("%d operations failed" % errors)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if workdir is not None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def bench_storage(name, factory, table, rounds):
+    storage = factory()
+    start = clock()
+    samples = timed(lambda i: storage.write(table), rounds)
+    report(name + " write", samples, clock() - start)
+    start = clock()
+    samples = timed(lambda i: storage.read(), rounds)
+    report(name + " read", samples, clock() - start)
+
+    if table and rounds:
+        eids = list(table)
+        start = clock()
+        samples = timed(
+            lambda i: storage.apply(table, [("update", eids[i % len(eids)],
+                                             table[eids[i % len(eids)]])]),
+            rounds * 10)
+        report(name + " apply", samples, clock() - start)
+    storage.close()
+
+
+def bench_cache(capacity, count):
+    cache = LRUCache(capacity=capacity)
+    keys = [random.randint(0, capacity * 2) for _ in range(count)]
+    start = clock()
+    samples = timed(lambda i: cache.__setitem__(keys[i], i), count)
+    report("lru set", samples, clock() - start)
+    start = clock()
+    samples = timed(lambda i: cache.get(keys[i]), count)
+    report("lru get", samples, clock() - start)
+    print("lru stats %s" % cache.stats())
+
+
+def run_micro(args):
+    table = dict((eid, make_record(eid, args.record_size))
+                 for eid in range(1, args.records + 1))
+    workdir = tempfile.mkdtemp(prefix="pykv-bench-")
+    try:
+        path = lambda name: os.path.join(workdir, name)
+        bench_storage("memory", MemoryStorage, table, args.rounds)
+        bench_storage("json", lambda: JSONStorage(path("db.json")),
+                      table, args.rounds)
+        bench_storage("wal", lambda: WALStorage(path("db.wal")),
+                      table, args.rounds)
+        bench_storage("record", lambda: RecordStorage(path("db.rec")),
+                      table, args.rounds)
+        bench_storage("zrecord",
+                      lambda: CompressedStorage(path("db.zrec"),
+                                                inner=RecordStorage),
+                      table, args.rounds)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    bench_cache(args.cache_size, args.cache_ops)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PyKV benchmarks")
+    commands = parser.add_subparsers(dest="command")
+
+    load = commands.add_parser("load", help="drive a server with clients")
+    load.add_argument("--connect", help="use a running server at this uri "
+                                        "instead of starting one")
+    load.add_argument("--ops", type=int, default=10000)
+    load.add_argument("--concurrency", type=int, default=4)
+    load.add_argument("--mix", default="insert=20,search=60,update=15,remove=5",
+                      help="operation weights")
+    load.add_argument("--table-size", type=int, default=10000,
+                      help="records loaded before the run")
+    load.add_argument("--keyspace", type=int, default=1000,
+                      help="number of distinct keys queried")
+    load.add_argument("--record-size", type=int, default=100,
+                      help="bytes of padding per record")
+    load.add_argument("server_args", nargs=argparse.REMAINDER,
+                      help="extra server.py options, after --")
+
+    micro = commands.add_parser("micro", help="storage and cache benchmarks")
+    micro.add_argument("--records", type=int, default=10000)
+    micro.add_argument("--record-size", type=int, default=100)
+    micro.add_argument("--rounds", type=int, default=20)
+    micro.add_argument("--cache-size", type=int, default=1000)
+    micro.add_argument("--cache-ops", type=int, default=100000)
+
+    args = parser.parse_args()
+    # The client logs every request
+    logging.disable(logging.WARNING)
+    if args.command == "load":
+        args.server_args = [arg for arg in args.server_args if arg != "--"]
+        run_load(args)
+    elif args.command == "micro":
+        run_micro(args)
+    else:
+        parser.print_help()
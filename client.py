@@ -1,16 +1,96 @@
 import zmq
 import json
+import copy
+import itertools
+import uuid
+import sys
 import traceback
 import logging
 import argparse
 
 from pykv.queriesinfo import QueryInfo, Query
+from pykv.utils import chunked
+from pykv.cursor import DEFAULT_BATCH_SIZE
+from pykv import protocol
+from pykv.sharding import HashRing
+
+UPDATE_OPS = ("delete", "increment", "decrement", "set", "unset", "push",
+              "pull", "max", "min")
+
+
+class ServerError(Exception):
+    '''
+    The server failed to run a request, e.g. a write sent to a replica.
+    '''
+
+
+class InsertError(ServerError):
+    '''
+    Some chunks of an insert failed, the others are stored: ``eids`` are
+    the ids the server gave their elements.
+    '''
+    def __init__(self, message, eids):
+        super(InsertError, self).__init__(message)
+        self.eids = eids
 
 
 class Client(object):
-    def __init__(self, db, socket):
+    def __init__(self, db, socket, codec=None):
+        '''
+        :param codec: wire codec from pykv.protocol, msgpack when available
+        '''
         self.db = db
         self._socket = socket
+        self.codec = codec if codec is not None else protocol.default_codec()
+        self.table_name = None
+        self.txn_id = None
+
+    def table(self, name):
+        '''
+        Client for the table ``name`` of the same database, sharing this
+        client's connection.
+        '''
+        client = copy.copy(self)
+        client.table_name = name
+        return client
+
+    def stats(self, prometheus=False):
+        '''
+        Server counters, phase timings, cache and storage figures, or the
+        same as Prometheus text.
+        '''
+        message = {"mode": "stats"}
+        if prometheus:
+            message["format"] = "prometheus"
+        return self._request(message)
+
+    def begin(self):
+        '''
+        Start an optimistic transaction. Returns a client whose requests
+        run in it on a snapshot, finish it with its commit() or abort().
+        '''
+        message = {"mode": "txn", "action": "begin", "db": self.db}
+        if self.table_name is not None:
+            message["table"] = self.table_name
+        client = copy.copy(self)
+        client.txn_id = self._wait(self._request(message))["txn"]
+        return client
+
+    def commit(self):
+        '''
+        :return: ``{"committed": True, "eids": [...]}`` or, when another
+                 client changed the same elements first,
+                 ``{"committed": False, "conflicts": [...]}``
+        '''
+        return self._finish("commit")
+
+    def abort(self):
+        return self._finish("abort")
+
+    def _finish(self, action):
+        if self.txn_id is None:
+            raise ValueError('Not in a transaction')
+        return self._request({"mode": "txn", "action": action, "txn": self.txn_id})
 
     def __len__(self):
         return self._send(func = "__len__") 
@@ -22,8 +102,7 @@ class Client(object):
         if not isinstance(element, dict):
             raise ValueError('Del element is not a dictionary')        
         
-        queryinfo = QueryInfo(entry = element.keys(), op = ["__eq__"], args = element.values())
-        return self.remove(queryinfo)
+        return self.remove(QueryInfo.match(element))
     
     def __contains__(self, element):
         '''
@@ -32,84 +111,564 @@ class Client(object):
         if not isinstance(element, dict):
             raise ValueError('Contains element is not a dictionary')  
                 
-        queryinfo = QueryInfo(entry = element.keys(), op = ["__eq__"], args = element.values())
-        return True if self.search(queryinfo) else False
+        return True if self.search(QueryInfo.match(element)) else False
     
     def __setitem__(self, key, value):
         self.insert(dict(key = value))     
         
-    def insert(self, element):
+    def insert(self, element, chunk_size=1000):
         '''
         :type element: list
-        :param element: for multi insert, it is a list of dict
+        :param element: for multi insert, it is a list (or any iterable) of dict
+        :param chunk_size: elements per message, larger loads are streamed to
+                           the server as several bulk inserts
+        :raises InsertError: if a chunk failed, holding the eids of the
+                             chunks stored before it
         '''
-        if not isinstance(element, list):
+        if isinstance(element, dict) or not hasattr(element, '__iter__'):
             raise ValueError('Element is not a list')
 
         logging.warning("Running %s %s %s", "insert",
                         self.db, element)
-        
-        return self._send(func = "insert", insert_item = element)
+
+        eids = []
+        for chunk in chunked(element, chunk_size):
+            try:
+                answer = self._send(func = "insert", insert_item = chunk)
+            except ServerError:
+                raise InsertError(str(sys.exc_info()[1]), eids)
+            if not isinstance(answer, list):
+                raise InsertError(answer, eids)
+            eids.extend(answer)
+        return eids
     
     def remove(self, queryinfo):
         if type(queryinfo) != QueryInfo:
             raise ValueError('Remove args is not QueryInfo')   
         
-        logging.warning("Running %s %s %s %s %s", queryinfo.entry,
-                        "remove", queryinfo.op, queryinfo.args, queryinfo.connection)  
+        logging.warning("Running %s %s %s", "remove", self.db, queryinfo)
         
-        return self._send(func = "remove", index = queryinfo.entry, operation = queryinfo.op,
-                             args = queryinfo.args, connection = queryinfo.connection)  
+        return self._send(func = "remove", query = queryinfo.ast)
     
-    def update(self, update_op, queryinfo):
+    def update(self, update_op, queryinfo, *args):
+        '''
+        Run an update operator on the server, e.g.
+        ``update("increment", query, "visits", 2)`` or several at once with
+        ``update([["set", "name", "he"], ["unset", "tmp"]], query)``.
+        '''
         if type(queryinfo) != QueryInfo:
             raise ValueError('Update args is not QueryInfo') 
-        if update_op not in ["decrement", "delete", "increment"]:
-            raise ValueError('Update args is not reasonal update_op') 
+        if args:
+            update_op = [update_op] + list(args)
+        ops = [update_op] if hasattr(update_op, 'split') or (
+            update_op and hasattr(update_op[0], 'split')) else update_op
+        for op in ops:
+            name = op if hasattr(op, 'split') else op[0]
+            if name not in UPDATE_OPS:
+                raise ValueError('Update args is not reasonal update_op') 
         
-        logging.warning("Running %s %s %s %s %s %s", queryinfo.entry,
-                        "update", queryinfo.op, queryinfo.args, queryinfo.connection, update_op)  
+        logging.warning("Running %s %s %s %s", "update", self.db, queryinfo, update_op)
         
-        return self._send(func = "update", index = queryinfo.entry, operation = queryinfo.op, 
-                        args = queryinfo.args, connection = queryinfo.connection, update_op = update_op)         
+        return self._send(func = "update", query = queryinfo.ast, update_op = update_op)
     
-    def search(self, queryinfo):
+    def search(self, queryinfo, batch_size=None, offset=0, limit=None,
+               fields=None):
+        '''
+        :param batch_size: if given, return an iterator that fetches the
+                           result from a server side cursor batch by batch
+        :param offset: number of matching elements to skip
+        :param limit: maximum number of elements to return
+        :param fields: only return these fields of each element, dotted
+                       for nested ones, e.g. ``["name", "age.x"]``
+        '''
         if type(queryinfo) != QueryInfo:
             raise ValueError('Search args is not QueryInfo')
+        if hasattr(fields, 'split'):
+            fields = [fields]
     
-        logging.warning("Running %s %s %s %s %s", queryinfo.entry,
-                        "search", queryinfo.op, queryinfo.args, queryinfo.connection)  
+        logging.warning("Running %s %s %s", "search", self.db, queryinfo)
         
-        return self._send(func = "search", index = queryinfo.entry, operation = queryinfo.op,
-                     args = queryinfo.args, connection = queryinfo.connection)
+        if batch_size is None and limit is None and not offset:
+            if fields is None:
+                return self._send(func = "search", query = queryinfo.ast)
+            return self._send(func = "search", query = queryinfo.ast,
+                              fields = list(fields))
+
+        page = self._send(func = "search", query = queryinfo.ast,
+                          batch_size = batch_size, offset = offset, limit = limit,
+                          fields = list(fields) if fields is not None else None)
+        # The batch size the server used for the first page
+        rows = self._iter_cursor(page, batch_size or limit or DEFAULT_BATCH_SIZE)
+        return rows if batch_size is not None else list(rows)
+
+    def aggregate(self, queryinfo=None, group_by=None, metrics=("count",)):
+        '''
+        Aggregate on the server, only the rows come back, e.g.
+        ``aggregate(query.age > 18, group_by="city",
+        metrics=["count", ["avg", "age"], ["max", "age"]])``.
+
+        :param queryinfo: elements to aggregate, all if ``None``
+        :param group_by: a field or a list of fields
+        :param metrics: ``"count"`` and ``[op, field]`` pairs, op is
+                        ``sum``, ``avg``, ``min`` or ``max``
+        :return: one dict per group, like
+                 ``{"city": "he", "count": 3, "avg(age)": 30.0, ...}``
+        '''
+        if queryinfo is not None and type(queryinfo) != QueryInfo:
+            raise ValueError('Aggregate args is not QueryInfo')
+
+        logging.warning("Running %s %s %s", "aggregate", self.db, queryinfo)
+
+        return self._send(func = "aggregate",
+                          query = queryinfo.ast if queryinfo is not None else None,
+                          group_by = group_by, metrics = list(metrics))
+
+    def _iter_cursor(self, page, batch_size):
+        page = self._wait(page)
+        try:
+            while True:
+                if not isinstance(page, dict):
+                    raise RuntimeError('Cursor failed: {0}'.format(page))
+                for row in page["rows"]:
+                    yield row
+                if page["cursor"] is None:
+                    return
+                page = self._wait(self._request({"mode": "cursor",
+                                                 "cursor": page["cursor"],
+                                                 "batch_size": batch_size}))
+        finally:
+            # Abandoned before the end, let the server drop the cursor now
+            # rather than when it expires
+            if isinstance(page, dict) and page["cursor"] is not None:
+                self._request({"mode": "cursor", "cursor": page["cursor"],
+                               "close": True})
+
+    def _wait(self, answer):
+        return answer
         
     
 
-    def _send(self, func=None, index=None, operation=None, 
-              args=None, connection=None, update_op=None, insert_item=None, **kwargs):
+    def _send(self, func=None, query=None, update_op=None, insert_item=None, **kwargs):
         
         kwargs = kwargs if kwargs is not None else {}
         if insert_item:
-            message = json.dumps({"mode": "run",
-                                 "db": self.db,
-                                 "func": func,
-                                 "insert_item": insert_item})            
+            message = {"mode": "run",
+                       "db": self.db,
+                       "func": func,
+                       "insert_item": insert_item}
+        else:
+            message = {"mode": "run",
+                       "db": self.db,
+                       "func": func,
+                       "query": query,
+                       "update_op": update_op,
+                       "kwargs": kwargs}
+        if self.table_name is not None:
+            message["table"] = self.table_name
+        if self.txn_id is not None:
+            message["txn"] = self.txn_id
+        return self._request(message)
+
+    def _request(self, message):
+        self._socket.send_multipart(protocol.encode_request(self.codec, message),
+                                    copy=False)
+        header = protocol.decode_reply(self._socket.recv_multipart())
+        if self._renegotiate(header):
+            return self._request(message)
+        if "error" in header:
+            raise ServerError(header["error"])
+        return header["result"]
+
+    def _renegotiate(self, header):
+        '''
+        Fall back to JSON when the server doesn't speak our codec.
+        '''
+        if "codecs" in header and self.codec is not protocol.JSON:
+            logging.warning("Server does not support codec %s, using JSON",
+                            self.codec.tag)
+            self.codec = protocol.JSON
+            return True
+        return False
+
+
+class Future(object):
+    '''
+    Reply of a pipelined request, filled in once the server answers.
+    '''
+    def __init__(self, client, request_id):
+        self._client = client
+        self.id = request_id
+        self._done = False
+        self._result = None
+        self._error = None
+
+    def done(self):
+        return self._done
+
+    def set_result(self, result):
+        self._result = result
+        self._done = True
+
+    def set_exception(self, error):
+        self._error = error
+        self._done = True
+
+    def result(self):
+        while not self._done:
+            self._client.pump()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class CombinedFuture(Future):
+    '''
+    Future over several requests, e.g. the chunks of one insert, whose
+    result is ``combine(futures)``.
+    '''
+    def __init__(self, futures, combine):
+        self._futures = futures
+        self._combine = combine
+
+    def done(self):
+        return all(future.done() for future in self._futures)
+
+    def result(self):
+        return self._combine(self._futures)
+
+
+class AsyncClient(Client):
+    '''
+    Pipelined client on a DEALER socket.
+
+    Every request is tagged with an id and returns a Future at once, so
+    many search/insert/update calls can be in flight on one connection.
+    Replies are matched back to their futures by id, in whatever order
+    the server workers finish them.
+    '''
+    def __init__(self, db, socket, codec=None):
+        super(AsyncClient, self).__init__(db, socket, codec)
+        self._ids = itertools.count()
+        self._pending = {}
+
+    def __len__(self):
+        return self._send(func = "__len__").result()
+
+    def __contains__(self, element):
+        if not isinstance(element, dict):
+            raise ValueError('Contains element is not a dictionary')
+
+        return True if self.search(QueryInfo.match(element)).result() else False
+
+    def insert(self, element, chunk_size=1000):
+        if isinstance(element, dict) or not hasattr(element, '__iter__'):
+            raise ValueError('Element is not a list')
+
+        futures = [self._send(func = "insert", insert_item = chunk)
+                   for chunk in chunked(element, chunk_size)]
+        return CombinedFuture(futures, self._inserted)
+
+    @staticmethod
+    def _inserted(futures):
+        '''
+        Join the eids of the chunks of an insert, the chunks after a failed
+        one may still have been stored.
+        '''
+        eids = []
+        error = None
+        for future in futures:
+            try:
+                eids.extend(future.result())
+            except ServerError:
+                error = error or sys.exc_info()[1]
+        if error is not None:
+            raise InsertError(str(error), eids)
+        return eids
+
+    def _request(self, message):
+        message["id"] = next(self._ids)
+        future = self._pending[message["id"]] = Future(self, message["id"])
+        future.message = message
+        self._transmit(message)
+        return future
+
+    def _transmit(self, message):
+        # The empty frame stands in for the envelope delimiter a REQ
+        # socket would add, the REP workers expect it
+        self._socket.send_multipart([b""] + protocol.encode_request(self.codec, message),
+                                    copy=False)
+
+    def pump(self):
+        '''
+        Wait for one reply and resolve its future.
+        '''
+        header = protocol.decode_reply(self._socket.recv_multipart()[1:])
+        if self._renegotiate(header):
+            for future in list(self._pending.values()):
+                self._transmit(future.message)
+            return
+        future = self._pending.pop(header.get("id"), None)
+        if future is None:
+            return
+        if "error" in header:
+            future.set_exception(ServerError(header["error"]))
         else:
-            message = json.dumps({"mode": "run",
-                              "db": self.db,
-                              "func": func,
-                              "index": index,
-                              "operation": operation,
-                              "args": args,
-                              "connection": connection,
-                              "update_op": update_op,
-                              "kwargs": kwargs})
-      
-        self._socket.send(message)
-        answer = self._socket.recv()
-        answer = json.loads(answer)
+            future.set_result(header["result"])
+
+    def _wait(self, answer):
+        return answer.result()
+
+    def gather(self, futures):
+        return [future.result() for future in futures]
+
+
+class ShardedClient(object):
+    '''
+    Client over several servers. Records are placed with a consistent hash
+    ring on their ``key`` field, a random key is added on insert when it
+    is missing. Queries fan out to every shard in parallel over pipelined
+    clients and the results are merged, unless they pin the shard key.
+    '''
+    def __init__(self, db, uris, key="_key", vnodes=100,
+                 batch_size=DEFAULT_BATCH_SIZE):
+        '''
+        :param batch_size: shard keys moved at a time by rebalance() and
+                           remove_node()
+        '''
+        self.db = db
+        self.key = key
+        self.batch_size = batch_size
+        self.ring = HashRing(vnodes=vnodes)
+        self.clients = {}
+        for uri in uris:
+            self._connect(uri)
+
+    def _connect(self, uri):
+        self.clients[uri] = async_client_factory(self.db, uri)
+        self.ring.add(uri)
+
+    def _everything(self):
+        return Query()[self.key] != None
+
+    def _targets(self, queryinfo):
+        op, path = queryinfo.ast[0], queryinfo.ast[1]
+        if op == "==" and path == [self.key]:
+            return [self.ring.node_for(queryinfo.ast[2])]
+        return list(self.clients)
+
+    def _place(self, elements):
+        '''
+        Group elements by the shard that owns their key.
+        '''
+        groups = {}
+        for element in elements:
+            groups.setdefault(self.ring.node_for(element[self.key]), []).append(element)
+        return groups
+
+    def __len__(self):
+        futures = [client._send(func = "__len__") for client in self.clients.values()]
+        return sum(future.result() for future in futures)
+
+    def insert(self, element, chunk_size=1000):
+        '''
+        :return: the shard keys of the inserted elements
+        '''
+        if isinstance(element, dict) or not hasattr(element, '__iter__'):
+            raise ValueError('Element is not a list')
+
+        elements = []
+        for item in element:
+            if not isinstance(item, dict):
+                raise ValueError('Element is not a dictionary')
+            if self.key not in item:
+                item = dict(item)
+                item[self.key] = uuid.uuid4().hex
+            elements.append(item)
+
+        futures = [self.clients[uri].insert(group, chunk_size)
+                   for uri, group in self._place(elements).items()]
+        for future in futures:
+            future.result()
+        return [item[self.key] for item in elements]
+
+    def search(self, queryinfo, fields=None):
+        futures = [self.clients[uri].search(queryinfo, fields=fields)
+                   for uri in self._targets(queryinfo)]
+        return [row for future in futures for row in future.result()]
+
+    def remove(self, queryinfo):
+        '''
+        :return: dict of the removed eids on each shard
+        '''
+        futures = dict((uri, self.clients[uri].remove(queryinfo))
+                       for uri in self._targets(queryinfo))
+        return dict((uri, future.result()) for uri, future in futures.items())
+
+    def update(self, update_op, queryinfo, *args):
+        '''
+        :return: dict of the updated eids on each shard
+        '''
+        futures = dict((uri, self.clients[uri].update(update_op, queryinfo, *args))
+                       for uri in self._targets(queryinfo))
+        return dict((uri, future.result()) for uri, future in futures.items())
+
+    def add_node(self, uri):
+        self._connect(uri)
+        return self.rebalance()
+
+    def remove_node(self, uri):
+        '''
+        Take a shard out of the ring and move all of its records to the
+        remaining ones. The shard is still searched until it is empty, if
+        the move fails it can be finished by calling remove_node() again.
+
+        :return: number of moved records
+        :raises ShardMoveError: if only part of the records were moved
+        '''
+        self.ring.remove(uri)
+        moved = self._drain(uri, lambda owner: True)
+        del self.clients[uri]
+        return moved
+
+    def rebalance(self):
+        '''
+        Move every record to the shard the ring places it on now.
+
+        :return: number of moved records
+        :raises ShardMoveError: if only part of the records were moved
+        '''
+        moved = 0
+        for uri in list(self.clients):
+            try:
+                moved += self._drain(uri, lambda owner: owner != uri)
+            except ShardMoveError:
+                error = sys.exc_info()[1]
+                error.moved += moved
+                raise
+        return moved
+
+    def _drain(self, uri, strays):
+        '''
+        Move the records of shard ``uri`` whose owner passes ``strays``.
+
+        The shard keys are paged through with a cursor and the records are
+        moved a page of keys at a time, all records of a key together. The
+        copies get new eids on their shard (eids are per shard), records
+        are only dropped from ``uri`` once their copies are stored.
+        '''
+        client = self.clients[uri]
+        moved = 0
+        done = set()
+        copied = []
+        try:
+            keys = client.search(self._everything(), fields=[self.key],
+                                 batch_size=self.batch_size)
+            for page in chunked(keys, self.batch_size):
+                # The cursor reads a snapshot, keys moved since still show up
+                page = set(row[self.key] for row in page) - done
+                page = [key for key in page if strays(self.ring.node_for(key))]
+                if not page:
+                    continue
+                query = self._one_of(page)
+                groups = self._place(self._check(uri, client.search(query)))
+                futures = [(owner, self.clients[owner].insert(group))
+                           for owner, group in groups.items()]
+                for owner, future in futures:
+                    self._check(owner, future)
+                    copied.extend(row[self.key] for row in groups[owner])
+                self._check(uri, client.remove(query))
+                copied = []
+                done.update(page)
+                moved += sum(len(group) for group in groups.values())
+        except Exception:
+            raise ShardMoveError(
+                'Moving records off {0} failed after {1} of them: '
+                '{2}'.format(uri, moved, sys.exc_info()[1]),
+                moved, sorted(set(copied)))
+        return moved
+
+    def _one_of(self, keys):
+        '''
+        Query for the records with any of ``keys``, as a balanced tree of
+        or so that long key lists stay shallow.
+        '''
+        if len(keys) == 1:
+            return Query()[self.key] == keys[0]
+        half = len(keys) // 2
+        return self._one_of(keys[:half]) | self._one_of(keys[half:])
+
+    def _check(self, uri, future):
+        answer = future.result()
+        if not isinstance(answer, list):
+            raise RuntimeError('Shard {0} failed: {1}'.format(uri, answer))
         return answer
 
+
+class ShardMoveError(Exception):
+    '''
+    Records could not all be moved between shards. ``moved`` records were
+    moved, the records with the shard keys in ``duplicated`` were copied
+    to their new shard but are still on the old one as well.
+    '''
+    def __init__(self, message, moved, duplicated):
+        super(ShardMoveError, self).__init__(message)
+        self.moved = moved
+        self.duplicated = duplicated
+
+
+class ReplicatedClient(object):
+    '''
+    Client over a primary and its read-only replicas (server.py --follow).
+    Writes and transactions go to the primary, reads are spread over the
+    replicas in turn. Replicas apply the primary's writes asynchronously,
+    a read right after a write may not see it yet.
+    '''
+    def __init__(self, db, primary_uri, replica_uris):
+        self.db = db
+        self.primary = client_factory(db, primary_uri)
+        self.replicas = [client_factory(db, uri) for uri in replica_uris]
+        self._readers = itertools.cycle(self.replicas or [self.primary])
+
+    def _reader(self):
+        return next(self._readers)
+
+    def table(self, name):
+        client = copy.copy(self)
+        client.primary = self.primary.table(name)
+        client.replicas = [replica.table(name) for replica in self.replicas]
+        client._readers = itertools.cycle(client.replicas or [client.primary])
+        return client
+
+    def __len__(self):
+        return len(self._reader())
+
+    def __contains__(self, element):
+        return element in self._reader()
+
+    def search(self, queryinfo, batch_size=None, offset=0, limit=None,
+               fields=None):
+        return self._reader().search(queryinfo, batch_size, offset, limit,
+                                     fields)
+
+    def aggregate(self, queryinfo=None, group_by=None, metrics=("count",)):
+        return self._reader().aggregate(queryinfo, group_by, metrics)
+
+    def insert(self, element, chunk_size=1000):
+        return self.primary.insert(element, chunk_size)
+
+    def remove(self, queryinfo):
+        return self.primary.remove(queryinfo)
+
+    def update(self, update_op, queryinfo, *args):
+        return self.primary.update(update_op, queryinfo, *args)
+
+    def begin(self):
+        return self.primary.begin()
+
+    def stats(self, prometheus=False):
+        return self.primary.stats(prometheus)
+
+
 def client_factory(db, uri="tcp://localhost:5559"):
     context = zmq.Context()
     logging.debug("Connecting to server on %s" % uri)
@@ -118,6 +677,14 @@ def client_factory(db, uri="tcp://localhost:5559"):
     return Client(db, socket)
 
 
+def async_client_factory(db, uri="tcp://localhost:5559"):
+    context = zmq.Context()
+    logging.debug("Connecting to server on %s" % uri)
+    socket = context.socket(zmq.DEALER)
+    socket.connect(uri)
+    return AsyncClient(db, socket)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("in_uri", default="tcp://*:5559", nargs='?')
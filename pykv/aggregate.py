@@ -0,0 +1,147 @@
+"""
+Streaming aggregation of query results.
+
+"""
+
+from collections import OrderedDict
+from numbers import Number
+
+from pykv.compiler import freeze
+from pykv.queries import _lookup, _missing
+
+__all__ = ('Aggregation',)
+
+
+METRICS = ('count', 'sum', 'avg', 'min', 'max')
+
+
+def _name(path):
+    return '.'.join(str(part) for part in path)
+
+
+def _path(field):
+    path = tuple(field.split('.')) if hasattr(field, 'split') else tuple(field)
+    if not path:
+        raise ValueError('Empty field path')
+    return path
+
+
+def _numeric(value):
+    return isinstance(value, Number) and not isinstance(value, (bool, complex))
+
+
+class Aggregation(object):
+    """
+    Folds elements, one at a time, into one row per group.
+
+    :param group_by: a field (dotted path) or a list of fields, elements
+                     missing one are grouped under ``None``
+    :param metrics: ``"count"`` and ``[op, field]`` pairs where op is
+                    ``sum``, ``avg``, ``min`` or ``max``. Sums and averages
+                    only look at numbers, ``min``/``max`` skip values that
+                    don't compare with the others.
+
+    A row holds the group fields and a value per metric, named like
+    ``count`` or ``sum(age)``.
+    """
+
+    def __init__(self, group_by=None, metrics=('count',)):
+        if group_by is None:
+            group_by = []
+        elif hasattr(group_by, 'split'):
+            group_by = [group_by]
+        self.group_paths = [_path(field) for field in group_by]
+
+        self.metrics = []
+        if hasattr(metrics, 'split'):
+            metrics = [metrics]
+        for metric in metrics:
+            if hasattr(metric, 'split'):
+                metric = [metric]
+            op, args = metric[0], list(metric[1:])
+            if op not in METRICS:
+                raise ValueError('Unknown metric {0!r}'.format(op))
+            if op == 'count':
+                if args:
+                    raise ValueError('count takes no field')
+                self.metrics.append(('count', op, None))
+                continue
+            if len(args) != 1:
+                raise ValueError('{0} takes one field'.format(op))
+            path = _path(args[0])
+            self.metrics.append(('{0}({1})'.format(op, _name(path)), op,
+                                 path))
+        if not self.metrics:
+            raise ValueError('No metrics to compute')
+
+        self._groups = OrderedDict()
+
+    def counts_only(self):
+        return all(op == 'count' for _, op, _ in self.metrics)
+
+    def _state(self, key, values):
+        state = self._groups.get(key)
+        if state is None:
+            state = self._groups[key] = [
+                values, [0 if op == 'count' else
+                         [0, 0] if op in ('sum', 'avg') else _missing
+                         for _, op, _ in self.metrics]]
+        return state[1]
+
+    def add(self, element):
+        values = []
+        for path in self.group_paths:
+            value = _lookup(element, path)
+            values.append(None if value is _missing else value)
+        # Lists and dicts can't key a dict as they are
+        state = self._state(tuple(freeze(value) for value in values), values)
+
+        for i, (_, op, path) in enumerate(self.metrics):
+            if op == 'count':
+                state[i] += 1
+                continue
+            value = _lookup(element, path)
+            if value is _missing or value is None:
+                continue
+            if op in ('sum', 'avg'):
+                if _numeric(value):
+                    state[i][0] += value
+                    state[i][1] += 1
+                continue
+            current = state[i]
+            try:
+                if current is _missing or (
+                        value < current if op == 'min' else value > current):
+                    state[i] = value
+            except TypeError:
+                pass
+
+    def add_count(self, values, count):
+        """
+        Count ``count`` elements into the group of ``values`` at once, e.g.
+        from an index. Only for :meth:`counts_only` aggregations.
+        """
+        state = self._state(tuple(freeze(value) for value in values),
+                            list(values))
+        for i in range(len(state)):
+            state[i] += count
+
+    def rows(self):
+        groups = self._groups
+        if not groups and not self.group_paths:
+            # Aggregating nothing still gives a row
+            self._state((), [])
+        rows = []
+        for values, state in groups.values():
+            row = dict((_name(path), value)
+                       for path, value in zip(self.group_paths, values))
+            for (name, op, _), value in zip(self.metrics, state):
+                if op == 'sum':
+                    value = value[0]
+                elif op == 'avg':
+                    value = float(value[0]) / value[1] if value[1] else None
+                elif value is _missing:
+                    value = None
+                row[name] = value
+            rows.append(row)
+        return rows
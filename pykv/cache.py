@@ -0,0 +1,324 @@
+"""
+Query result caches.
+
+A result cache sits in front of ``TinyDB.search`` (and ``count``). It is
+picked with the ``result_cache`` option of :class:`~pykv.database.TinyDB`,
+which calls it as ``result_cache(db, capacity, max_size, sizeof, ttl)``,
+and has to provide:
+
+* ``version()``: a token taken before a query runs,
+* ``get(hashval)``: the cached result of a query or ``None``,
+* ``put(hashval, version, elements)``: store a result computed under
+  ``version``, unless a write happened since,
+* ``invalidate(changes, fields)``: called when a write is published,
+  with the ``(op, eid, element)`` changes and the top level fields they
+  touched, or twice ``None`` when the whole table was replaced,
+* ``clear()``: the table was reloaded or is planned differently,
+* ``stats()`` and ``close()``.
+
+"""
+
+import errno
+import hashlib
+import json
+import mmap
+import os
+import stat
+import struct
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from pykv.queries import plan_key, query_paths
+from pykv.utils import LRUCache
+
+__all__ = ('LocalResultCache', 'SharedResultCache')
+
+
+SHM = '/dev/shm'
+
+
+def _private_dir(path):
+    """
+    Create the directory ``path`` for this user only, or make sure the
+    existing one is: other users could plant entries in it otherwise.
+    """
+    try:
+        os.mkdir(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    st = os.lstat(path)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or
+            st.st_mode & 0o077):
+        raise OSError('{0} is not a directory private to this user'.format(
+            path))
+
+
+class LocalResultCache(object):
+    """
+    Results of recent queries of this process in an LRU bounded by
+    ``capacity`` entries and a ``max_size`` budget of ``sizeof(result)``.
+    Entries expire after ``ttl`` seconds (never if ``None``). A write drops
+    the entries whose query looks at a field it changed or which hold an
+    element it changed, the others stay valid. All of them are missed once
+    the storage stamp shows the data was changed by someone else.
+    """
+
+    def __init__(self, db, capacity=10, max_size=None, sizeof=len, ttl=None):
+        self.db = db
+        self.ttl = ttl
+        self.expirations = 0
+        self._entries = LRUCache(capacity=capacity, max_size=max_size,
+                                 sizeof=lambda entry: sizeof(entry[1]))
+        # Write counter, a result computed before the last write is stale
+        self._version = 0
+        # Storage stamp the entries were computed under
+        self._stamp = None
+        self._lock = threading.Lock()
+
+    def version(self):
+        return (self._version, self.db._storage.stamp())
+
+    def get(self, hashval):
+        if self._stamp is None or self._stamp != self.db._storage.stamp():
+            self._entries.misses += 1
+            return None
+        try:
+            entry = self._entries.get(hashval)
+        except TypeError:
+            # Compares with a list or a dict, not cached
+            self._entries.misses += 1
+            return None
+        if entry is None:
+            return None
+        expires, elements = entry
+        if expires is not None and expires < time.time():
+            try:
+                del self._entries[hashval]
+            except KeyError:
+                pass
+            self.expirations += 1
+            return None
+        return elements
+
+    def put(self, hashval, version, elements):
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        counter, stamp = version
+        if stamp is None:
+            # The storage can't tell when the data changes
+            return
+        with self._lock:
+            if counter != self._version:
+                return
+            if stamp != self._stamp:
+                self._entries.clear()
+                self._stamp = stamp
+            try:
+                self._entries[hashval] = (expires, elements)
+            except TypeError:
+                pass
+
+    def invalidate(self, changes=None, fields=None):
+        if changes is None or fields is None:
+            return self.clear()
+        with self._lock:
+            self._version += 1
+            if self._stamp != self.db._write_stamp:
+                # Someone else changed the data the write started from
+                self._stamp = None
+                self._entries.clear()
+                return
+            self._stamp = self.db._storage.stamp()
+        eids = set(eid for _, eid, _ in changes)
+
+        def stale(hashval, entry):
+            paths = query_paths(hashval)
+            if paths is None or any(path[:1] and path[0] in fields
+                                    for path in paths):
+                return True
+            return any(element.eid in eids for element in entry[1])
+
+        self._entries.invalidate(stale)
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._stamp = None
+        self._entries.clear()
+
+    def stats(self):
+        stats = self._entries.stats()
+        stats['expirations'] = self.expirations
+        return stats
+
+    def close(self):
+        pass
+
+
+class SharedResultCache(object):
+    """
+    Results shared by the processes of a host that open the same database,
+    kept as JSON files under ``directory`` (in ``/dev/shm`` when there is
+    one, i.e. in memory) in a subdirectory only this user may access. They
+    survive a server restart.
+
+    Every write bumps a counter all the processes map from the same file.
+    An entry is used while that counter and the storage stamp are still
+    the ones it was computed under, and for at most ``ttl`` seconds. At
+    most ``capacity`` entries are kept, results bigger than ``max_size``
+    (by ``sizeof``) are not stored. Queries without a
+    :func:`~pykv.queries.plan_key` are not cached.
+    """
+
+    # Look for entries over ``capacity`` every that many puts
+    PRUNE_EVERY = 64
+
+    def __init__(self, db, capacity=1000, max_size=None, sizeof=len,
+                 ttl=None, directory=None):
+        if fcntl is None:
+            raise ImportError('Shared result caches need fcntl')
+        self.db = db
+        self.capacity = capacity or None
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.ttl = ttl
+        self.hits = self.misses = self.evictions = 0
+        self._puts = 0
+
+        if directory is None:
+            directory = SHM if os.path.isdir(SHM) else tempfile.gettempdir()
+        path = db._args[0] if db._args else None
+        if hasattr(path, 'split'):
+            namespace = hashlib.sha1(
+                os.path.abspath(path).encode('utf-8')).hexdigest()
+        else:
+            # Nothing to share with, e.g. a MemoryStorage
+            namespace = uuid.uuid4().hex
+        root = os.path.join(directory,
+                            'pykv-cache-{0}'.format(os.getuid()))
+        _private_dir(root)
+        self.directory = os.path.join(root, namespace)
+        _private_dir(self.directory)
+
+        self._counter = open(os.path.join(self.directory, 'version'), 'a+b')
+        with self._locked():
+            if os.fstat(self._counter.fileno()).st_size < 8:
+                self._counter.write(b'\0' * 8)
+                self._counter.flush()
+        self._map = mmap.mmap(self._counter.fileno(), 8)
+
+    @contextmanager
+    def _locked(self):
+        fcntl.flock(self._counter.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._counter.fileno(), fcntl.LOCK_UN)
+
+    def _count(self):
+        return struct.unpack('<Q', self._map[:8])[0]
+
+    def _bump(self):
+        with self._locked():
+            self._map[:8] = struct.pack('<Q', self._count() + 1)
+
+    def _path(self, key):
+        return os.path.join(self.directory,
+                            hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def version(self):
+        # The stamp catches files changed by someone not using the cache.
+        # Kept as JSON, the way entries store it
+        return json.dumps([self._count(), self.db._storage.stamp()])
+
+    def get(self, hashval):
+        from pykv.database import Element
+
+        key = plan_key(hashval)
+        entry = None
+        if key is not None:
+            try:
+                with open(self._path(key)) as handle:
+                    entry = json.load(handle)
+            except (IOError, OSError, ValueError):
+                pass
+        if entry is not None:
+            expires = entry['expires']
+            if entry['version'] == self.version() and (
+                    expires is None or expires >= time.time()):
+                self.hits += 1
+                return [Element(element, eid)
+                        for eid, element in entry['elements']]
+        self.misses += 1
+        return None
+
+    def put(self, hashval, version, elements):
+        key = plan_key(hashval)
+        if key is None or version != self.version():
+            return
+        if self.max_size is not None and self.sizeof(elements) > self.max_size:
+            return
+
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        path = self._path(key)
+        tmp = '{0}.{1}.tmp'.format(path, uuid.uuid4().hex)
+        try:
+            raw = json.dumps({'version': version, 'expires': expires,
+                              'elements': [[element.eid, element]
+                                           for element in elements]})
+        except (TypeError, ValueError):
+            # Not JSON, e.g. in a MemoryStorage
+            return
+        with open(tmp, 'w') as handle:
+            handle.write(raw)
+        os.rename(tmp, path)
+
+        self._puts += 1
+        if self._puts % self.PRUNE_EVERY == 0:
+            self._prune()
+
+    def _entries(self):
+        return [os.path.join(self.directory, name)
+                for name in os.listdir(self.directory)
+                if name != 'version' and not name.endswith('.tmp')]
+
+    def _prune(self):
+        if self.capacity is None:
+            return
+        entries = []
+        for path in self._entries():
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except OSError:
+                pass
+        entries.sort()
+        for _, path in entries[:max(len(entries) - self.capacity, 0)]:
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except OSError:
+                pass
+
+    def invalidate(self, changes=None, fields=None):
+        self._bump()
+
+    def clear(self):
+        # Entries are tied to the storage stamp, those of a table that was
+        # changed behind our back are already missed
+        pass
+
+    def stats(self):
+        return {'entries': len(self._entries()), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+    def close(self):
+        self._map.close()
+        self._counter.close()
@@ -0,0 +1,178 @@
+"""
+Columnar shadow of numeric fields for vectorized scans.
+
+Needs numpy, which is optional.
+
+"""
+
+from numbers import Integral, Number
+
+from pykv.queries import _lookup, _missing
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+__all__ = ('ColumnStore',)
+
+
+# Beyond this ints don't survive the trip through a float64
+_MAX_EXACT = 2 ** 53
+
+
+class ColumnStore(object):
+    """
+    Keeps the numeric values found at some query paths in NumPy arrays,
+    one row per record, so ``==``, ``!=``, ``<``, ``<=``, ``>`` and ``>=``
+    on those paths (and ``&``, ``|``, ``~`` of them) are evaluated as
+    vectorized masks instead of record by record.
+
+    Rows of removed records are only marked dead and are reclaimed by
+    the next rebuild.
+    """
+
+    def __init__(self, paths=()):
+        if np is None:
+            raise ImportError('Columnar scans need numpy')
+        self.paths = []
+        for path in paths:
+            self.add_path(path)
+        self.rebuild({})
+
+    def add_path(self, path):
+        path = tuple(path)
+        if path not in self.paths:
+            self.paths.append(path)
+
+    def rebuild(self, data):
+        size = max(len(data), 16)
+        self._size = 0
+        self._rows = {}
+        self._eids = np.zeros(size, dtype=np.int64)
+        self._alive = np.zeros(size, dtype=bool)
+        # Per path: float values, value is a number, value is something else
+        self._columns = dict(
+            (path, (np.zeros(size), np.zeros(size, dtype=bool),
+                    np.zeros(size, dtype=bool)))
+            for path in self.paths)
+        # Paths holding ints too big for a float64 can't be used
+        self._broken = set()
+
+        for eid, element in data.items():
+            self.add(eid, element)
+
+    def _grow(self):
+        size = len(self._eids) * 2
+        self._eids = np.resize(self._eids, size)
+        self._alive = np.resize(self._alive, size)
+        self._alive[self._size:] = False
+        for path, arrays in list(self._columns.items()):
+            self._columns[path] = tuple(np.resize(array, size)
+                                        for array in arrays)
+
+    def add(self, eid, element):
+        row = self._rows.get(eid)
+        if row is None:
+            if self._size == len(self._eids):
+                self._grow()
+            row = self._rows[eid] = self._size
+            self._size += 1
+            self._eids[row] = eid
+            self._alive[row] = True
+
+        for path, (values, numeric, other) in self._columns.items():
+            value = _lookup(element, path)
+            numeric[row] = other[row] = False
+            if value is _missing:
+                continue
+            if isinstance(value, Number) and not isinstance(value, complex):
+                # Floats, inf and nan included, are stored as they are
+                if isinstance(value, float) or (
+                        isinstance(value, Integral) and
+                        abs(value) <= _MAX_EXACT):
+                    values[row] = value
+                    numeric[row] = True
+                else:
+                    self._broken.add(path)
+            else:
+                other[row] = True
+
+    def discard(self, eid):
+        row = self._rows.pop(eid, None)
+        if row is not None:
+            self._alive[row] = False
+
+    def _leaf(self, op, path, rhs):
+        if path not in self._columns or path in self._broken:
+            return None
+        if isinstance(rhs, bool) or not isinstance(rhs, (Integral, float)):
+            return None
+        if isinstance(rhs, Integral) and abs(rhs) > _MAX_EXACT:
+            # Compared in float64 it could equal its neighbours
+            return None
+
+        n = self._size
+        values, numeric, other = (array[:n] for array in self._columns[path])
+        if op == '==':
+            return numeric & (values == rhs)
+        if op == '!=':
+            # Anything that isn't a number differs from one
+            return (numeric & (values != rhs)) | other
+        if other.any():
+            # Ordering numbers against other types is left to the query
+            return None
+        if op == '<':
+            return numeric & (values < rhs)
+        if op == '<=':
+            return numeric & (values <= rhs)
+        if op == '>':
+            return numeric & (values > rhs)
+        if op == '>=':
+            return numeric & (values >= rhs)
+        return None
+
+    def _mask(self, hashval):
+        """
+        Return ``(mask, exact)``: the rows that may match, and whether they
+        are known to match. ``None`` if the query can't be vectorized.
+        """
+        op = hashval[0]
+
+        if op in ('and', 'or'):
+            masks = [self._mask(sub) for sub in hashval[1]]
+            if op == 'or' and None in masks:
+                return None
+            masks = [mask for mask in masks if mask is not None]
+            if not masks:
+                return None
+            combined = masks[0][0]
+            for mask, _ in masks[1:]:
+                combined = (combined & mask) if op == 'and' else (combined | mask)
+            exact = len(masks) == len(hashval[1]) and all(e for _, e in masks)
+            return combined, exact
+
+        if op == 'not':
+            sub = self._mask(hashval[1])
+            if sub is None or not sub[1]:
+                return None
+            return ~sub[0], True
+
+        if len(hashval) == 3:
+            mask = self._leaf(op, hashval[1], hashval[2])
+            if mask is not None:
+                return mask, True
+        return None
+
+    def select(self, hashval):
+        """
+        Return ``(eids, exact)`` for a query, or ``None`` if it needs a
+        regular scan. When ``exact`` is false the eids still have to be
+        checked against the query.
+        """
+        found = self._mask(hashval)
+        if found is None:
+            return None
+        mask, exact = found
+        mask &= self._alive[:self._size]
+        return self._eids[:self._size][mask].tolist(), exact
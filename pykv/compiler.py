@@ -0,0 +1,169 @@
+"""
+Compiles the query AST sent by clients into a query plan.
+
+The AST (see :class:`pykv.queriesinfo.QueryInfo`) is turned into the source
+of one flat function, e.g. ``["and", ["==", ["name"], "he"], ["<", ["age"],
+3]]`` becomes::
+
+    def plan(r):
+        v0 = r.get(k0, _missing)
+        v1 = r.get(k1, _missing)
+        return ((v0 == a0) and (v1 < a1))
+
+so evaluating it costs one Python call per record instead of one per AST
+node. Paths and arguments are bound as names, never pasted into the source.
+
+"""
+
+import json
+import re
+
+from pykv.queries import QueryImpl, _lookup
+from pykv.utils import LRUCache
+
+__all__ = ('QueryCompiler', 'compile_query', 'freeze')
+
+
+class _Missing(object):
+    """
+    Stands for a path that isn't there: every comparison with it is false,
+    like a failed path lookup in :class:`pykv.queries.Query`.
+    """
+
+    def _false(self, other):
+        return False
+
+    __eq__ = __ne__ = __lt__ = __le__ = __gt__ = __ge__ = _false
+    __hash__ = object.__hash__
+
+    def __repr__(self):
+        return '<missing>'
+
+
+_missing = _Missing()
+
+COMPARISONS = {'==': '==', '!=': '!=', '<': '<', '<=': '<=', '>': '>',
+               '>=': '>='}
+
+
+def _re_match(value, pattern):
+    return value is not _missing and pattern.match(value) is not None
+
+
+def _re_search(value, pattern):
+    return value is not _missing and pattern.search(value) is not None
+
+
+def freeze(value):
+    """
+    Turn JSON lists and dicts into tuples so they can go in a hashval.
+    """
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, freeze(item))
+                            for key, item in value.items()))
+    return value
+
+
+class _Builder(object):
+    def __init__(self):
+        self.names = {'_missing': _missing, '_lookup': _lookup,
+                      '_re_match': _re_match, '_re_search': _re_search}
+        self.lookups = []
+        self._paths = {}
+
+    def _bind(self, prefix, value):
+        name = '{0}{1}'.format(prefix, len(self.names))
+        self.names[name] = value
+        return name
+
+    def _value(self, path):
+        """
+        Name of the local holding the value at ``path``, each distinct path
+        is looked up once per record.
+        """
+        key = freeze(path)
+        if key not in self._paths:
+            var = 'v{0}'.format(len(self._paths))
+            if len(path) == 1:
+                self.lookups.append('{0} = r.get({1}, _missing)'.format(
+                    var, self._bind('k', path[0])))
+            else:
+                self.lookups.append('{0} = _lookup(r, {1}, _missing)'.format(
+                    var, self._bind('p', tuple(path))))
+            self._paths[key] = var
+        return self._paths[key]
+
+    def build(self, ast):
+        """
+        Return ``(expression source, hashval)`` for an AST node.
+        """
+        op = ast[0]
+
+        if op in ('and', 'or'):
+            # Flatten chains like a & b & c into one level
+            exprs, hashvals = [], []
+            for node in ast[1:]:
+                expr, hashval = self.build(node)
+                if hashval[0] == op:
+                    hashvals.extend(hashval[1])
+                else:
+                    hashvals.append(hashval)
+                exprs.append(expr)
+            source = '({0})'.format(' {0} '.format(op).join(exprs))
+            return source, (op, frozenset(hashvals))
+
+        if op == 'not':
+            expr, hashval = self.build(ast[1])
+            return '(not {0})'.format(expr), ('not', hashval)
+
+        path, arg = ast[1], ast[2] if len(ast) > 2 else None
+        if not path:
+            raise ValueError('Query has no path')
+        value = self._value(path)
+        hashval = (op, tuple(path), freeze(arg))
+
+        if op in COMPARISONS:
+            return '({0} {1} {2})'.format(
+                value, COMPARISONS[op], self._bind('a', arg)), hashval
+        if op == 'exists':
+            return '({0} is not _missing)'.format(value), (op, tuple(path))
+        if op in ('matches', 'search'):
+            return '_re_{0}({1}, {2})'.format(
+                'match' if op == 'matches' else 'search', value,
+                self._bind('a', re.compile(arg))), hashval
+
+        raise ValueError('Unknown query operation {0!r}'.format(op))
+
+
+def compile_query(ast):
+    """
+    Compile a query AST into a :class:`QueryImpl`.
+    """
+    builder = _Builder()
+    expr, hashval = builder.build(ast)
+    lines = ['def plan(r):']
+    lines.extend('    ' + lookup for lookup in builder.lookups)
+    lines.append('    return ' + expr)
+
+    namespace = builder.names
+    exec(compile('\n'.join(lines), '<query plan>', 'exec'), namespace)
+    return QueryImpl(namespace['plan'], hashval)
+
+
+class QueryCompiler(object):
+    """
+    Compiles query ASTs, keeping the plans of recent queries so a hot
+    query is neither parsed nor compiled again.
+    """
+
+    def __init__(self, capacity=256):
+        self.plans = LRUCache(capacity=capacity)
+
+    def compile(self, ast):
+        key = json.dumps(ast, sort_keys=True)
+        plan = self.plans.get(key)
+        if plan is None:
+            plan = self.plans[key] = compile_query(ast)
+        return plan
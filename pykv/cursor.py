@@ -0,0 +1,96 @@
+"""
+Server side cursors for paginated search results.
+
+"""
+
+import threading
+import time
+import uuid
+from itertools import islice
+
+__all__ = ('Cursor', 'CursorManager', 'DEFAULT_BATCH_SIZE')
+
+
+# Rows per batch when the client doesn't say
+DEFAULT_BATCH_SIZE = 1000
+
+_end = object()
+
+
+class Cursor(object):
+    """
+    Hands out the rows of a lazy result in batches.
+    """
+
+    def __init__(self, iterable, ttl):
+        self.id = uuid.uuid4().hex
+        self.ttl = ttl
+        self._iterator = iter(iterable)
+        self._next = next(self._iterator, _end)
+        self.touch()
+
+    def touch(self):
+        self.expires = time.time() + self.ttl
+
+    @property
+    def exhausted(self):
+        return self._next is _end
+
+    def fetch(self, size):
+        rows = []
+        while len(rows) < size and self._next is not _end:
+            rows.append(self._next)
+            self._next = next(self._iterator, _end)
+        self.touch()
+        return rows
+
+
+class CursorManager(object):
+    """
+    Keeps the open cursors of a server. Cursors not fetched from for
+    ``ttl`` seconds are dropped.
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._cursors = {}
+        self._lock = threading.Lock()
+
+    def expire(self):
+        now = time.time()
+        with self._lock:
+            for cursor_id, cursor in list(self._cursors.items()):
+                if cursor.expires < now:
+                    del self._cursors[cursor_id]
+
+    def open(self, iterable, batch_size, offset=0, limit=None):
+        """
+        Start a cursor over ``iterable`` and return the first batch as
+        ``{"cursor": id, "rows": [...]}``. ``cursor`` is ``None`` when
+        there is nothing left to fetch.
+        """
+        self.expire()
+        stop = offset + limit if limit is not None else None
+        cursor = Cursor(islice(iterable, offset, stop), self.ttl)
+        with self._lock:
+            self._cursors[cursor.id] = cursor
+        return self.fetch(cursor.id, batch_size)
+
+    def fetch(self, cursor_id, batch_size=None):
+        """
+        :raises KeyError: if the cursor is unknown or expired
+        """
+        if batch_size is None:
+            batch_size = DEFAULT_BATCH_SIZE
+        self.expire()
+        with self._lock:
+            cursor = self._cursors[cursor_id]
+        rows = cursor.fetch(batch_size)
+        if cursor.exhausted:
+            self.close(cursor_id)
+            return {"cursor": None, "rows": rows}
+        return {"cursor": cursor_id, "rows": rows}
+
+    def close(self, cursor_id):
+        with self._lock:
+            self._cursors.pop(cursor_id, None)
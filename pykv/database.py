@@ -1,6 +1,18 @@
+import copy
+import os
+import re
+import threading
+import weakref
+from contextlib import contextmanager
 
 from pykv import JSONStorage
-from pykv.utils import LRUCache, iteritems, itervalues
+from pykv.aggregate import Aggregation
+from pykv.cache import LocalResultCache
+from pykv.columnar import ColumnStore
+from pykv.index import Index, plan
+from pykv.metrics import Metrics
+from pykv.queries import QueryOps, project
+from pykv.utils import GroupCommit, iteritems, itervalues
 
 
 class Element(dict):
@@ -13,28 +25,433 @@ class Element(dict):
 
 
 
+def _projected(elements, fields):
+    """
+    Yield the elements cut down to ``fields``, all of them if ``None``.
+    """
+    for element in elements:
+        if fields is None:
+            yield element
+        else:
+            yield Element(project(element, fields), element.eid)
+
+
+_removed = object()
+
+
+class _Draft(object):
+    """
+    The changes of a writer on top of a published table, which stays as it
+    is until the write is published.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        # eid -> new element, or ``_removed``
+        self.changed = {}
+
+    def __getitem__(self, eid):
+        element = self.changed.get(eid)
+        if element is None:
+            return self.base[eid]
+        if element is _removed:
+            raise KeyError(eid)
+        return element
+
+    def get(self, eid, default=None):
+        try:
+            return self[eid]
+        except KeyError:
+            return default
+
+    def __contains__(self, eid):
+        return self.get(eid, _removed) is not _removed
+
+    def __setitem__(self, eid, element):
+        self.changed[eid] = element
+
+    def __delitem__(self, eid):
+        self.pop(eid)
+
+    def pop(self, eid, *default):
+        try:
+            element = self[eid]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        self.changed[eid] = _removed
+        return element
+
+    def keys(self):
+        return list(self)
+
+    def __iter__(self):
+        changed = self.changed
+        for eid in self.base:
+            if changed.get(eid) is not _removed:
+                yield eid
+        for eid, element in iteritems(changed):
+            if element is not _removed and eid not in self.base:
+                yield eid
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def apply(self, table):
+        for eid, element in iteritems(self.changed):
+            if element is _removed:
+                table.pop(eid, None)
+            else:
+                table[eid] = element
+        return table
+
+
+class _Pin(object):
+    """
+    Stands for a reader in :attr:`TinyDB._pins`.
+    """
+
+
+def _changed_fields(old, new):
+    missing = object()
+    return [key for key in set(old) | set(new)
+            if old.get(key, missing) != new.get(key, missing)]
+
+
+DURABILITY = ('none', 'batch', 'always')
+
+
+class ConflictError(Exception):
+    """
+    A transaction touched elements that were changed since it began.
+    """
+    def __init__(self, eids):
+        super(ConflictError, self).__init__(
+            'Transaction conflicts on {0}'.format(eids))
+        self.eids = eids
+
+
+class Transaction(object):
+    """
+    Optimistic transaction.
+
+    Reads see the table as it was when the transaction began, plus its own
+    writes. Writes are buffered and stored together by :meth:`commit`,
+    which fails with :class:`ConflictError` if an element the transaction
+    read or wrote was changed by someone else in the meantime. Elements a
+    query could newly match (phantoms) are not checked.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.version, self._data = db._snapshot(self)
+        self.changes = {}
+        self.reads = set()
+        self.done = False
+
+    def _items(self):
+        for eid, element in iteritems(self._data):
+            if eid not in self.changes:
+                yield eid, element
+        for eid, element in iteritems(self.changes):
+            if element is not None:
+                yield eid, element
+
+    def search(self, cond, fields=None):
+        elements = [element for _, element in self._items() if cond(element)]
+        self.reads.update(element.eid for element in elements)
+        return list(_projected(elements, fields))
+
+    def get(self, cond=None, eid=None):
+        if eid is not None:
+            self.reads.add(eid)
+            return self.changes.get(eid, self._data.get(eid))
+        elements = self.search(cond)
+        return elements[0] if elements else None
+
+    def iter_search(self, cond, fields=None):
+        return iter(self.search(cond, fields))
+
+    def count(self, cond):
+        return len(self.search(cond))
+
+    def aggregate(self, cond=None, group_by=None, metrics=('count',)):
+        aggregation = Aggregation(group_by, metrics)
+        for _, element in self._items():
+            if cond is None or cond(element):
+                self.reads.add(element.eid)
+                aggregation.add(element)
+        return aggregation.rows()
+
+    def contains(self, cond=None, eids=None):
+        if eids is not None:
+            return any(self.get(eid=eid) for eid in eids)
+        return self.get(cond) is not None
+
+    def insert(self, elements):
+        elements = list(elements)
+        for element in elements:
+            if not isinstance(element, dict):
+                raise ValueError('Element is not a dictionary')
+
+        eids = self.db._allocate(len(elements)) if elements else []
+        for eid, element in zip(eids, elements):
+            self.changes[eid] = Element(element, eid)
+        return eids
+
+    insert_multiple = insert
+
+    def process_elements(self, func, cond=None, eids=None, shallow=False):
+        if eids is None:
+            eids = [eid for eid, element in self._items() if cond(element)]
+        working = {}
+        for eid in eids:
+            element = self.changes.get(eid, self._data.get(eid))
+            if element is not None:
+                working[eid] = (Element(element, eid) if shallow
+                                else copy.deepcopy(element))
+        for eid in list(working):
+            func(working, eid)
+        for eid in eids:
+            self.reads.add(eid)
+            self.changes[eid] = working.get(eid)
+        return eids
+
+    def update(self, fields, cond=None, eids=None):
+        if isinstance(fields, (list, tuple)):
+            fields = QueryOps.combine(fields)
+        if not callable(fields):
+            values = fields
+            fields = lambda data, eid: data[eid].update(values)
+            fields.copy_on_write = True
+        return self.process_elements(
+            fields, cond, eids,
+            shallow=getattr(fields, 'copy_on_write', False))
+
+    def remove(self, cond=None, eids=None):
+        if eids is None:
+            eids = [eid for eid, element in self._items() if cond(element)]
+        for eid in eids:
+            self.reads.add(eid)
+            self.changes[eid] = None
+        return eids
+
+    def commit(self):
+        """
+        Store the buffered writes, return the eids that were changed.
+
+        :raises ConflictError: nothing was stored, the transaction may be
+                               retried from the start
+        """
+        if self.done:
+            raise ValueError('Transaction already finished')
+        self.done = True
+        try:
+            return self.db._commit(self)
+        finally:
+            self.db._unpin(self)
+
+    def abort(self):
+        self.done = True
+        self.changes = {}
+        self.db._unpin(self)
+
+
 class TinyDB(object):
     """
     DB main class
+
+    ``durability`` picks when writes are fsynced: ``'none'`` leaves it to
+    the OS, ``'batch'`` syncs in the background every ``commit_interval``
+    seconds or ``commit_writes`` writes, ``'always'`` syncs before a write
+    returns, sharing the sync with concurrent writers.
+
+    :meth:`table` opens further named tables, each in its own storage.
+
+    With ``resident=True`` readers work on snapshots of the in-memory table
+    and never wait for writers (see :attr:`mvcc`); without it every read
+    loads the table from the storage and must not overlap a write.
+
+    Opening doesn't load the data when the storage kept the metadata saved
+    by :meth:`close` (last id, count, indexes); the table is then read on
+    first use, or right away in a background thread with ``warm_up=True``.
     """
     def __init__(self,  *args, **kwargs):
+        # Kept to open the named tables with the same settings
+        self._args = args
+        self._kwargs = dict(kwargs)
+        self._tables = {}
         storage = kwargs.pop('storage', JSONStorage)
         cache_size = kwargs.pop('cache_size', 10)
+        cache_max_size = kwargs.pop('cache_max_size', None)
+        cache_sizeof = kwargs.pop('cache_sizeof', len)
+        cache_ttl = kwargs.pop('cache_ttl', None)
+        result_cache = kwargs.pop('result_cache', LocalResultCache)
+        self._resident = kwargs.pop('resident', False)
+        self.metrics = kwargs.pop('metrics', None) or Metrics()
+        # Name of the table, ``None`` for the main one
+        self.name = kwargs.pop('name', None)
+        # Called after every published write, shared with the tables
+        self._listeners = kwargs.pop('listeners', None)
+        if self._listeners is None:
+            self._listeners = []
+        # Whether this thread holds back its syncs, shared with the tables
+        self._defer = kwargs.pop('defer', None)
+        if self._defer is None:
+            self._defer = threading.local()
+        warm_up = kwargs.pop('warm_up', False)
+        self.durability = kwargs.pop('durability', 'none')
+        commit_interval = kwargs.pop('commit_interval', 0.01)
+        commit_writes = kwargs.pop('commit_writes', 100)
+        if self.durability not in DURABILITY:
+            raise ValueError('Unknown durability {0!r}'.format(self.durability))
+        self._table = None
+        self._stamp = None
+        self._indexes = {}
+        self._columns = None
+        self._index_stamp = None
+        self._write_stamp = None
+        # Guards reloads and index rebuilds done on behalf of concurrent
+        # readers
+        self._reload_lock = threading.RLock()
+        # Writers take turns, readers never wait for them: a write works on
+        # a copy of the table and publishes it when stored
+        self._write_lock = threading.RLock()
+        self._writing = False
+        # Tables readers are using, by reader: a write changes the live
+        # table in place unless a reader holds it, and copies it otherwise
+        self._pins = weakref.WeakKeyDictionary()
+        # Version of the table and of every element, for transactions
+        self._version = 0
+        self._versions = {}
+        self._reset_version = 0
+        # Version each open transaction began with
+        self._txn_versions = weakref.WeakKeyDictionary()
+        self._versions_kept = 512
         
         self._opened = False
         self._storage = storage(*args, **kwargs) 
         self._opened = True 
+
+        self._committer = None
+        self._local = threading.local()
+        if self.durability == 'always':
+            self._committer = GroupCommit(self._storage.sync)
+        elif self.durability == 'batch':
+            self._committer = GroupCommit(self._storage.sync,
+                                          interval=commit_interval,
+                                          max_pending=commit_writes)
      
-        self._query_cache = LRUCache(capacity=cache_size)
-        data = self._read()
-        if data:
-            self._last_id = max(i for i in data)
+        self._query_cache = result_cache(self, capacity=cache_size,
+                                         max_size=cache_max_size,
+                                         sizeof=cache_sizeof, ttl=cache_ttl)
+        # Number of elements as of storage stamp ``_count_stamp``
+        self._count = None
+        self._count_stamp = None
+        self._known_tables = []
+
+        meta = self._storage.read_meta()
+        if meta is not None:
+            self._last_id = meta['last_id']
+            if meta.get('count') is not None:
+                self._count = meta['count']
+                self._count_stamp = self._storage.stamp()
+            for path in meta.get('indexes', []):
+                self.create_index(path)
+            for path in meta.get('columns', []):
+                try:
+                    self.create_column(path)
+                except ImportError:
+                    pass
+            self._known_tables = meta.get('tables', [])
         else:
-            self._last_id = 0
+            eids = list(self._read()) if self._resident else self._storage.eids()
+            self._last_id = max(eids) if eids else 0
+
+        if warm_up and self._resident:
+            thread = threading.Thread(target=self._warm_up)
+            thread.daemon = True
+            thread.start()
+
+    def _warm_up(self):
+        data = self._read()
+        if self._secondary():
+            with self._reload_lock:
+                self._fresh_indexes(data)
             
+    def table(self, name, **options):
+        """
+        Return the table ``name``, opening it on first use.
+
+        A table is a database of its own: its own id counter, query cache,
+        indexes and storage. The storage path is derived from this one
+        (``db.json`` gives ``db.users.json``); ``options`` override the
+        settings this database was opened with, e.g. another ``storage``.
+        """
+        if not re.match(r'^\w+$', name):
+            raise ValueError('Invalid table name {0!r}'.format(name))
+
+        with self._reload_lock:
+            table = self._tables.get(name)
+            if table is None:
+                args = self._args
+                if args and hasattr(args[0], 'split'):
+                    root, ext = os.path.splitext(args[0])
+                    args = ('{0}.{1}{2}'.format(root, name, ext),) + args[1:]
+                kwargs = dict(self._kwargs)
+                kwargs.update(options)
+                kwargs.setdefault('metrics', self.metrics)
+                kwargs.setdefault('listeners', self._listeners)
+                kwargs.setdefault('defer', self._defer)
+                kwargs['name'] = name
+                table = self._tables[name] = TinyDB(*args, **kwargs)
+            return table
+
+    def add_listener(self, func):
+        """
+        Call ``func(table, changes, data)`` after every write to this
+        database or its tables is published, e.g. to ship the changes to
+        replicas. ``changes`` is ``None`` when the whole table was replaced
+        by ``data``.
+        """
+        self._listeners.append(func)
+
+    def tables(self):
+        return sorted(set(self._tables) | set(self._known_tables))
+
+    def drop_table(self, name):
+        with self._reload_lock:
+            if name in self._known_tables:
+                # Stored by an earlier run, open it to empty its storage
+                self.table(name)
+                self._known_tables.remove(name)
+            table = self._tables.pop(name, None)
+        if table is not None:
+            table.purge()
+            table.close()
+
     def close(self):
+        for table in itervalues(self._tables):
+            table.close()
         self._opened = False
+        if self._committer is not None:
+            self._committer.close()
+        self._storage.write_meta(self._meta())
         self._storage.close() 
+        self._query_cache.close()
+
+    def _meta(self):
+        count = self._count
+        if self._count_stamp is None or (
+                self._count_stamp != self._storage.stamp()):
+            count = None
+        return {'last_id': self._last_id,
+                'count': count,
+                'indexes': [list(path) for path in self._indexes],
+                'columns': list(map(list, self._columns.paths))
+                           if self._columns is not None else [],
+                'tables': self.tables()}
         
     def __enter__(self):
         return self
@@ -43,26 +460,201 @@ class TinyDB(object):
         if self._opened is True:
             self.close()
 
-    def process_elements(self, func, cond=None, eids=None):
-        data = self._read()
+    def process_elements(self, func, cond=None, eids=None, shallow=True,
+                         copies=True):
+        """
+        Apply ``func(data, eid)`` to the matching elements and store the
+        result. ``shallow`` tells that ``func`` only replaces top level
+        values, otherwise the old elements are deep-copied to find out
+        which fields changed. ``copies=False`` hands ``func`` the elements
+        themselves, for functions that only drop them.
+        """
+        with self._locked():
+            data = self._writable()
 
-        if eids is not None:
+            if eids is None:
+                eids = [eid for eid in list(data) if cond(data[eid])]
+
+            # ``func`` gets copies, readers may still hold the old elements
+            before = {}
+            for eid in eids:
+                before[eid] = data[eid]
+                if copies:
+                    data[eid] = (Element(data[eid], eid) if shallow
+                                 else copy.deepcopy(data[eid]))
             for eid in eids:
                 func(data, eid)
 
-        else:
-            eids = []
-            for eid in list(data):
-                if cond(data[eid]):
-                    func(data, eid)
-                    eids.append(eid)
+            changes = []
+            fields = set()
+            for eid in eids:
+                if eid in data:
+                    changes.append(('update', eid, data[eid]))
+                    fields.update(_changed_fields(before[eid], data[eid]))
+                else:
+                    changes.append(('remove', eid, None))
+                    fields.update(before[eid])
 
-        self._write(data)
+            self._write(data, changes, fields)
 
         return eids
 
+    def create_index(self, path):
+        """
+        Index the values at ``path`` (a tuple like ``('name',)`` or a dotted
+        string) so that ``==``, ``<``, ``<=``, ``>`` and ``>=`` queries on it
+        no longer scan the whole table.
+        """
+        path = tuple(path.split('.')) if hasattr(path, 'split') else tuple(path)
+        if path not in self._indexes:
+            self._indexes[path] = Index(path)
+            self._index_stamp = None
+            self._query_cache.clear()
+        return self._indexes[path]
+
+    def drop_index(self, path):
+        path = tuple(path.split('.')) if hasattr(path, 'split') else tuple(path)
+        self._indexes.pop(path, None)
+
+    def create_column(self, path):
+        """
+        Shadow the numeric values at ``path`` in a NumPy column so range and
+        equality queries on it are answered by vectorized masks instead of
+        a record by record scan. Needs numpy.
+        """
+        path = tuple(path.split('.')) if hasattr(path, 'split') else tuple(path)
+        if self._columns is None:
+            self._columns = ColumnStore()
+        if path not in self._columns.paths:
+            self._columns.add_path(path)
+            self._index_stamp = None
+            self._query_cache.clear()
+        return self._columns
+
+    def drop_column(self, path):
+        path = tuple(path.split('.')) if hasattr(path, 'split') else tuple(path)
+        if self._columns is not None and path in self._columns.paths:
+            self._columns.paths.remove(path)
+            if not self._columns.paths:
+                self._columns = None
+            self._index_stamp = None
+
+    def _secondary(self):
+        """
+        The structures kept in sync with the table: indexes and columns.
+        """
+        found = list(itervalues(self._indexes))
+        if self._columns is not None:
+            found.append(self._columns)
+        return found
+
+    def _fresh_indexes(self, data):
+        with self._reload_lock:
+            if self._writing:
+                # Our own write, the indexes are patched once it's stored
+                return self._indexes
+            stamp = self._storage.stamp()
+            if stamp is None or stamp != self._index_stamp:
+                for index in self._secondary():
+                    index.rebuild(data)
+                self._index_stamp = stamp
+            return self._indexes
+
+    def _update_indexes(self, data, changes):
+        for index in self._secondary():
+            if changes is None:
+                index.rebuild(data)
+                continue
+            for op, eid, element in changes:
+                index.discard(eid)
+                if op != 'remove':
+                    index.add(eid, element)
+
+    def _matching(self, cond, data):
+        """
+        Yield the elements of ``data`` matching ``cond``, narrowed down by
+        the indexes when the query allows it.
+        """
+        eids = None
+        hashval = getattr(cond, 'hashval', None)
+        if hashval is not None and self._secondary():
+            with self._reload_lock:
+                # The indexes follow the latest table, an older snapshot
+                # has to be scanned
+                if not self._resident or data is self._table:
+                    eids = self._planned(hashval, data)
+            if isinstance(eids, tuple):
+                return self._filter(None, (data[eid] for eid in eids[0]
+                                           if eid in data))
+
+        if eids is None:
+            return self._filter(cond, itervalues(data))
+        return self._filter(cond, (data[eid] for eid in sorted(eids)
+                                   if eid in data))
+
+    def _filter(self, cond, elements):
+        """
+        Yield the elements matching ``cond`` (all if ``None``), counting
+        how many were looked at.
+        """
+        scanned = 0
+        try:
+            for element in elements:
+                scanned += 1
+                if cond is None or cond(element):
+                    yield element
+        finally:
+            self.metrics.incr('rows_scanned', scanned)
+
+    def _planned(self, hashval, data):
+        """
+        Candidate eids from the indexes, or ``(eids,)`` when the columns
+        found exactly the matching ones.
+        """
+        indexes = self._fresh_indexes(data)
+        if indexes:
+            eids = plan(indexes, hashval)
+            if eids is not None:
+                return eids
+        if self._columns is not None:
+            found = self._columns.select(hashval)
+            if found is not None:
+                eids, exact = found
+                return (eids,) if exact else eids
+        return None
+
+    def cache_stats(self):
+        return self._query_cache.stats()
+
+    def stats(self):
+        """
+        Counters and phase timings (shared with the tables), plus the query
+        cache and storage traffic of this database and its tables.
+        """
+        stats = self.metrics.snapshot()
+        with self._reload_lock:
+            dbs = [self] + list(itervalues(self._tables))
+
+        cache = {'hits': 0, 'misses': 0, 'evictions': 0, 'entries': 0}
+        counters = stats['counters']
+        counters.setdefault('storage_bytes_read', 0)
+        counters.setdefault('storage_bytes_written', 0)
+        for db in dbs:
+            for key, value in db.cache_stats().items():
+                if key in cache:
+                    cache[key] += value
+            counters['storage_bytes_read'] += getattr(
+                db._storage, 'bytes_read', 0)
+            counters['storage_bytes_written'] += getattr(
+                db._storage, 'bytes_written', 0)
+        lookups = cache['hits'] + cache['misses']
+        cache['hit_ratio'] = float(cache['hits']) / lookups if lookups else 0.0
+        stats['cache'] = cache
+        return stats
+
     def clear_cache(self):
-        self._query_cache.clear()
+        # Also drops the results shared with other processes
+        self._query_cache.invalidate()
 
     def _get_next_id(self):
         current_id = self._last_id + 1
@@ -71,66 +663,291 @@ class TinyDB(object):
         return current_id
 
     def _read(self):
+        """
+        Return the table as ``{eid: Element}``.
+
+        In resident mode the decoded table is kept in memory and only
+        reloaded when the storage stamp shows it was changed by someone
+        else. The returned dict is then the live table, not a copy.
+        """
+        if not self._resident:
+            return self._load()
+
+        with self._reload_lock:
+            if self._writing and self._table is not None:
+                # Keep serving the last published table until the write
+                # being stored is published
+                return self._table
+            stamp = self._storage.stamp()
+            if self._table is None or stamp is None or stamp != self._stamp:
+                self._query_cache.clear()
+                if self._table is not None:
+                    # Changed behind our back, every transaction conflicts
+                    self._version += 1
+                    self._reset_version = self._version
+                self._table = self._load()
+                self._stamp = stamp
+
+            return self._table
+
+    def _writable(self):
+        """
+        Return a table a writer may change. In resident mode that is a
+        :class:`_Draft` of the live table, readers keep seeing the table as
+        it is until the write is published.
+        """
+        data = self._read()
+        return _Draft(data) if self._resident else data
+
+    def _pin(self, holder):
+        """
+        Return the table, which writers won't change in place while
+        ``holder`` is alive or until :meth:`_unpin`.
+        """
+        with self._reload_lock:
+            data = self._read()
+            if self._resident:
+                self._pins[holder] = data
+            return data
+
+    def _unpin(self, holder):
+        with self._reload_lock:
+            self._pins.pop(holder, None)
+            self._txn_versions.pop(holder, None)
+
+    @contextmanager
+    def _pinned(self):
+        holder = _Pin()
         try:
-            raw_data = (self._storage.read() or {})
+            yield self._pin(holder)
+        finally:
+            self._unpin(holder)
+
+    def _published(self, values):
+        """
+        Turn what a writer stored into the next table: a :class:`_Draft` is
+        applied in place unless a reader holds the table it is based on.
+        """
+        if not isinstance(values, _Draft):
+            return values
+        base = values.base
+        if base is self._table and not any(
+                data is base for data in list(self._pins.values())):
+            return values.apply(base)
+        return values.apply(dict(base))
+
+    @property
+    def mvcc(self):
+        """
+        Whether reads run on snapshots and need no lock against writers.
+        Only resident tables keep snapshots, otherwise a read has to wait
+        for the writes in progress.
+        """
+        return self._resident
+
+    def _load(self):
+        try:
+            with self.metrics.timer('storage_read'):
+                raw_data = (self._storage.read() or {})
         except KeyError:
-            self.write({})
+            self._write({})
             return {}
         
         data = {}
         for key, val in iteritems(raw_data):
             eid = int(key)
             data[eid] = Element(val, eid)
+        self._count, self._count_stamp = len(data), self._storage.stamp()
         
         return data
         
-    def _write(self, values):
-        self._query_cache.clear()
-        self._storage.write(values)
+    def _write(self, values, changes=None, fields=None):
+        """
+        Persist ``values``. When the caller knows which records changed it
+        passes them as ``changes`` so the storage may log just those, and
+        the top level ``fields`` they touched so only the cached queries
+        looking at those fields are dropped.
+        """
+        maintained = self._secondary()
+        with self._reload_lock:
+            # Stamp of the data the write starts from, the indexes and the
+            # cached results are only patched if it is the one they saw
+            self._write_stamp = self._storage.stamp()
+            if maintained:
+                if self._write_stamp != self._index_stamp:
+                    changes_seen = None
+                else:
+                    changes_seen = changes
+            self._writing = True
+
+        try:
+            with self.metrics.timer('storage_write'):
+                if changes is None:
+                    self._storage.write(values)
+                else:
+                    self._storage.apply(values, changes)
+        finally:
+            with self._reload_lock:
+                self._writing = False
+
+        # Publish the new table
+        with self._reload_lock:
+            values = self._published(values)
+            self._query_cache.invalidate(changes, fields)
+
+            if maintained:
+                self._update_indexes(values, changes_seen)
+                self._index_stamp = self._storage.stamp()
+
+            if self._resident:
+                self._table = values
+                self._stamp = self._storage.stamp()
+            self._count, self._count_stamp = len(values), self._storage.stamp()
+
+            self._version += 1
+            if changes is None:
+                self._reset_version = self._version
+            else:
+                for _, eid, _ in changes:
+                    self._versions[eid] = self._version
+            self._forget_versions()
+
+            # Still under the lock, so listeners see the writes of a table
+            # in the order they were published
+            for listener in self._listeners:
+                listener(self, changes, values)
+
+        if self._committer is not None:
+            self._local.ticket = self._committer.written()
+            if self.durability == 'always' and not getattr(
+                    self._defer, 'on', False):
+                self.commit()
+
+    def _forget_versions(self):
+        """
+        Drop the element versions no open transaction can conflict on, the
+        ones not newer than the oldest transaction. With transactions open
+        that is only done once the versions doubled, not on every write.
+        """
+        if not self._txn_versions:
+            self._versions.clear()
+        elif len(self._versions) > 2 * self._versions_kept:
+            oldest = min(self._txn_versions.values())
+            self._versions = dict((eid, version) for eid, version
+                                  in iteritems(self._versions)
+                                  if version > oldest)
+            self._versions_kept = max(len(self._versions), 512)
+
+    def commit(self):
+        """
+        Block until everything this thread wrote is fsynced.
+        """
+        ticket = getattr(self._local, 'ticket', None)
+        if self._committer is not None and ticket is not None:
+            self._committer.wait(ticket)
+
+    @contextmanager
+    def group_commit(self):
+        """
+        Hold back the sync of the writes made in this block, to this database
+        or its tables, until it ends so a server can release its locks first
+        and let writers from other threads share the sync.
+        """
+        outer = getattr(self._defer, 'on', False)
+        self._defer.on = True
+        try:
+            yield
+        finally:
+            self._defer.on = outer
+        if not outer:
+            # Including the tables opened in the block
+            with self._reload_lock:
+                dbs = [self] + list(itervalues(self._tables))
+            for db in dbs:
+                if db.durability == 'always':
+                    db.commit()
+
+    @contextmanager
+    def _locked(self):
+        """
+        Take the write lock, the sync of the writes made under it is waited
+        for once it is released: other writers can store theirs meanwhile
+        and share the sync.
+        """
+        with self.group_commit():
+            with self._write_lock:
+                yield
 
     def __len__(self):
+        if self._count_stamp is not None and (
+                self._count_stamp == self._storage.stamp()):
+            return self._count
         return len(self._read())
 
     def all(self):
-        return list(itervalues(self._read()))
+        with self._pinned() as data:
+            return list(itervalues(data))
 
     def insert(self, elements):
-        eid = []
+        """
+        Insert a list (or any iterable) of elements.
+
+        The whole batch is validated first, gets a contiguous block of ids
+        and is stored with a single read and a single write.
+        """
+        elements = list(elements)
         for element in elements:
-            eid.append(self._get_next_id())
-    
             if not isinstance(element, dict):
                 raise ValueError('Element is not a dictionary')
-    
-            data = self._read()
-            data[eid[-1]] = element
-            self._write(data)
 
-        return eid
-
-    def insert_multiple(self, elements):
-        eids = []
-        data = self._read()
+        if not elements:
+            return []
 
-        for element in elements:
-            eid = self._get_next_id()
-            eids.append(eid)
+        with self._locked():
+            # Taken in the lock, so ids are stored in the order they are given
+            eids = self._allocate(len(elements))
+            data = self._writable()
+            changes = []
+            fields = set()
+            for eid, element in zip(eids, elements):
+                data[eid] = Element(element, eid)
+                changes.append(('insert', eid, data[eid]))
+                fields.update(element)
+            self._write(data, changes, fields)
 
-            data[eid] = element
+        return eids
 
-        self._write(data)
+    def _allocate(self, count):
+        """
+        Reserve a contiguous block of ``count`` ids. Ids are never given
+        twice: those of a failed write or of an aborted transaction are not
+        reused and leave a gap.
+        """
+        with self._reload_lock:
+            first = self._last_id + 1
+            self._last_id += count
+            return list(range(first, self._last_id + 1))
 
-        return eids
+    insert_multiple = insert
 
     def remove(self, cond=None, eids=None):
         return self.process_elements(lambda data, eid: data.pop(eid),
-                                     cond, eids)
+                                     cond, eids, copies=False)
 
     def update(self, fields, cond=None, eids=None):
+        """
+        Update the matching elements with a dict of new top level values,
+        a callable ``f(data, eid)`` (e.g. from :class:`QueryOps`) or a list
+        of such callables applied in order.
+        """
+        if isinstance(fields, (list, tuple)):
+            fields = QueryOps.combine(fields)
         if callable(fields):
+            # Copy-on-write operations leave the old element untouched, no
+            # deep copy is needed to diff it
             return self.process_elements(
                 lambda data, eid: fields(data, eid),
-                cond, eids
+                cond, eids, shallow=getattr(fields, 'copy_on_write', False)
             )
         else:
             return self.process_elements(
@@ -139,28 +956,203 @@ class TinyDB(object):
             )
 
     def purge(self):
-        self._write({})
-        self._last_id = 0
+        with self._locked():
+            self._write({})
+            self._last_id = 0
+
+    def replicate(self, changes=None, data=None, last_id=None):
+        """
+        Apply writes made on another database: ``(op, eid, element)``
+        changes, or the whole table as ``(eid, element)`` pairs in
+        ``data``. The eids are kept. Applying a change twice is harmless,
+        so a replica can replay a log over a newer snapshot.
+        """
+        with self._locked():
+            if changes is None:
+                data = dict((eid, Element(element, eid))
+                            for eid, element in data)
+                self._write(data)
+                if last_id is None:
+                    last_id = max(data) if data else 0
+            else:
+                data = self._writable()
+                applied = []
+                fields = set()
+                for op, eid, element in changes:
+                    old = data.pop(eid, None)
+                    if op == 'remove':
+                        if old is not None:
+                            applied.append(('remove', eid, None))
+                            fields.update(old)
+                        continue
+                    data[eid] = Element(element, eid)
+                    applied.append(('insert' if old is None else 'update',
+                                    eid, data[eid]))
+                    fields.update(_changed_fields(old or {}, element))
+                if applied:
+                    self._write(data, applied, fields)
 
-    def search(self, cond):
-        if cond in self._query_cache:
-            return self._query_cache[cond]
+            with self._reload_lock:
+                if last_id is not None:
+                    self._last_id = last_id
+                elif changes:
+                    self._last_id = max([self._last_id] +
+                                        [eid for _, eid, _ in changes])
 
-        elements = [element for element in self.all() if cond(element)]
-        self._query_cache[cond] = elements
+    def search(self, cond, fields=None):
+        """
+        Return the elements matching ``cond``. With ``fields`` (dotted
+        paths) only those values of each element are kept.
+        """
+        if fields is not None:
+            # The cache holds whole elements, any projection can use them
+            return list(_projected(self.search(cond), fields))
+
+        elements = self._query_cache.get(cond.hashval)
+        if elements is not None:
+            return elements
+
+        # Not cached if a write is published meanwhile
+        version = self._query_cache.version()
+        with self._pinned() as data:
+            with self.metrics.timer('evaluate'):
+                elements = list(self._matching(cond, data))
+        self.metrics.incr('rows_returned', len(elements))
+        self._query_cache.put(cond.hashval, version, elements)
 
         return elements
 
+    def begin(self):
+        """
+        Start an optimistic :class:`Transaction` on a snapshot of this
+        table.
+        """
+        return Transaction(self)
+
+    def _snapshot(self, holder):
+        with self._reload_lock:
+            self._txn_versions[holder] = self._version
+            return self._version, self._pin(holder)
+
+    def _commit(self, txn):
+        """
+        Store the changes of ``txn`` in one write, unless an element it read
+        or wrote was changed since it began.
+
+        :raises ConflictError: listing the conflicting eids
+        """
+        with self._locked():
+            touched = txn.reads | set(txn.changes)
+            if self._reset_version > txn.version:
+                conflicts = touched
+            else:
+                conflicts = [eid for eid in touched
+                             if self._versions.get(eid, 0) > txn.version]
+            if conflicts:
+                raise ConflictError(sorted(conflicts))
+
+            data = self._writable()
+            changes = []
+            fields = set()
+            for eid, element in iteritems(txn.changes):
+                old = data.get(eid)
+                if element is None:
+                    if old is None:
+                        continue
+                    del data[eid]
+                    changes.append(('remove', eid, None))
+                    fields.update(old)
+                else:
+                    data[eid] = element
+                    changes.append(('insert' if old is None else 'update',
+                                    eid, element))
+                    fields.update(_changed_fields(old or {}, element))
+            if changes:
+                self._write(data, changes, fields)
+            return [eid for _, eid, _ in changes]
+
+    def iter_search(self, cond, fields=None):
+        """
+        Lazily yield the elements matching ``cond``, e.g. to page through
+        a large result. Works on the table as it was when called.
+        """
+        # Writers leave the table alone while the scan holds it
+        holder = _Pin()
+        return self._scan(holder, self._pin(holder), cond, fields)
+
+    def _scan(self, holder, data, cond, fields):
+        try:
+            for element in _projected(self._matching(cond, data), fields):
+                yield element
+        finally:
+            self._unpin(holder)
+
     def get(self, cond=None, eid=None):
         if eid is not None:
-            return self._read().get(eid, None)
+            if self._resident:
+                return self._read().get(eid, None)
+            # Lets the storage decode just this record
+            element = self._storage.read_one(eid)
+            return Element(element, eid) if element is not None else None
 
-        for element in self.all():
-            if cond(element):
-                return element
+        with self._pinned() as data:
+            return next(self._matching(cond, data), None)
 
     def count(self, cond):
-        return len(self.search(cond))
+        elements = self._query_cache.get(cond.hashval)
+        if elements is not None:
+            return len(elements)
+        return self.aggregate(cond)[0]['count']
+
+    def aggregate(self, cond=None, group_by=None, metrics=('count',)):
+        """
+        Compute ``metrics`` over the elements matching ``cond`` (all if
+        ``None``) in one pass, without building the result list. See
+        :class:`pykv.aggregate.Aggregation` for ``group_by`` and
+        ``metrics``.
+
+        :return: a list of rows, one per group
+        """
+        aggregation = Aggregation(group_by, metrics)
+        with self._pinned() as data, self.metrics.timer('aggregate'):
+            if cond is None and aggregation.counts_only() and (
+                    self._count_groups(aggregation, data)):
+                return aggregation.rows()
+            if cond is None:
+                elements = self._filter(None, itervalues(data))
+            else:
+                elements = self._matching(cond, data)
+            for element in elements:
+                aggregation.add(element)
+        return aggregation.rows()
+
+    def _count_groups(self, aggregation, data):
+        """
+        Count the groups of ``aggregation`` from the table size or an
+        index on the group field, without looking at the elements. Return
+        whether it could.
+        """
+        paths = aggregation.group_paths
+        if not paths:
+            aggregation.add_count((), len(data))
+            return True
+        if len(paths) != 1 or paths[0] not in self._indexes:
+            return False
+
+        with self._reload_lock:
+            if self._resident and data is not self._table:
+                return False
+            counts = self._fresh_indexes(data)[paths[0]].counts()
+        if counts is None:
+            return False
+        counted = 0
+        for value, count in counts:
+            aggregation.add_count((value,), count)
+            counted += count
+        if len(data) > counted:
+            # Elements without the field
+            aggregation.add_count((None,), len(data) - counted)
+        return True
 
     def contains(self, cond=None, eids=None):
         if eids is not None:
@@ -0,0 +1,142 @@
+"""
+Secondary indexes over query paths.
+
+"""
+
+from bisect import bisect_left, bisect_right, insort
+
+from pykv.queries import _lookup, _missing
+
+__all__ = ('Index', 'plan')
+
+
+class Index(object):
+    """
+    Index the values found at one query path.
+
+    A hash map serves ``==`` lookups and a sorted list of the distinct
+    values serves ``<``, ``<=``, ``>`` and ``>=``. Lookups return a superset
+    of the matching eids, callers still have to apply the condition.
+    """
+
+    def __init__(self, path):
+        self.path = tuple(path)
+        self.sortable = True
+        self._eids = {}
+        self._values = {}
+        self._keys = []
+        self._unhashable = set()
+
+    def add(self, eid, element):
+        value = _lookup(element, self.path)
+        if value is _missing:
+            return
+
+        try:
+            eids = self._eids.get(value)
+        except TypeError:
+            self._unhashable.add(eid)
+            return
+
+        if eids is None:
+            eids = self._eids[value] = set()
+            if self.sortable:
+                try:
+                    insort(self._keys, value)
+                except TypeError:
+                    self.sortable = False
+                    self._keys = []
+        eids.add(eid)
+        self._values[eid] = value
+
+    def discard(self, eid):
+        self._unhashable.discard(eid)
+        value = self._values.pop(eid, _missing)
+        if value is _missing:
+            return
+
+        eids = self._eids[value]
+        eids.discard(eid)
+        if not eids:
+            del self._eids[value]
+            if self.sortable:
+                self._keys.pop(bisect_left(self._keys, value))
+
+    def rebuild(self, data):
+        self.__init__(self.path)
+        for eid, element in data.items():
+            self.add(eid, element)
+
+    def counts(self):
+        """
+        Return ``[(value, number of elements), ...]``, or ``None`` when
+        some values couldn't be indexed.
+        """
+        if self._unhashable:
+            return None
+        return [(value, len(eids)) for value, eids in self._eids.items()]
+
+    def lookup(self, op, rhs):
+        """
+        Return the eids that may satisfy ``value <op> rhs``, or ``None``
+        when this index can't answer.
+        """
+        try:
+            if op == '==':
+                # Lists and dicts aren't hashed, the query has to look at
+                # them itself
+                return self._unhashable | self._eids.get(rhs, set())
+            if not self.sortable:
+                return None
+
+            keys = self._keys
+            if op == '<':
+                keys = keys[:bisect_left(keys, rhs)]
+            elif op == '<=':
+                keys = keys[:bisect_right(keys, rhs)]
+            elif op == '>':
+                keys = keys[bisect_right(keys, rhs):]
+            elif op == '>=':
+                keys = keys[bisect_left(keys, rhs):]
+            else:
+                return None
+        except TypeError:
+            return None
+
+        eids = set(self._unhashable)
+        for key in keys:
+            eids.update(self._eids[key])
+        return eids
+
+
+def plan(indexes, hashval):
+    """
+    Work out the candidate eids for a query from its ``hashval``.
+
+    :param indexes: dict mapping path tuples to :class:`Index`
+    :return: a set of eids or ``None`` if the query needs a full scan
+    """
+    op = hashval[0]
+
+    if op == 'and':
+        sets = [plan(indexes, sub) for sub in hashval[1]]
+        sets = [eids for eids in sets if eids is not None]
+        if not sets:
+            return None
+        return set.intersection(*sets)
+
+    if op == 'or':
+        result = set()
+        for sub in hashval[1]:
+            eids = plan(indexes, sub)
+            if eids is None:
+                return None
+            result |= eids
+        return result
+
+    if op in ('==', '<', '<=', '>', '>='):
+        index = indexes.get(hashval[1])
+        if index is not None:
+            return index.lookup(op, hashval[2])
+
+    return None
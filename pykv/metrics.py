@@ -0,0 +1,133 @@
+"""
+Counters and phase timings, exported as JSON or Prometheus text.
+
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+__all__ = ('Metrics', 'prometheus')
+
+clock = getattr(time, 'perf_counter', time.time)
+
+# Upper bounds of the latency buckets, in seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the ``q`` quantile.
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def snapshot(self):
+        cumulative = []
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            cumulative.append([bound, seen])
+        return {'count': self.count, 'sum': self.sum, 'max': self.max,
+                'p50': self.quantile(0.5), 'p99': self.quantile(0.99),
+                'buckets': cumulative}
+
+
+class Metrics(object):
+    """
+    Thread-safe counters and timing histograms of one process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self.timings.get(name)
+            if histogram is None:
+                histogram = self.timings[name] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = clock()
+        try:
+            yield
+        finally:
+            self.observe(name, clock() - start)
+
+    def snapshot(self):
+        with self._lock:
+            return {'counters': dict(self.counters),
+                    'timings': dict((name, histogram.snapshot())
+                                    for name, histogram
+                                    in self.timings.items())}
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.timings = {}
+
+
+def _number(value):
+    return repr(float(value))
+
+
+def prometheus(stats, prefix='pykv'):
+    """
+    Render a stats dict (see ``TinyDB.stats``) in the Prometheus text
+    exposition format.
+    """
+    lines = []
+    for name, value in sorted(stats.get('counters', {}).items()):
+        metric = '{0}_{1}_total'.format(prefix, name)
+        lines.append('# TYPE {0} counter'.format(metric))
+        lines.append('{0} {1}'.format(metric, _number(value)))
+
+    for name, value in sorted(stats.get('cache', {}).items()):
+        metric = '{0}_cache_{1}'.format(prefix, name)
+        lines.append('# TYPE {0} gauge'.format(metric))
+        lines.append('{0} {1}'.format(metric, _number(value)))
+
+    metric = '{0}_seconds'.format(prefix)
+    timings = sorted(stats.get('timings', {}).items())
+    if timings:
+        lines.append('# TYPE {0} histogram'.format(metric))
+    for name, timing in timings:
+        for bound, count in timing['buckets']:
+            lines.append('{0}_bucket{{phase="{1}",le="{2}"}} {3}'.format(
+                metric, name, bound, count))
+        lines.append('{0}_bucket{{phase="{1}",le="+Inf"}} {2}'.format(
+            metric, name, timing['count']))
+        lines.append('{0}_sum{{phase="{1}"}} {2}'.format(
+            metric, name, _number(timing['sum'])))
+        lines.append('{0}_count{{phase="{1}"}} {2}'.format(
+            metric, name, timing['count']))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,139 @@
+"""
+Wire format between client and server.
+
+A request is sent as two frames, ``[codec tag, payload]``. The server
+answers in the codec the request used with ``[codec tag, header, rows...]``:
+the header is a dict holding the ``result``, or the ``error`` of a
+request that failed, and the request ``id`` for pipelined clients. Long result lists are not put in the header but split
+into row frames of ``ROWS_PER_FRAME`` rows each, which are sent without
+copying and decoded one by one.
+
+msgpack is used when it is installed, JSON otherwise. A request made of a
+single frame is the old plain JSON protocol.
+
+"""
+
+import json
+
+from pykv.utils import chunked
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+__all__ = ('JSON', 'MSGPACK', 'CODECS', 'default_codec', 'split_request',
+           'encode_request', 'encode_reply', 'encode_error',
+           'encode_unsupported', 'decode_reply')
+
+
+ROWS_PER_FRAME = 1000
+
+
+class JSONCodec(object):
+    tag = b'J'
+
+    def dumps(self, obj):
+        return json.dumps(obj).encode('utf-8')
+
+    def loads(self, raw):
+        return json.loads(bytes(raw).decode('utf-8'))
+
+
+class MsgpackCodec(object):
+    tag = b'M'
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, raw):
+        return msgpack.unpackb(raw, raw=False)
+
+
+JSON = JSONCodec()
+MSGPACK = MsgpackCodec() if msgpack is not None else None
+
+CODECS = dict((codec.tag, codec) for codec in (JSON, MSGPACK)
+              if codec is not None)
+
+
+def default_codec():
+    return MSGPACK or JSON
+
+
+def split_request(frames):
+    """
+    Return ``(codec, payload)`` of a request. ``codec`` is ``None`` for a
+    single frame request in the old JSON protocol.
+
+    :raises ValueError: if the client picked a codec we don't have
+    """
+    if len(frames) == 1:
+        return None, frames[0]
+
+    tag, payload = bytes(frames[0]), frames[1]
+    if tag not in CODECS:
+        raise ValueError('Unsupported codec {0!r}'.format(tag))
+    return CODECS[tag], payload
+
+
+def encode_request(codec, message):
+    return [codec.tag, codec.dumps(message)]
+
+
+def encode_reply(codec, result, request_id=None):
+    header = {}
+    if request_id is not None:
+        header["id"] = request_id
+
+    try:
+        rows = []
+        if isinstance(result, list) and len(result) > ROWS_PER_FRAME:
+            rows = [codec.dumps(chunk)
+                    for chunk in chunked(result, ROWS_PER_FRAME)]
+            header["rows"] = len(rows)
+        else:
+            header["result"] = result
+        encoded = codec.dumps(header)
+    except (TypeError, ValueError):
+        rows = []
+        header.pop("rows", None)
+        header["result"] = str(result)
+        encoded = codec.dumps(header)
+
+    return [codec.tag, encoded] + rows
+
+
+def encode_error(codec, error, request_id=None):
+    """
+    Reply to a request that failed with the exception ``error``, the
+    header holds its ``error`` message instead of a ``result``.
+    """
+    header = {"error": "{0}: {1}".format(type(error).__name__, error)}
+    if request_id is not None:
+        header["id"] = request_id
+    return [codec.tag, codec.dumps(header)]
+
+
+def encode_unsupported(error):
+    """
+    Reply to a request in a codec we don't have, listing the ones we do.
+    """
+    header = {"error": str(error),
+              "codecs": [tag.decode('ascii') for tag in CODECS]}
+    return [JSON.tag, JSON.dumps(header)]
+
+
+def decode_reply(frames):
+    """
+    Decode the frames of a reply back into its header, with the row
+    frames joined into ``header["result"]``.
+    """
+    codec = CODECS[bytes(frames[0])]
+    header = codec.loads(frames[1])
+    if "rows" in header:
+        result = []
+        for frame in frames[2:]:
+            result.extend(codec.loads(frame))
+        header["result"] = result
+    return header
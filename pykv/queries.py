@@ -3,35 +3,246 @@ Contains the querying interface.
 
 """
 
+import json
 import re
 import sys
 import functools
 
 from pykv.utils import catch_warning 
 
-__all__ = ('Query', 'where', 'QueryOps', 'QueryImpl')
+__all__ = ('Query', 'where', 'QueryOps', 'QueryImpl', 'query_paths',
+           'plan_key', 'project')
 
 
 def is_sequence(obj):
     return hasattr(obj, '__iter__')
 
 
+def query_paths(hashval):
+    """
+    Return the set of paths a query looks at, or ``None`` if it can match
+    records regardless of their fields (negations).
+    """
+    op = hashval[0]
+    if op == 'not':
+        return None
+    if op in ('and', 'or'):
+        paths = set()
+        for sub in hashval[1]:
+            sub_paths = query_paths(sub)
+            if sub_paths is None:
+                return None
+            paths |= sub_paths
+        return paths
+    return set([hashval[1]])
+
+
+def plan_key(hashval):
+    """
+    Return a canonical string for a query's ``hashval``: the same for equal
+    queries whatever the order of their ``&``/``|`` operands, so it can key
+    results shared between processes. ``None`` if the query calls Python
+    functions (``test``) or compares with values JSON can't hold.
+    """
+    op = hashval[0]
+    if op in ('and', 'or'):
+        keys = [plan_key(sub) for sub in hashval[1]]
+        if None in keys:
+            return None
+        return json.dumps([op, sorted(keys)])
+    if op == 'not':
+        key = plan_key(hashval[1])
+        return None if key is None else json.dumps([op, key])
+    if op == 'test':
+        return None
+    try:
+        return json.dumps(list(hashval), sort_keys=True)
+    except (TypeError, ValueError):
+        return None
+
+
+_missing = object()
+
+
+def _field_path(field):
+    return tuple(field.split('.')) if hasattr(field, 'split') else tuple(field)
+
+
+def _lookup(value, path, default=_missing):
+    """
+    Walk ``path`` down nested dicts (and lists, by position), ``default``
+    if it isn't there.
+    """
+    try:
+        for part in path:
+            value = value[part]
+    except (KeyError, TypeError, IndexError):
+        return default
+    return value
+
+
+def project(element, fields):
+    """
+    Return a dict with only the values of ``element`` at ``fields``
+    (dotted paths or lists of keys), nested as in ``element``. Missing
+    fields are left out, a field inside another one adds nothing.
+    """
+    if hasattr(fields, 'split'):
+        fields = [fields]
+    paths = sorted(set(_field_path(field) for field in fields), key=len)
+    if () in paths:
+        raise ValueError('Empty field path')
+
+    result = {}
+    taken = set()
+    for path in paths:
+        if any(path[:i] in taken for i in range(1, len(path))):
+            continue
+        value = _lookup(element, path)
+        if value is _missing:
+            continue
+        node = result
+        for part in path[:-1]:
+            node = node.setdefault(part, {})
+        node[path[-1]] = value
+        taken.add(path)
+    return result
+
+
+def _modify(node, path, change):
+    """
+    Return a copy of the dict ``node`` with the value at ``path`` replaced
+    by ``change(old)``. Only the dicts along the path are copied, so the
+    old record is left as it was. ``old`` is ``_missing`` for an absent
+    field and returning ``_missing`` removes it.
+    """
+    key = path[0]
+    old = node.get(key, _missing)
+    if len(path) == 1:
+        value = change(old)
+    elif old is _missing:
+        value = _modify({}, path[1:], change)
+        if not value:
+            # Nothing to unset below a missing field
+            value = _missing
+    elif isinstance(old, dict):
+        value = _modify(old, path[1:], change)
+    else:
+        raise ValueError('Field {0!r} is not an object'.format(key))
+
+    if value is old:
+        return node
+    node = dict(node)
+    if value is _missing:
+        node.pop(key, None)
+    else:
+        node[key] = value
+    return node
+
+
 class QueryOps(object):
     """
     Sever-end operation class
+
+    Apart from ``delete`` the methods build update operations for
+    ``TinyDB.update``: callables ``op(data, eid)`` that replace the record
+    with a changed copy. ``field`` is a dotted path or a list of keys.
     """
     def delete(self, data, eid):
         data.pop(eid)
         return
+    # Drops the record without changing it, no copy to diff is needed
+    delete.copy_on_write = True
+
+    @staticmethod
+    def _change(field, change):
+        path = _field_path(field)
+        if not path:
+            raise ValueError('Update has no field')
+
+        def op(data, eid):
+            element = data[eid]
+            data[eid] = type(element)(_modify(element, path, change), eid)
+        op.copy_on_write = True
+        return op
+
+    def increment(self, field, n=1):
+        return self._change(field,
+                            lambda old: n if old is _missing else old + n)
+
+    def decrement(self, field, n=1):
+        return self.increment(field, -n)
+
+    def set(self, field, value):
+        return self._change(field, lambda old: value)
+
+    def unset(self, field):
+        return self._change(field, lambda old: _missing)
+
+    def push(self, field, value):
+        def change(old):
+            if old is _missing:
+                return [value]
+            if not isinstance(old, list):
+                raise ValueError('Field {0!r} is not a list'.format(field))
+            return old + [value]
+        return self._change(field, change)
+
+    def pull(self, field, value):
+        def change(old):
+            if old is _missing:
+                return old
+            if not isinstance(old, list):
+                raise ValueError('Field {0!r} is not a list'.format(field))
+            return [item for item in old if item != value]
+        return self._change(field, change)
+
+    def max(self, field, value):
+        return self._change(
+            field, lambda old: value if old is _missing or value > old else old)
+
+    def min(self, field, value):
+        return self._change(
+            field, lambda old: value if old is _missing or value < old else old)
+
+    @staticmethod
+    def combine(ops):
+        """
+        Chain several operations into one, applied in order.
+        """
+        ops = list(ops)
+
+        def op(data, eid):
+            for single in ops:
+                if eid not in data:
+                    return
+                single(data, eid)
+        op.copy_on_write = all(getattr(single, 'copy_on_write', False)
+                               for single in ops)
+        return op
+
+    def parse(self, spec):
+        """
+        Build an operation from its wire form: a name like ``"delete"``,
+        a list like ``["increment", "visits", 2]`` or a list of those.
+        """
+        if hasattr(spec, 'split'):
+            spec = [spec]
+        if not spec:
+            raise ValueError('Empty update operation')
+        if not hasattr(spec[0], 'split'):
+            return self.combine(self.parse(single) for single in spec)
+
+        name, args = spec[0], spec[1:]
+        if name.startswith('_') or name in ('combine', 'parse'):
+            raise ValueError('Unknown update operation {0!r}'.format(name))
+        try:
+            method = getattr(self, name)
+        except AttributeError:
+            raise ValueError('Unknown update operation {0!r}'.format(name))
+        return method if name == 'delete' else method(*args)
 
 
-    def increment(self, field):
-        pass
-
-    def decrement(self, field):
-        pass
-        
-    
 class QueryInfo(object):
     """
     Used to pass query info from client to server
@@ -64,7 +275,13 @@ class QueryImpl(object):
         return 'QueryImpl{0}'.format(self.hashval)
 
     def __eq__(self, other):
+        if not isinstance(other, QueryImpl):
+            return NotImplemented
         return self.hashval == other.hashval
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
     
     def __and__(self, other):
         return QueryImpl(lambda value: self(value) and other(value),
@@ -100,26 +317,16 @@ class Query(object):
             raise ValueError('Query has no path')
 
         def impl(value):
-            try:
-                for part in self._path:
-                    value = value[part]
-            except (KeyError, TypeError):
-                return False
-            else:
-                return test(value)
+            value = _lookup(value, self._path)
+            return False if value is _missing else test(value)
 
         return QueryImpl(impl, hashval)
 
     
     def _cond(self, test):  # is this ok???
         def warpper(value): # only support one arg
-            try:
-                for part in self._path:
-                    value = value[part]
-            except (KeyError, TypeError):
-                return False
-            else:
-                return test(value) 
+            value = _lookup(value, self._path)
+            return False if value is _missing else test(value)
         return warpper
         
     def __eq__(self, rhs):
@@ -18,45 +18,42 @@ __all__ = ('Query', 'QueryInfo')
 class QueryInfo(object):
     """
     Used to pass query info from client to server
-    
+
+    The query is kept as an AST made of JSON friendly lists:
+
+        [op, path, arg]     a test like ["==", ["name"], "he"]
+        ["and", a, b]
+        ["or", a, b]
+        ["not", a]
     """
-    def __init__(self, entry=None, op=None, args=None, connection=None, **kwargs):
+    def __init__(self, ast):
         """
-        :type entry: list
-        :type op: list
-        :type args: list
-        :type connection: list
-        """        
-        self.entry = [] if entry is None else entry
-        self.op = [] if op is None else op
-        self.args = [] if args is None else args
-        self.connection = [] if connection is None else connection
-        self.kwargs = kwargs
-        
+        :type ast: list
+        """
+        self.ast = ast
+
+    @classmethod
+    def match(cls, element):
+        """
+        Query matching every field of ``element``
+        """
+        queryinfo = None
+        for key, value in element.items():
+            test = cls(["==", [key], value])
+            queryinfo = test if queryinfo is None else queryinfo & test
+        return queryinfo
+
     def __str__(self):
-        return 'QueryInfo{0},{1},{2},{3}'.format(self.entry, self.op, self.args, self.connection)
-    
-    
+        return 'QueryInfo{0}'.format(self.ast)
+
     def __and__(self, other):
-        self.entry.extend(other.entry)
-        self.op.extend(other.op)
-        self.args.extend(other.args)
-        self.connection.append('__and__')        
-        return self
-    
+        return QueryInfo(["and", self.ast, other.ast])
+
     def __or__(self, other):
-        self.entry.extend(other.entry)
-        self.op.extend(other.op)
-        self.args.extend(other.args)
-        self.connection.append('__or__')        
-        return self
-    
+        return QueryInfo(["or", self.ast, other.ast])
+
     def __invert__(self):
-        """
-        Just need to add __or__ info
-        """
-        self.connection.append('__or__')        
-        return self
+        return QueryInfo(["not", self.ast])
 
  
 
@@ -83,32 +80,32 @@ class Query(object):
         if self._path == []:
             return 
         
-        return QueryInfo([self._path], ["__eq__"], [rhs])
+        return QueryInfo(["==", self._path, rhs])
 
     def __ne__(self, rhs):
-        return QueryInfo([self._path], ["__ne__"], [rhs])
+        return QueryInfo(["!=", self._path, rhs])
 
 
     def __lt__(self, rhs):
-        return QueryInfo([self._path], ["__lt__"], [rhs])
+        return QueryInfo(["<", self._path, rhs])
 
     def __le__(self, rhs):
-        return QueryInfo([self._path], ["__le__"], [rhs])
+        return QueryInfo(["<=", self._path, rhs])
 
     def __gt__(self, rhs):
-        return QueryInfo([self._path], ["__gt__"], [rhs])
+        return QueryInfo([">", self._path, rhs])
 
     def __ge__(self, rhs):
-        return QueryInfo([self._path], ["__ge__"], [rhs])
+        return QueryInfo([">=", self._path, rhs])
 
     def exists(self):
-        return QueryInfo([self._path], ["exists"], [rhs])
+        return QueryInfo(["exists", self._path, None])
 
     def matches(self, regex):
-        return QueryInfo([self._path], ["matches"], [rhs])
+        return QueryInfo(["matches", self._path, regex])
 
     def search(self, regex):
-        return QueryInfo([self._path], ["search"], [rhs])
+        return QueryInfo(["search", self._path, regex])
        
     def any(self, cond):
         if callable(cond):
@@ -0,0 +1,195 @@
+"""
+Leader-follower replication.
+
+The primary numbers every published write in a :class:`ReplicationLog`
+and sends it on a PUB socket. A :class:`Follower` subscribes to it and
+applies the writes to its own database, which then serves reads. When a
+follower starts, misses a message or sees the primary restart, it asks
+the primary (a ``replicate`` request on its client endpoint) for the
+entries it lacks, or for a snapshot of every table once the log no
+longer reaches back that far.
+
+"""
+
+import logging
+import threading
+import uuid
+from collections import deque
+
+import zmq
+
+from pykv import protocol
+from pykv.utils import RWLock, iteritems
+
+__all__ = ('ReplicationLog', 'Follower')
+
+
+class ReplicationLog(object):
+    """
+    Keeps the last ``size`` writes of ``db`` and its tables and publishes
+    each on a PUB socket bound to ``uri``.
+    """
+
+    def __init__(self, db, uri, context=None, size=10000, codec=None):
+        self.db = db
+        self.codec = codec if codec is not None else protocol.default_codec()
+        # Changes when the primary restarts, its sequence numbers start over
+        self.epoch = uuid.uuid4().hex
+        self.seq = 0
+        self._entries = deque(maxlen=size)
+        self._lock = threading.Lock()
+        context = context if context is not None else zmq.Context.instance()
+        self._socket = context.socket(zmq.PUB)
+        self._socket.bind(uri)
+        db.add_listener(self.record)
+
+    def record(self, table, changes, data):
+        entry = {'epoch': self.epoch, 'table': table.name}
+        if changes is None:
+            entry['data'] = sorted(iteritems(data))
+        else:
+            entry['changes'] = [[op, eid, element]
+                                for op, eid, element in changes]
+        with self._lock:
+            self.seq += 1
+            entry['seq'] = self.seq
+            self._entries.append(entry)
+            self._socket.send_multipart(
+                protocol.encode_request(self.codec, entry))
+
+    def sync(self, since=None, epoch=None):
+        """
+        Answer a follower that has applied everything up to ``since``: the
+        entries after it, or a snapshot of every table when the log doesn't
+        reach back that far (or ``epoch`` is not ours).
+        """
+        with self._lock:
+            seq = self.seq
+            if (epoch == self.epoch and since is not None and
+                    seq - len(self._entries) <= since <= seq):
+                return {'epoch': self.epoch, 'seq': seq,
+                        'entries': [entry for entry in self._entries
+                                    if entry['seq'] > since]}
+
+        # Entries after ``seq`` may already be in the snapshot, followers
+        # replay them anyway
+        tables = []
+        for table in [self.db] + [self.db.table(name)
+                                  for name in self.db.tables()]:
+            with table._pinned() as data:
+                tables.append({'table': table.name,
+                               'last_id': table._last_id,
+                               'data': sorted(iteritems(data))})
+        return {'epoch': self.epoch, 'seq': seq, 'tables': tables}
+
+    def close(self):
+        self._socket.close()
+
+
+class Follower(object):
+    """
+    Applies the log of the primary at ``primary_uri`` (its client endpoint)
+    published on ``log_uri`` to ``db``.
+
+    ``lock`` (a :class:`pykv.utils.RWLock`) is write-locked around every
+    apply, readers sharing it never see half of one.
+    """
+
+    def __init__(self, db, primary_uri, log_uri, context=None, lock=None,
+                 timeout=5.0, codec=None):
+        self.db = db
+        self.primary_uri = primary_uri
+        self.log_uri = log_uri
+        self.context = (context if context is not None
+                        else zmq.Context.instance())
+        self.lock = lock if lock is not None else RWLock()
+        self.timeout = timeout
+        self.codec = codec if codec is not None else protocol.default_codec()
+        self.epoch = None
+        self.seq = 0
+        self.running = False
+        self._thread = None
+
+    def start(self):
+        self.running = True
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.running = False
+        if self._thread is not None:
+            self._thread.join()
+
+    def run(self):
+        socket = self.context.socket(zmq.SUB)
+        socket.setsockopt(zmq.SUBSCRIBE, b'')
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(self.log_uri)
+        self.sync()
+        try:
+            while self.running:
+                if not socket.poll(self.timeout * 1000):
+                    # Quiet primary, make sure the last entry wasn't lost
+                    self.sync()
+                    continue
+                codec, payload = protocol.split_request(
+                    socket.recv_multipart())
+                entry = codec.loads(payload)
+                if entry['epoch'] != self.epoch or (
+                        entry['seq'] > self.seq + 1):
+                    self.db.metrics.incr('replication_gaps')
+                    self.sync()
+                elif entry['seq'] == self.seq + 1:
+                    self.apply(entry)
+        finally:
+            socket.close()
+
+    def sync(self):
+        """
+        Catch up with the primary, return whether it answered.
+        """
+        socket = self.context.socket(zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.setsockopt(zmq.RCVTIMEO, int(self.timeout * 1000))
+        socket.connect(self.primary_uri)
+        try:
+            socket.send_multipart(protocol.encode_request(
+                self.codec, {'mode': 'replicate', 'since': self.seq,
+                             'epoch': self.epoch}))
+            answer = protocol.decode_reply(socket.recv_multipart())
+        except zmq.Again:
+            logging.warning('Primary %s did not answer', self.primary_uri)
+            return False
+        finally:
+            socket.close()
+        if 'error' in answer:
+            logging.error('Primary refused to replicate: %s', answer['error'])
+            return False
+        answer = answer['result']
+
+        if 'tables' in answer:
+            self.db.metrics.incr('replication_snapshots')
+            with self.lock.write_lock():
+                for table in answer['tables']:
+                    self._table(table['table']).replicate(
+                        data=table['data'], last_id=table['last_id'])
+            self.epoch, self.seq = answer['epoch'], answer['seq']
+        else:
+            for entry in answer['entries']:
+                if entry['seq'] == self.seq + 1:
+                    self.apply(entry)
+        return True
+
+    def apply(self, entry):
+        with self.lock.write_lock():
+            table = self._table(entry['table'])
+            if 'data' in entry:
+                table.replicate(data=entry['data'])
+            else:
+                table.replicate(changes=entry['changes'])
+        self.epoch, self.seq = entry['epoch'], entry['seq']
+        self.db.metrics.incr('replicated_writes')
+
+    def _table(self, name):
+        return self.db if name is None else self.db.table(name)
@@ -0,0 +1,58 @@
+"""
+Consistent hashing used to spread records over several servers.
+
+"""
+
+import hashlib
+from bisect import bisect, insort
+
+__all__ = ('HashRing',)
+
+
+class HashRing(object):
+    """
+    A consistent hash ring with virtual nodes.
+
+    Every node is put on the ring ``vnodes`` times so keys spread evenly,
+    and adding or removing a node only moves the keys of its neighbours.
+    """
+
+    def __init__(self, nodes=(), vnodes=100):
+        self.vnodes = vnodes
+        self.nodes = set()
+        self._ring = []
+        self._owners = {}
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key):
+        if not isinstance(key, bytes):
+            key = u'{0}'.format(key).encode('utf-8')
+        return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+    def add(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for i in range(self.vnodes):
+            point = self._hash(u'{0}#{1}'.format(node, i))
+            if point not in self._owners:
+                self._owners[point] = node
+                insort(self._ring, point)
+
+    def remove(self, node):
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        for i in range(self.vnodes):
+            point = self._hash(u'{0}#{1}'.format(node, i))
+            if self._owners.get(point) == node:
+                del self._owners[point]
+                self._ring.remove(point)
+
+    def node_for(self, key):
+        if not self._ring:
+            raise ValueError('Hash ring is empty')
+        i = bisect(self._ring, self._hash(key)) % len(self._ring)
+        return self._owners[self._ring[i]]
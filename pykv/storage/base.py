@@ -1,10 +1,20 @@
 # -*- coding: utf-8 -*-
+import json
+import os
 from abc import ABCMeta, abstractmethod
 
 
+_replace = getattr(os, 'replace', os.rename)
+
+
 class Storage(object):
     __metaclass__ = ABCMeta
 
+    def __init__(self):
+        # Traffic to and from the backing file, for the stats
+        self.bytes_read = 0
+        self.bytes_written = 0
+
     @abstractmethod
     def read(self):
         raise NotImplementedError('To be overridden!')
@@ -13,7 +23,94 @@ class Storage(object):
     def write(self, data):
         raise NotImplementedError('To be overridden!')
 
-    def close(self):
+    def apply(self, data, changes):
+        """
+        Persist a batch of changes.
+
+        :param data: the whole table after the changes were made
+        :param changes: list of ``(op, eid, element)`` tuples where op is
+                        'insert', 'update' or 'remove'
+
+        Storages that can log single records override this, the default
+        just rewrites the whole table. ``data`` may be a mapping other than
+        a dict, e.g. the changes on top of a resident table.
+        """
+        self.write(data if isinstance(data, dict) else dict(data))
+
+    def read_one(self, eid):
+        """
+        Return the stored element with id ``eid`` or ``None``. Storages
+        that can decode a single record override this.
+        """
+        data = self.read() or {}
+        return data.get(eid, data.get(str(eid)))
+
+    def eids(self):
+        """
+        Return the ids of all stored elements.
+        """
+        return [int(eid) for eid in (self.read() or {})]
+
+    def stamp(self):
+        """
+        Return a value that changes whenever the stored data changes, e.g.
+        an mtime or a generation counter. ``None`` means the storage can't
+        tell, so callers must assume the data changed.
+        """
+        return None
+
+    def sync(self):
+        """
+        Make the written data durable (fsync). Storages that only keep
+        data in memory don't need to.
+        """
         pass
 
+    def _meta_files(self):
+        """
+        Files whose stamps tell whether saved metadata still describes the
+        stored data.
+        """
+        path = getattr(self, 'path', None)
+        return [path] if path else []
+
+    def _files_stamp(self):
+        stamps = []
+        for path in self._meta_files():
+            st = os.stat(path)
+            stamps.append([path, getattr(st, 'st_mtime_ns', st.st_mtime),
+                           st.st_size, st.st_ino])
+        return stamps
+
+    def read_meta(self):
+        """
+        Return the dict saved by :meth:`write_meta`, or ``None`` if there is
+        none or the data changed since it was saved.
+        """
+        if not self._meta_files():
+            return None
+        try:
+            with open(self._meta_files()[0] + '.meta') as handle:
+                meta = json.load(handle)
+            if meta.get('stamp') == self._files_stamp():
+                return meta
+        except (IOError, OSError, ValueError):
+            pass
+        return None
 
+    def write_meta(self, meta):
+        """
+        Save a small dict next to the data (``<path>.meta``), e.g. the last
+        id, so opening the data doesn't need to parse it. Storages without
+        a file don't keep it.
+        """
+        if not self._meta_files():
+            return
+        path = self._meta_files()[0] + '.meta'
+        meta = dict(meta, stamp=self._files_stamp())
+        with open(path + '.tmp', 'w') as handle:
+            json.dump(meta, handle)
+        _replace(path + '.tmp', path)
+
+    def close(self):
+        pass
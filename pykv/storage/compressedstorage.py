@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+import base64
+import logging
+import threading
+import zlib
+
+from pykv.storage.base import Storage
+from pykv.storage.jsonstorage import JSONStorage
+
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+
+def _codec(name, level=6):
+    """
+    Return the ``(compress, decompress)`` functions of a compression.
+    """
+    if name == 'zlib':
+        return (lambda raw: zlib.compress(raw, level)), zlib.decompress
+    if name == 'lz4':
+        if lz4 is None:
+            raise ImportError('lz4 compression needs the lz4 package')
+        return lz4.compress, lz4.decompress
+    raise ValueError('Unknown compression {0!r}'.format(name))
+
+
+class CompressedStorage(Storage):
+    """
+    Compresses the table in blocks on top of another storage.
+
+    Records are grouped by id, ``block_size`` ids to a block, and every
+    block is compressed on its own (``zlib``, or ``lz4`` when installed,
+    zlib is used instead of it otherwise) and stored in the ``inner`` storage as one record holding its eids and
+    the compressed JSON. :meth:`read_one` only inflates the block of the
+    record, and a change rewrites only the blocks it touches (logged as
+    single records by inner storages that can, like
+    :class:`~pykv.storage.recordstorage.RecordStorage`)::
+
+        TinyDB('db.json', storage=CompressedStorage, inner=RecordStorage)
+    """
+
+    def __init__(self, path, inner=JSONStorage, block_size=256,
+                 compression='zlib', level=6, **kwargs):
+        # The traffic counters are the inner storage's
+        if block_size < 1:
+            raise ValueError('block_size must be positive')
+        if compression == 'lz4' and lz4 is None:
+            logging.warning('lz4 is not installed, compressing with zlib')
+            compression = 'zlib'
+        self.storage = inner(path, **kwargs)
+        self.block_size = block_size
+        self.compression = compression
+        self._compress = _codec(compression, level)[0]
+
+        self._lock = threading.RLock()
+        # Compressed blocks by number, as stored
+        self._blocks = None
+        self._stamp = None
+
+    @property
+    def bytes_read(self):
+        return self.storage.bytes_read
+
+    @property
+    def bytes_written(self):
+        return self.storage.bytes_written
+
+    def _encode(self, records):
+        raw = json.dumps(dict((str(eid), element)
+                              for eid, element in records.items()))
+        packed = self._compress(raw.encode('utf-8'))
+        return {'codec': self.compression,
+                'eids': sorted(int(eid) for eid in records),
+                'data': base64.b64encode(packed).decode('ascii')}
+
+    def _decode(self, block):
+        decompress = _codec(block['codec'])[1]
+        raw = decompress(base64.b64decode(block['data']))
+        return dict((int(eid), element) for eid, element
+                    in json.loads(raw.decode('utf-8')).items())
+
+    def _load(self):
+        """
+        Return the stored blocks, reread when someone else changed them.
+        """
+        stamp = self.storage.stamp()
+        if self._blocks is None or stamp is None or stamp != self._stamp:
+            self._blocks = dict((int(number), block) for number, block
+                                in (self.storage.read() or {}).items())
+            self._stamp = stamp
+        return self._blocks
+
+    def _group(self, data):
+        blocks = {}
+        for eid, element in data.items():
+            eid = int(eid)
+            blocks.setdefault(eid // self.block_size, {})[eid] = element
+        return blocks
+
+    def read(self):
+        with self._lock:
+            data = {}
+            for block in self._load().values():
+                data.update(self._decode(block))
+            return data
+
+    def read_one(self, eid):
+        with self._lock:
+            eid = int(eid)
+            block = self._load().get(eid // self.block_size)
+            if block is None or eid not in block['eids']:
+                return None
+            return self._decode(block).get(eid)
+
+    def eids(self):
+        with self._lock:
+            return [eid for block in self._load().values()
+                    for eid in block['eids']]
+
+    def write(self, data):
+        with self._lock:
+            blocks = dict((number, self._encode(records))
+                          for number, records in self._group(data).items())
+            self.storage.write(blocks)
+            self._blocks = blocks
+            self._stamp = self.storage.stamp()
+
+    def apply(self, data, changes):
+        if not changes:
+            return
+
+        with self._lock:
+            # Changed on a copy, the cached blocks stay as stored if the
+            # inner storage fails
+            blocks = dict(self._load())
+            touched = {}
+            for op, eid, element in changes:
+                number = int(eid) // self.block_size
+                if number not in touched:
+                    block = blocks.get(number)
+                    touched[number] = (self._decode(block)
+                                       if block is not None else {})
+                if op == 'remove':
+                    touched[number].pop(int(eid), None)
+                else:
+                    touched[number][int(eid)] = element
+
+            block_changes = []
+            for number, records in sorted(touched.items()):
+                if records:
+                    op = 'update' if number in blocks else 'insert'
+                    blocks[number] = self._encode(records)
+                    block_changes.append((op, number, blocks[number]))
+                elif number in blocks:
+                    del blocks[number]
+                    block_changes.append(('remove', number, None))
+            self.storage.apply(blocks, block_changes)
+            self._blocks = blocks
+            self._stamp = self.storage.stamp()
+
+    def stamp(self):
+        return self.storage.stamp()
+
+    def sync(self):
+        self.storage.sync()
+
+    def read_meta(self):
+        return self.storage.read_meta()
+
+    def write_meta(self, meta):
+        self.storage.write_meta(meta)
+
+    def close(self):
+        self.storage.close()
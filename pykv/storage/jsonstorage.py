@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import os
+import threading
 from pykv.utils import touch
 from pykv.storage.base import Storage
 
@@ -15,26 +16,51 @@ class JSONStorage(Storage):
     def __init__(self, path, create_dirs=False, **kwargs):
         super(JSONStorage, self).__init__()
         touch(path, create_dirs=create_dirs)  
+        self.path = path
         self.kwargs = kwargs
+        # Readers share the handle (and its offset), one at a time
+        self._lock = threading.RLock()
         self._handle = open(path, 'r+')
 
     def close(self):
-        self._handle.close()
+        with self._lock:
+            self._handle.close()
+
+    def stamp(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        with self._lock:
+            if st.st_ino != os.fstat(self._handle.fileno()).st_ino:
+                # Replaced by another process (e.g. written to a temp file
+                # and renamed), follow the new file
+                self._handle.close()
+                self._handle = open(self.path, 'r+')
+        return (getattr(st, 'st_mtime_ns', st.st_mtime), st.st_size, st.st_ino)
+
+    def sync(self):
+        with self._lock:
+            os.fsync(self._handle.fileno())
 
     def read(self):
-        self._handle.seek(0, os.SEEK_END)
-        size = self._handle.tell()
+        # A handle of its own: Python 2's file may still serve what we last
+        # wrote from its buffer after someone else changed the file
+        with self._lock, open(self.path) as handle:
+            raw = handle.read()
 
-        if not size:
-            return None
-        else:
-            self._handle.seek(0)
-            return json.load(self._handle)
+            if not raw:
+                return None
+            else:
+                self.bytes_read += len(raw)
+                return json.loads(raw)
 
     def write(self, data):
-        self._handle.seek(0)
         serialized = json.dumps(data, **self.kwargs)
-        self._handle.write(serialized)
-        self._handle.flush()
-        self._handle.truncate()
+        with self._lock:
+            self._handle.seek(0)
+            self._handle.write(serialized)
+            self.bytes_written += len(serialized)
+            self._handle.flush()
+            self._handle.truncate()
 
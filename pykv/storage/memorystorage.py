@@ -7,9 +7,15 @@ class MemoryStorage(Storage):
     def __init__(self):
         super(MemoryStorage, self).__init__()
         self.memory = None
+        self.generation = 0
 
     def read(self):
         return self.memory
 
     def write(self, data):
         self.memory = data
+        self.generation += 1
+
+    def stamp(self):
+        return self.generation
+
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+import os
+import mmap
+import threading
+
+from pykv.utils import touch
+from pykv.storage.base import Storage
+
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+
+_replace = getattr(os, 'replace', os.rename)
+
+
+class RecordStorage(Storage):
+    """
+    Append-only record file read through ``mmap``.
+
+    Every record is stored as one line ``<eid> <json>`` and a changed or
+    removed record (``<eid> null``) is appended, never rewritten. An
+    ``eid -> (offset, length)`` index is kept in memory and saved to
+    ``<path>.idx``, so opening the file only loads the index and
+    :meth:`read_one` decodes a single record. Once more than half of the
+    file (and at least ``compact_threshold`` bytes) is dead it is rewritten
+    with the live records only.
+    """
+
+    def __init__(self, path, create_dirs=False, compact_threshold=1 << 20,
+                 **kwargs):
+        super(RecordStorage, self).__init__()
+        touch(path, create_dirs=create_dirs)
+        self.path = path
+        self.index_path = path + '.idx'
+        self.compact_threshold = compact_threshold
+        self.kwargs = kwargs
+
+        self._lock = threading.RLock()
+        self._generation = 0
+        self._map = None
+        self._offsets = {}
+        self._open()
+
+    def _open(self):
+        self._handle = open(self.path, 'ab')
+        self._size = self._handle.tell()
+        self._load_index()
+        self._remap()
+
+    def _load_index(self):
+        self._offsets = {}
+        scanned = 0
+        try:
+            with open(self.index_path) as handle:
+                saved = json.load(handle)
+            if (saved['ino'] == os.fstat(self._handle.fileno()).st_ino and
+                    saved['size'] <= self._size):
+                self._offsets = dict((int(eid), tuple(where)) for eid, where
+                                     in saved['offsets'].items())
+                self._dead = saved['dead']
+                scanned = saved['size']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+        if not scanned:
+            self._offsets = {}
+            self._dead = 0
+        # Records appended after the index was saved
+        self._scan(scanned)
+
+    def _scan(self, offset):
+        with open(self.path, 'rb') as handle:
+            handle.seek(offset)
+            for line in handle:
+                if not line.endswith(b'\n'):
+                    # Torn write at the tail, drop it
+                    self._truncate(offset)
+                    break
+                eid, _, payload = line.partition(b' ')
+                self._index_record(int(eid), offset, len(line),
+                                   payload.strip() == b'null')
+                offset += len(line)
+
+    def _truncate(self, size):
+        self._handle.truncate(size)
+        self._handle.seek(size)
+        self._size = size
+
+    def _index_record(self, eid, offset, length, removed):
+        old = self._offsets.pop(eid, None)
+        if old is not None:
+            self._dead += old[1]
+        if removed:
+            self._dead += length
+        else:
+            self._offsets[eid] = (offset, length)
+
+    def _save_index(self):
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w') as handle:
+            json.dump({'size': self._size, 'dead': self._dead,
+                       'ino': os.fstat(self._handle.fileno()).st_ino,
+                       'offsets': dict((str(eid), where) for eid, where
+                                       in self._offsets.items())}, handle)
+        _replace(tmp, self.index_path)
+
+    def _remap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._size:
+            with open(self.path, 'rb') as handle:
+                self._map = mmap.mmap(handle.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+
+    def _view(self):
+        # Appends grow the file past the mapped area
+        if self._map is None or len(self._map) < self._size:
+            self._remap()
+        return self._map
+
+    def _decode(self, where):
+        offset, length = where
+        line = self._view()[offset:offset + length]
+        self.bytes_read += length
+        return json.loads(line.partition(b' ')[2].decode('utf-8'))
+
+    def _encode(self, eid, element):
+        return u'{0} {1}\n'.format(
+            eid, json.dumps(element, **self.kwargs)).encode('utf-8')
+
+    def _append(self, records):
+        chunks = []
+        offset = self._size
+        for eid, element in records:
+            line = self._encode(eid, element)
+            chunks.append(line)
+            self._index_record(int(eid), offset, len(line), element is None)
+            offset += len(line)
+        self._handle.write(b''.join(chunks))
+        self._handle.flush()
+        self.bytes_written += offset - self._size
+        self._size = offset
+
+    def eids(self):
+        with self._lock:
+            return list(self._offsets)
+
+    def read_one(self, eid):
+        with self._lock:
+            where = self._offsets.get(int(eid))
+            if where is None:
+                return None
+            return self._decode(where)
+
+    def read(self):
+        with self._lock:
+            return dict((eid, self._decode(where))
+                        for eid, where in self._offsets.items())
+
+    def write(self, data):
+        with self._lock:
+            self._rewrite((int(eid), self._encode(eid, element))
+                          for eid, element in sorted(data.items()))
+
+    def _rewrite(self, lines):
+        """
+        Replace the file by ``(eid, line)`` pairs, written to a temp file
+        first so a crash leaves either the old or the new file.
+        """
+        tmp = self.path + '.tmp'
+        offsets = {}
+        size = 0
+        with open(tmp, 'wb') as handle:
+            for eid, line in lines:
+                handle.write(line)
+                offsets[eid] = (size, len(line))
+                size += len(line)
+            handle.flush()
+            os.fsync(handle.fileno())
+        self.bytes_written += size
+
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._handle.close()
+        _replace(tmp, self.path)
+        self._handle = open(self.path, 'ab')
+        self._size = size
+        self._offsets = offsets
+        self._dead = 0
+        self._remap()
+        self._save_index()
+        self._generation += 1
+
+    def apply(self, data, changes):
+        if not changes:
+            return
+
+        with self._lock:
+            self._append([(eid, None if op == 'remove' else element)
+                          for op, eid, element in changes])
+            self._generation += 1
+            if (self._dead > self.compact_threshold and
+                    self._dead * 2 > self._size):
+                self.compact()
+
+    def compact(self):
+        """
+        Rewrite the file with the live records only.
+        """
+        with self._lock:
+            view = self._view()
+            live = sorted(self._offsets.items(), key=lambda item: item[1])
+            # Copy the raw lines, there is no need to decode them
+            self._rewrite((eid, view[offset:offset + length])
+                          for eid, (offset, length) in live)
+
+    def sync(self):
+        with self._lock:
+            os.fsync(self._handle.fileno())
+
+    def stamp(self):
+        return self._generation
+
+    def close(self):
+        with self._lock:
+            self._save_index()
+            self._handle.close()
+            if self._map is not None:
+                self._map.close()
+                self._map = None
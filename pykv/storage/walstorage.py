@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+import os
+import glob
+import threading
+
+from pykv.utils import touch
+from pykv.storage.base import Storage
+
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+
+_replace = getattr(os, 'replace', os.rename)
+
+
+class WALStorage(Storage):
+    """
+    Write-ahead log storage.
+
+    The changes of every write are appended to a log segment
+    (``<path>.wal.<n>``) as one JSON line, so a write costs O(records)
+    instead of O(table).  On open the snapshot at ``path`` is loaded and the
+    segments it does not cover are replayed on top of it; a write torn by a
+    crash is dropped as a whole.  Once the active segment grows past
+    ``compact_threshold`` bytes a new segment is started and the table is
+    dumped into a fresh snapshot by a background thread.
+    """
+
+    def __init__(self, path, create_dirs=False, compact_threshold=1 << 20,
+                 **kwargs):
+        super(WALStorage, self).__init__()
+        touch(path, create_dirs=create_dirs)
+        self.path = path
+        self.compact_threshold = compact_threshold
+        self.kwargs = kwargs
+
+        self._lock = threading.RLock()
+        self._compactor = None
+        self._table = {}
+        self._generation = 0
+        self._segment = self._load()
+        self._open_segment(self._segment)
+
+    def _segment_path(self, segment):
+        return '{0}.wal.{1}'.format(self.path, segment)
+
+    def _segments(self):
+        segments = []
+        for name in glob.glob(self.path + '.wal.*'):
+            try:
+                segments.append(int(name.rsplit('.', 1)[1]))
+            except ValueError:
+                continue
+        return sorted(segments)
+
+    def _load(self):
+        with open(self.path) as handle:
+            raw = handle.read()
+        self.bytes_read += len(raw)
+        snapshot = json.loads(raw) if raw.strip() else {}
+        first = snapshot.get('segment', 0)
+        for eid, element in snapshot.get('table', {}).items():
+            self._table[int(eid)] = element
+
+        last = first
+        for segment in self._segments():
+            if segment < first:
+                # Already folded into the snapshot, left over by a crash
+                os.remove(self._segment_path(segment))
+                continue
+            self._replay(segment)
+            last = segment
+        return last
+
+    def _replay(self, segment):
+        offset = 0
+        with open(self._segment_path(segment), 'r+b') as handle:
+            for line in handle:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('Unterminated line')
+                    changes = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    # Torn write at the tail of the log, drop it so the
+                    # next change isn't appended to the partial line
+                    handle.seek(offset)
+                    handle.truncate()
+                    break
+                if changes and not isinstance(changes[0], list):
+                    # A single change, as logged by earlier versions
+                    changes = [changes]
+                for op, eid, element in changes:
+                    self._apply_change(op, eid, element)
+                self.bytes_read += len(line)
+                offset += len(line)
+
+    def _apply_change(self, op, eid, element):
+        if op == 'remove':
+            self._table.pop(eid, None)
+        else:
+            self._table[eid] = dict(element)
+
+    def _open_segment(self, segment):
+        self._log = open(self._segment_path(segment), 'a')
+        self._log_size = self._log.tell()
+
+    def _rotate(self):
+        self._log.close()
+        self._segment += 1
+        self._open_segment(self._segment)
+        return self._segment
+
+    def _write_snapshot(self, table, segment):
+        tmp = self.path + '.tmp'
+        serialized = json.dumps({'segment': segment, 'table': table},
+                                **self.kwargs)
+        with open(tmp, 'w') as handle:
+            handle.write(serialized)
+            handle.flush()
+            os.fsync(handle.fileno())
+        _replace(tmp, self.path)
+        self.bytes_written += len(serialized)
+
+        for old in self._segments():
+            if old < segment:
+                os.remove(self._segment_path(old))
+
+    def _wait_compactor(self):
+        if self._compactor is not None:
+            self._compactor.join()
+            self._compactor = None
+
+    def compact(self, background=True):
+        """
+        Fold the log into a new snapshot.
+        """
+        with self._lock:
+            if self._compactor is not None and self._compactor.is_alive():
+                return
+            self._wait_compactor()
+            segment = self._rotate()
+            table = dict(self._table)
+
+            if background:
+                self._compactor = threading.Thread(
+                    target=self._write_snapshot, args=(table, segment))
+                self._compactor.daemon = True
+                self._compactor.start()
+                return
+
+        self._write_snapshot(table, segment)
+
+    def read(self):
+        with self._lock:
+            return dict(self._table)
+
+    def write(self, data):
+        with self._lock:
+            self._wait_compactor()
+            self._table = dict((int(eid), dict(element))
+                               for eid, element in data.items())
+            self._generation += 1
+            self._write_snapshot(self._table, self._rotate())
+
+    def apply(self, data, changes):
+        if not changes:
+            return
+
+        # One line for all the changes, replayed all or nothing
+        record = json.dumps([[op, eid, element]
+                             for op, eid, element in changes],
+                            **self.kwargs) + '\n'
+
+        with self._lock:
+            self._log.write(record)
+            self.bytes_written += len(record)
+            self._log.flush()
+            self._log_size += len(record)
+            for op, eid, element in changes:
+                self._apply_change(op, eid, element)
+            self._generation += 1
+
+            if self._log_size > self.compact_threshold:
+                self.compact()
+
+    def _meta_files(self):
+        return [self.path] + [self._segment_path(segment)
+                              for segment in self._segments()]
+
+    def write_meta(self, meta):
+        with self._lock:
+            # A running compaction would change the files afterwards
+            self._wait_compactor()
+            self._log.flush()
+            super(WALStorage, self).write_meta(meta)
+
+    def sync(self):
+        with self._lock:
+            os.fsync(self._log.fileno())
+
+    def stamp(self):
+        return self._generation
+
+    def close(self):
+        with self._lock:
+            self._wait_compactor()
+            self._log.close()
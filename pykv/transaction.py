@@ -0,0 +1,52 @@
+"""
+Server side registry of open transactions.
+
+"""
+
+import threading
+import time
+import uuid
+
+__all__ = ('TransactionManager',)
+
+
+class TransactionManager(object):
+    """
+    Keeps the open transactions of a server by id. Transactions not used
+    for ``ttl`` seconds are aborted.
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._transactions = {}
+        self._lock = threading.Lock()
+
+    def expire(self):
+        now = time.time()
+        with self._lock:
+            for txn_id, (txn, expires) in list(self._transactions.items()):
+                if expires < now:
+                    txn.abort()
+                    del self._transactions[txn_id]
+
+    def begin(self, db):
+        self.expire()
+        txn_id = uuid.uuid4().hex
+        with self._lock:
+            self._transactions[txn_id] = (db.begin(), time.time() + self.ttl)
+        return txn_id
+
+    def get(self, txn_id):
+        """
+        :raises KeyError: if the transaction is unknown or expired
+        """
+        self.expire()
+        with self._lock:
+            txn, _ = self._transactions[txn_id]
+            self._transactions[txn_id] = (txn, time.time() + self.ttl)
+        return txn
+
+    def finish(self, txn_id):
+        with self._lock:
+            txn, _ = self._transactions.pop(txn_id)
+        return txn
@@ -2,7 +2,11 @@
 Utility functions.
 """
 
+from collections import OrderedDict
 from contextlib import contextmanager
+from itertools import islice
+import threading
+import time
 import warnings
 import os
 
@@ -12,58 +16,265 @@ itervalues = getattr(dict, 'itervalues', dict.values)
 
 
 
-class LRUCache(dict):
-    """
-    A simple LRU cache.
+class LRUCache(object):
     """
+    A LRU cache with O(1) lookups and updates.
 
-    def __init__(self, *args, **kwargs):
-        self.capacity = kwargs.pop('capacity', None) or float('nan')
-        self.lru = []
+    Entries are bounded by ``capacity`` and, optionally, by ``max_size``:
+    the sum of ``sizeof(value)`` over all entries. ``sizeof`` defaults to
+    ``len`` which makes ``max_size`` a budget of cached results; pass a
+    byte-size function to budget memory instead.
+    """
 
-        super(LRUCache, self).__init__(*args, **kwargs)
+    def __init__(self, capacity=None, max_size=None, sizeof=len):
+        self.capacity = capacity or None
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.RLock()
 
     def refresh(self, key):
-        if key in self.lru:
-            self.lru.remove(key)
-        self.lru.append(key)
+        try:
+            self._items.move_to_end(key)
+        except AttributeError:
+            self._items[key] = self._items.pop(key)
 
-    def get(self, key, default=None):
-        item = super(LRUCache, self).get(key, default)
-        self.refresh(key)
+    def __len__(self):
+        return len(self._items)
 
-        return item
+    def __iter__(self):
+        return iter(list(self._items))
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
 
     def __getitem__(self, key):
-        item = super(LRUCache, self).__getitem__(key)
-        self.refresh(key)
+        with self._lock:
+            try:
+                item = self._items[key]
+            except KeyError:
+                self.misses += 1
+                raise
+            self.hits += 1
+            self.refresh(key)
 
-        return item
+            return item
 
     def __setitem__(self, key, value):
-        super(LRUCache, self).__setitem__(key, value)
+        size = self.sizeof(value) if self.max_size is not None else 0
+
+        with self._lock:
+            if key in self._items:
+                del self[key]
 
-        self.refresh(key)
+            if self.max_size is not None and size > self.max_size:
+                return
 
-        if len(self) > self.capacity:
-            self.pop(self.lru.pop(0))
+            self._items[key] = value
+            self._sizes[key] = size
+            self.size += size
+
+            while self._items and (
+                    (self.capacity is not None
+                     and len(self._items) > self.capacity)
+                    or (self.max_size is not None
+                        and self.size > self.max_size)):
+                del self[next(iter(self._items))]
+                self.evictions += 1
 
     def __delitem__(self, key):
-        super(LRUCache, self).__delitem__(key)
-        self.lru.remove(key)
+        with self._lock:
+            del self._items[key]
+            self.size -= self._sizes.pop(key)
+
+    def invalidate(self, predicate):
+        """
+        Drop every entry for which ``predicate(key, value)`` is true.
+        """
+        with self._lock:
+            stale = [key for key, value in iteritems(self._items)
+                     if predicate(key, value)]
+            for key in stale:
+                del self[key]
+            return len(stale)
 
     def clear(self):
-        super(LRUCache, self).clear()
-        del self.lru[:]
+        with self._lock:
+            self._items.clear()
+            self._sizes.clear()
+            self.size = 0
+
+    def stats(self):
+        return {'entries': len(self._items), 'size': self.size,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
         
 
+class RWLock(object):
+    """
+    A readers-writer lock: any number of readers or a single writer.
+
+    Waiting writers hold back new readers so writes don't starve under a
+    steady stream of reads.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read_lock(self):
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    def acquire_write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+
+    def release_write(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+    @contextmanager
+    def write_lock(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+class GroupCommit(object):
+    """
+    Shares one ``sync()`` (e.g. an fsync) between the writes that arrive
+    while another sync is running.
+
+    Every write takes a ticket with :meth:`written`; :meth:`wait` returns
+    once a sync started after that ticket finished. When ``interval`` (in
+    seconds) is given a background thread also syncs that often, or as soon
+    as ``max_pending`` writes are waiting, so writers don't have to wait.
+    """
+
+    def __init__(self, sync, interval=None, max_pending=None):
+        self._sync = sync
+        self._cond = threading.Condition(threading.Lock())
+        self._written = 0
+        self._synced = 0
+        self._syncing = False
+        self._closed = False
+        self.interval = interval
+        self.max_pending = max_pending
+        self._thread = None
+        if interval is not None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def written(self):
+        with self._cond:
+            self._written += 1
+            if (self.max_pending is not None and
+                    self._written - self._synced >= self.max_pending):
+                self._cond.notify_all()
+            return self._written
+
+    def wait(self, ticket):
+        with self._cond:
+            while self._synced < ticket:
+                if self._syncing:
+                    # Ride along with the next sync
+                    self._cond.wait()
+                    continue
+                self._syncing = True
+                target = self._written
+                self._cond.release()
+                try:
+                    self._sync()
+                finally:
+                    self._cond.acquire()
+                    self._syncing = False
+                    self._cond.notify_all()
+                self._synced = max(self._synced, target)
+
+    def flush(self):
+        with self._cond:
+            ticket = self._written
+        self.wait(ticket)
+
+    def _due(self, deadline):
+        if time.time() >= deadline:
+            return True
+        return (self.max_pending is not None and
+                self._written - self._synced >= self.max_pending)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = time.time() + self.interval
+                while not self._closed and not self._due(deadline):
+                    self._cond.wait(max(deadline - time.time(), 0))
+                if self._closed:
+                    return
+            self.flush()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+
+def chunked(iterable, size):
+    """
+    Split ``iterable`` into lists of at most ``size`` items.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 def touch(fname, times=None, create_dirs=False):
     if create_dirs:
         base_dir = os.path.dirname(fname)
         if not os.path.exists(base_dir):
             os.makedirs(base_dir)
     with open(fname, 'a'):
-        os.utime(fname, times)
+        # Leave the mtime of an existing file alone unless asked, it tells
+        # whether saved metadata is still valid
+        if times is not None:
+            os.utime(fname, times)
 
 
 @contextmanager
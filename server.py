@@ -1,7 +1,16 @@
 from __future__ import (absolute_import)
 
-from pykv.database import TinyDB
+from pykv.database import ConflictError, TinyDB
 from pykv.queries import Query, QueryImpl, QueryOps
+from pykv.utils import RWLock
+from pykv.cursor import CursorManager, DEFAULT_BATCH_SIZE
+from pykv.transaction import TransactionManager
+from pykv.compiler import QueryCompiler
+from pykv.metrics import prometheus
+from pykv.replication import Follower, ReplicationLog
+from pykv.storage.compressedstorage import CompressedStorage
+from pykv.cache import SharedResultCache
+from pykv import protocol
 
 import zmq
 from zmq.devices import ProcessDevice
@@ -18,6 +27,9 @@ import copy_reg
 import types
 import shutil
 import logging
+import signal
+import threading
+from contextlib import contextmanager
 
 
 
@@ -26,6 +38,10 @@ def reduce_method(m):
 
 copy_reg.pickle(types.MethodType, reduce_method)
 
+# Anything else may change the data (drop_table, replicate, clear_cache...)
+READ_FUNCS = frozenset(["search", "get", "count", "contains", "all",
+                        "__len__", "aggregate", "tables", "stats"])
+
 
 def router_dealer(client_uri, internal_uri):
     pd = ProcessDevice(zmq.QUEUE, zmq.ROUTER, zmq.DEALER)
@@ -36,132 +52,348 @@ def router_dealer(client_uri, internal_uri):
     return pd
 
 class Server(object):
-    def __init__(self, db, client_uri, internal_uri, lock_uri, read_only=False):
+    def __init__(self, db, client_uri, internal_uri, read_only=False,
+                 rwlock=None, cursors=None, compiler=None, transactions=None,
+                 replication=None):
         self.client_uri = client_uri
         self.internal_uri = internal_uri
         self.rep_uri = internal_uri.replace("*", "localhost")
-        self.lock_uri = lock_uri
-        self.auto_reload = zmq.NONBLOCK if read_only else 0
+        # A replica: writes only come from the primary's log
+        self.read_only = read_only
+        # ReplicationLog of a primary, answers the followers catching up
+        self.replication = replication
         self.db = db
         self.running = False
+        # Shared by all the workers of one process: writes (and exec) get
+        # the database to themselves, reads run beside each other and,
+        # on a resident database, beside the writes on a snapshot
+        self.rwlock = rwlock if rwlock is not None else RWLock()
+        self.cursors = cursors if cursors is not None else CursorManager()
+        self.compiler = compiler if compiler is not None else QueryCompiler()
+        self.transactions = (transactions if transactions is not None
+                             else TransactionManager())
 
-    def start(self):
-        self.context = zmq.Context()
+    def start(self, context=None):
+        self.context = context if context is not None else zmq.Context()
         self.socket = self.context.socket(zmq.REP)
         self.socket.connect(self.rep_uri)
+
+    @contextmanager
+    def guard(self, message):
+        mode = message.get("mode")
+        if mode == "stats" or mode == "run" and message.get("txn") or (
+                mode == "txn" and message.get("action") == "abort"):
+            # Works on the transaction's own snapshot (or the metrics)
+            yield
+        elif mode in ("cursor", "replicate") or (
+                mode == "txn" and message.get("action") == "begin") or (
+                mode == "run" and message.get("func") in READ_FUNCS):
+            if self.db.mvcc:
+                yield
+            else:
+                with self.rwlock.read_lock():
+                    yield
+        else:
+            with self.rwlock.write_lock():
+                yield
             
     def run(self):
         self.running = True
         while self.running:
+            frames = self.socket.recv_multipart()
+            logging.debug("Received request: %s" % frames)
             try:
-                message = self.socket.recv(self.auto_reload)
-            except zmq.ZMQError as e:
-                pass
-            logging.debug("Received request: %s" % message)
+                codec, message = protocol.split_request(frames)
+            except ValueError:
+                self.socket.send_multipart(protocol.encode_unsupported(sys.exc_info()[1]))
+                continue
+
+            metrics = self.db.metrics
+            metrics.incr("requests")
+            error = None
             try:
-                message = json.loads(message)
-                if message["mode"] == "exec":
-                    # Make extra checks here
-                    old_stdout = sys.stdout
-                    stdout = sys.stdout = StringIO()
-                    try:
-                        try:
-                            co = compile(message["command"], "<command-line>", "eval")
-                        except SyntaxError:
-                            co = compile(message["command"], "<command-line>", "exec")
-                        ret = eval(co, globals()) 
-                        
-                    except:
-                        output = sys.exc_info()
-                    else:
-                        output = ret
-                    sys.stdout = old_stdout
-                elif message["mode"] == "readall":
-                    output = db
-                elif message["mode"] == "lock":
-                    output = {"locked": True, "uri": self.lock_uri}
-                elif message["mode"] == "unlock":
-                    output = {"locked": False}
-                else:
-                    try:
-                        entry = globals()[message["db"]]
-                        func = getattr(entry, message["func"])
-                        print(func)
-                    except AttributeError:
-                        output = "Server not find this func {0}".format(message["func"])     
-                    else: # to do : split this to simple funcs                     
-                        try:
-                            cond = None
-                            if message.get("index",None):
-                                query = Query(message["index"].pop(0))
-                                operation = getattr(query, message["operation"].pop(0))
-                                cond = operation(message["args"].pop(0))
-                                while message["connection"]:
-                                    if message["index"]:
-                                        query = Query(message["index"].pop(0))
-                                        operation = getattr(query, message["operation"].pop(0))                                
-                                        cond = getattr(cond, message["connection"].pop(0))(operation(message["args"].pop(0)))
-                                    else:
-                                        cond = getattr(cond, message["connection"].pop(0))()
-                                print(cond)
-                            if message["func"] == "insert":
-                                output = func(message["insert_item"])
-                            elif message["func"] == "update":
-                                query_op = QueryOps()
-                                print(message["update_op"])
-                                update_op = getattr(query_op, message["update_op"])
-                                print("update_op: ", update_op)
-                                output = func(update_op, cond)
-                            else:
-                                output = func(cond) if cond else func() # like db.__len__()
-                        except AttributeError:
-                            output = "Server not find this operation {0}".format(message["operation"])
-                            raise
-                        
-                     
-            except:
+                with metrics.timer("decode"):
+                    message = codec.loads(message) if codec else json.loads(message)
+                name = "request.{0}".format(message.get("func") or message.get("mode"))
+                with metrics.timer(name):
+                    # The fsync waits outside the lock, other writers may join it
+                    with self.db.group_commit():
+                        with self.guard(message):
+                            output = self.handle(message)
+            except Exception:
+                metrics.incr("errors")
+                error = sys.exc_info()[1]
                 output = traceback.format_exc()
-                logging.error(traceback.print_exc())
+                logging.error(output)
                 
             if type(output).__name__ in ['listiterator', 'dictionary-keyiterator']:
                 output = list(output)
+            request_id = message.get("id") if isinstance(message, dict) else None
+            if codec is not None:
+                with metrics.timer("encode"):
+                    if error is not None:
+                        frames = protocol.encode_error(codec, error, request_id)
+                    else:
+                        frames = protocol.encode_reply(codec, output, request_id)
+                self.socket.send_multipart(frames, copy=False)
+            else:
+                if request_id is not None:
+                    # Pipelined clients match replies to requests by id
+                    output = {"id": request_id, "result": output}
+                with metrics.timer("encode"):
+                    try:
+                        output = json.dumps(output)
+                    except:
+                        output = str(output)
+                self.socket.send(output)
+
+    def writes(self, message):
+        """
+        Whether a request may change the data.
+        """
+        mode = message.get("mode")
+        return mode in ("exec", "txn") or (
+            mode == "run" and message.get("func") not in READ_FUNCS)
+
+    def handle(self, message):
+        if self.read_only and self.writes(message):
+            raise ValueError("Read-only replica, send writes to the primary")
+        if message["mode"] == "exec":
+            # Make extra checks here
+            old_stdout = sys.stdout
+            stdout = sys.stdout = StringIO()
             try:
-                output = json.dumps(output)
+                try:
+                    co = compile(message["command"], "<command-line>", "eval")
+                except SyntaxError:
+                    co = compile(message["command"], "<command-line>", "exec")
+                ret = eval(co, globals()) 
+                
             except:
-                output = str(output)
-            self.socket.send(output)
-            
-            if message["mode"] == "lock":
-                self.normal_socket = self.socket
-                self.socket = zmq.Context().socket(zmq.REP)
-                self.socket.bind(self.lock_uri.replace("localhost", "*"))
-                logging.debug("Locked and listening on %s" % self.lock_uri)
-            elif message["mode"] == "unlock":
-                self.socket.close()
-                self.socket = self.normal_socket
-                logging.debug("Unlocked")
+                output = sys.exc_info()
+            else:
+                output = ret
+            sys.stdout = old_stdout
+        elif message["mode"] == "readall":
+            output = db
+        elif message["mode"] == "cursor":
+            if message.get("close"):
+                self.cursors.close(message["cursor"])
+                output = None
+            else:
+                output = self.cursors.fetch(message["cursor"], message.get("batch_size"))
+        elif message["mode"] == "txn":
+            output = self.transaction(message)
+        elif message["mode"] == "stats":
+            output = self.db.stats()
+            if message.get("format") == "prometheus":
+                output = prometheus(output)
+        elif message["mode"] == "replicate":
+            if self.replication is None:
+                raise ValueError("Not a replication primary")
+            output = self.replication.sync(message.get("since"),
+                                           message.get("epoch"))
+        elif message["mode"] in ("lock", "unlock"):
+            raise ValueError("Lock mode was replaced by transactions")
+        else:
+            try:
+                if message.get("txn"):
+                    entry = self.transactions.get(message["txn"])
+                else:
+                    entry = self.entry(message)
+                func = getattr(entry, message["func"])
+            except AttributeError:
+                output = "Server not find this func {0}".format(message["func"])     
+            else: # to do : split this to simple funcs                     
+                try:
+                    cond = None
+                    if message.get("query"):
+                        with self.db.metrics.timer("compile"):
+                            cond = self.compiler.compile(message["query"])
+                    if message["func"] == "insert":
+                        output = func(message["insert_item"])
+                    elif message["func"] == "update":
+                        update_op = QueryOps().parse(message["update_op"])
+                        output = func(update_op, cond)
+                    elif message["func"] == "search" and message.get("kwargs"):
+                        kwargs = dict(message["kwargs"])
+                        fields = kwargs.pop("fields", None)
+                        if kwargs:
+                            output = self.open_cursor(entry, cond, fields=fields,
+                                                      **kwargs)
+                        else:
+                            output = func(cond, fields=fields)
+                    elif message["func"] == "aggregate":
+                        output = func(cond, **message.get("kwargs") or {})
+                    else:
+                        output = func(cond) if cond else func() # like db.__len__()
+                except AttributeError:
+                    output = "Server not find this operation {0}".format(message.get("update_op"))
+                    raise
+
+        return output
+
+    def entry(self, message):
+        entry = globals()[message["db"]]
+        if message.get("table"):
+            entry = entry.table(message["table"])
+        return entry
+
+    def transaction(self, message):
+        """
+        Begin, commit or abort an optimistic transaction.
+        """
+        action = message["action"]
+        if action == "begin":
+            return {"txn": self.transactions.begin(self.entry(message))}
+
+        txn = self.transactions.finish(message["txn"])
+        if action == "abort":
+            txn.abort()
+            return {"committed": False}
+        if action == "commit":
+            try:
+                return {"committed": True, "eids": txn.commit()}
+            except ConflictError:
+                return {"committed": False,
+                        "conflicts": sys.exc_info()[1].eids}
+        raise ValueError("Unknown transaction action {0!r}".format(action))
+
+    def open_cursor(self, db, cond, batch_size=None, offset=0, limit=None,
+                    fields=None):
+        if batch_size is None:
+            batch_size = limit if limit is not None else DEFAULT_BATCH_SIZE
+        return self.cursors.open(db.iter_search(cond, fields), batch_size,
+                                 offset=offset, limit=limit)
+
+
+def start_workers(db, args, count, read_only=False, replication=None):
+    """
+    Start ``count`` worker threads on the internal DEALER endpoint. They
+    share one zmq context and one readers-writer lock.
+
+    The threads overlap waiting on the sockets, the disk and fsyncs, the
+    Python work of the requests still runs one at a time under the GIL.
+    They stay threads because they share the database, its resident
+    table and caches; run more servers to use more cores.
+    """
+    context = zmq.Context.instance()
+    rwlock = RWLock()
+    cursors = CursorManager()
+    compiler = QueryCompiler()
+    transactions = TransactionManager()
+    servers = []
+    for i in range(count):
+        server = Server(db, args.client_uri, args.internal_uri,
+                        read_only=read_only, rwlock=rwlock, cursors=cursors,
+                        compiler=compiler, transactions=transactions,
+                        replication=replication)
+        server.start(context)
+        servers.append(server)
+
+    for server in servers[1:]:
+        thread = threading.Thread(target=server.run)
+        thread.daemon = True
+        thread.start()
+    return servers[0]
 
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument("db_filename", default="/tmp/db.pkl", nargs='?')
+    parser.add_argument("db_filename", default="db.json", nargs='?')
     parser.add_argument("client_uri", default="tcp://*:5559", nargs='?')
     parser.add_argument("internal_uri", default="tcp://*:5560", nargs='?')
-    parser.add_argument("lock_uri", default="tcp://*:5558", nargs='?')
+    # Used by the old lock mode, accepted so existing command lines work
+    parser.add_argument("lock_uri", default="tcp://*:5558", nargs='?',
+                        help=argparse.SUPPRESS)
     parser.add_argument("-v", "--verbosity", action="count", default=0)
+    parser.add_argument("--resident", action="store_true",
+                        help="keep the table in memory between requests, "
+                             "reads then run on snapshots beside the writes "
+                             "(MVCC) instead of waiting for them")
+    parser.add_argument("--index", action="append", default=[],
+                        help="dotted field path to index, may be repeated")
+    parser.add_argument("--column", action="append", default=[],
+                        help="dotted numeric field path to scan as a numpy "
+                             "column, may be repeated")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker threads behind the device, "
+                             "they overlap I/O but share one core (GIL)")
+    parser.add_argument("--durability", choices=["none", "batch", "always"],
+                        default="none",
+                        help="when writes are fsynced: never, in batches or "
+                             "before replying")
+    parser.add_argument("--commit-interval", type=float, default=10,
+                        help="batch durability: ms between syncs")
+    parser.add_argument("--commit-writes", type=int, default=100,
+                        help="batch durability: sync after this many writes")
+    parser.add_argument("--compression", choices=["zlib", "lz4"],
+                        help="store the data compressed in blocks")
+    parser.add_argument("--cache-ttl", type=float,
+                        help="seconds a cached query result stays valid")
+    parser.add_argument("--shared-cache", action="store_true",
+                        help="share cached query results with the other "
+                             "processes of this host (in /dev/shm)")
+    parser.add_argument("--replication-uri",
+                        help="primary: publish the change log on this uri "
+                             "for followers, e.g. tcp://*:5561")
+    parser.add_argument("--follow", metavar="PRIMARY_URI",
+                        help="run as a read-only replica of the primary "
+                             "whose client endpoint is PRIMARY_URI")
+    parser.add_argument("--follow-log", metavar="LOG_URI",
+                        help="replica: the primary's --replication-uri")
     args = parser.parse_args()
+    if bool(args.follow) != bool(args.follow_log):
+        parser.error("--follow and --follow-log go together")
     if args.verbosity == 1:
         logging.basicConfig(level=logging.INFO)
     elif args.verbosity >= 2:
         logging.basicConfig(level=logging.DEBUG)
 
-    logging.info("Starting server: client_uri=%s internal_uri=%s lock_uri=%s"
-                 % (args.client_uri, args.internal_uri, args.lock_uri))
+    logging.info("Starting server: client_uri=%s internal_uri=%s"
+                 % (args.client_uri, args.internal_uri))
     router = router_dealer(args.client_uri, args.internal_uri)
-    db = TinyDB('db.json')
+    options = {"cache_ttl": args.cache_ttl}
+    if args.compression:
+        options.update(storage=CompressedStorage,
+                       compression=args.compression)
+    if args.shared_cache:
+        options.update(result_cache=SharedResultCache, cache_size=1000)
+    db = TinyDB(args.db_filename, resident=args.resident, warm_up=args.resident,
+                durability=args.durability,
+                commit_interval=args.commit_interval / 1000.0,
+                commit_writes=args.commit_writes, **options)
+    for path in args.index:
+        db.create_index(path)
+    for path in args.column:
+        db.create_column(path)
     query = Query()
-    server = Server(db, args.client_uri, args.internal_uri, args.lock_uri)
+    replication = None
+    if args.replication_uri:
+        replication = ReplicationLog(db, args.replication_uri)
     router.start()
-    server.start()
-    server.run()
+    server = start_workers(db, args, max(args.workers, 1),
+                           read_only=bool(args.follow), replication=replication)
+    follower = None
+    if args.follow:
+        follower = Follower(db, args.follow, args.follow_log,
+                            lock=server.rwlock)
+        follower.start()
+
+    def shutdown(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, shutdown)
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Saves the metadata for a fast restart and flushes pending syncs
+        logging.info("Shutting down")
+        if follower is not None:
+            follower.stop()
+        with server.rwlock.write_lock():
+            db.close()
+        if replication is not None:
+            replication.close()
  
@@ -0,0 +1,82 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      'server.py')
+
+
+def free_uri():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return 'tcp://127.0.0.1:{0}'.format(port)
+
+
+def _wait_for(uri, timeout=10):
+    host, port = uri[len('tcp://'):].split(':')
+    deadline = time.time() + timeout
+    while True:
+        sock = socket.socket()
+        try:
+            sock.connect((host, int(port)))
+            return
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+        finally:
+            sock.close()
+
+
+class ServerProcess(object):
+    """
+    server.py running in a process of its own, on free local ports.
+    """
+
+    def __init__(self, path, options):
+        self.path = path
+        self.options = list(options)
+        self.uri = free_uri()
+        self.internal_uri = free_uri()
+        self.process = None
+
+    def start(self):
+        self.process = subprocess.Popen(
+            [sys.executable, SERVER, self.path, self.uri, self.internal_uri]
+            + self.options)
+        _wait_for(self.uri)
+        return self
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            self.process.wait()
+        self.process = None
+
+
+@pytest.fixture
+def server(tmpdir):
+    """
+    Start a server with ``server(name, *options)``, stopped after the test.
+    """
+    pytest.importorskip('zmq')
+    if sys.version_info[0] != 2:
+        pytest.skip('server.py runs on Python 2')
+
+    servers = []
+
+    def start(name='db.json', *options):
+        process = ServerProcess(str(tmpdir.join(name)), options).start()
+        servers.append(process)
+        return process
+
+    yield start
+    for process in servers:
+        process.stop()
@@ -0,0 +1,82 @@
+import pytest
+
+from pykv.aggregate import Aggregation
+from pykv.database import TinyDB
+from pykv.queries import Query
+
+
+def _db(tmpdir):
+    db = TinyDB(str(tmpdir.join('db.json')), resident=True)
+    db.insert_multiple([
+        {'city': 'a', 'age': 10}, {'city': 'a', 'age': 30},
+        {'city': 'b', 'age': 'old'}, {'city': None, 'age': 5}, {'age': 7}])
+    return db
+
+
+def _scanned(db):
+    return db.metrics.snapshot()['counters'].get('rows_scanned', 0)
+
+
+def _by_city(rows):
+    return dict((row['city'], row) for row in rows)
+
+
+def test_metrics_per_group(tmpdir):
+    db = _db(tmpdir)
+    rows = _by_city(db.aggregate(group_by='city', metrics=[
+        'count', ['sum', 'age'], ['avg', 'age'], ['min', 'age'],
+        ['max', 'age']]))
+
+    assert rows['a'] == {'city': 'a', 'count': 2, 'sum(age)': 40,
+                         'avg(age)': 20.0, 'min(age)': 10, 'max(age)': 30}
+    # Only numbers are summed
+    assert rows['b']['sum(age)'] == 0
+    assert rows['b']['avg(age)'] is None
+    # A missing field groups with None
+    assert rows[None]['count'] == 2
+    assert rows[None]['sum(age)'] == 12
+
+
+def test_counts_from_the_index_match_a_scan(tmpdir):
+    db = _db(tmpdir)
+    scanned = db.aggregate(group_by='city')
+    db.create_index('city')
+
+    before = _scanned(db)
+    indexed = db.aggregate(group_by='city')
+    assert _scanned(db) == before
+    key = lambda row: str(row['city'])
+    assert sorted(indexed, key=key) == sorted(scanned, key=key)
+
+    # The index narrows a filtered aggregation down as for a search
+    before = _scanned(db)
+    rows = db.aggregate(Query().city == 'a', metrics=[['max', 'age']])
+    assert rows == [{'max(age)': 30}]
+    assert _scanned(db) - before == 2
+
+
+def test_empty_and_in_transaction(tmpdir):
+    db = _db(tmpdir)
+    assert db.aggregate(Query().city == 'z', metrics=['count', ['avg', 'age']]) == [
+        {'count': 0, 'avg(age)': None}]
+    assert db.aggregate(Query().city == 'z', group_by='city') == []
+
+    txn = db.begin()
+    txn.insert([{'city': 'z', 'age': 1}])
+    assert txn.aggregate(Query().city == 'z') == [{'count': 1}]
+    txn.abort()
+
+
+def test_group_by_lists_and_nested_paths():
+    aggregation = Aggregation(group_by=['tags', 'x.y'])
+    for element in [{'tags': ['a'], 'x': {'y': 1}}, {'tags': ['a'], 'x': {'y': 1}},
+                    {'tags': ['b']}]:
+        aggregation.add(element)
+    assert aggregation.rows() == [{'tags': ['a'], 'x.y': 1, 'count': 2},
+                                  {'tags': ['b'], 'x.y': None, 'count': 1}]
+
+
+def test_bad_metrics():
+    for metrics in [['median'], [['count', 'age']], [['sum']], []]:
+        with pytest.raises(ValueError):
+            Aggregation(metrics=metrics)
@@ -0,0 +1,92 @@
+import json
+import time
+
+from pykv.database import TinyDB
+from pykv.queries import Query
+from pykv.utils import LRUCache
+
+
+def test_outside_change_is_seen_by_cached_search(tmpdir):
+    path = str(tmpdir.join('db.json'))
+    db = TinyDB(path, resident=True)
+    db.insert_multiple([{'name': 'he'}, {'name': 'she'}])
+    q = Query()
+    assert len(db.search(q.name == 'he')) == 1
+    assert len(db.search(q.name == 'he')) == 1
+
+    # Another process rewrites the file
+    with open(path, 'w') as handle:
+        json.dump({'2': {'name': 'she'}, '3': {'name': 'it'}}, handle)
+
+    assert db.search(q.name == 'he') == []
+    assert db.count(q.name == 'it') == 1
+    db.close()
+
+
+def test_write_keeps_unrelated_results(tmpdir):
+    db = TinyDB(str(tmpdir.join('db.json')), resident=True)
+    db.insert_multiple([{'name': 'he', 'age': 1}])
+    q = Query()
+    db.search(q.name == 'he')
+    db.insert_multiple([{'age': 2}])
+
+    hits = db.cache_stats()['hits']
+    assert len(db.search(q.name == 'he')) == 1
+    assert db.cache_stats()['hits'] == hits + 1
+    db.close()
+
+
+def test_lru_evicts_by_count_and_size():
+    cache = LRUCache(capacity=3, max_size=5)
+    cache['a'] = [1]
+    cache['b'] = [1, 2]
+    cache['c'] = [1]
+    assert cache['a'] == [1]
+    cache['d'] = [1]
+    # Over capacity, 'b' was used least recently
+    assert list(cache) == ['c', 'a', 'd']
+    # Over the size budget
+    cache['e'] = [1, 2, 3]
+    assert list(cache) == ['a', 'd', 'e']
+    assert cache.size == 5
+    # Too big to be kept at all
+    cache['f'] = list(range(6))
+    assert list(cache) == ['a', 'd', 'e']
+    assert cache.evictions == 2
+
+
+def test_write_drops_results_holding_changed_elements(tmpdir):
+    db = TinyDB(str(tmpdir.join('db.json')), resident=True, cache_size=100)
+    db.insert_multiple([{'name': 'he', 'age': 1}, {'name': 'she', 'age': 2}])
+    q = Query()
+    db.search(q.name == 'he')
+    db.search(q.name == 'she')
+    db.search(q.age > 0)
+
+    db.update({'age': 3}, q.name == 'he')
+    misses = db.cache_stats()['misses']
+    assert db.search(q.name == 'she') == [{'name': 'she', 'age': 2}]
+    assert db.cache_stats()['misses'] == misses
+    # Holds the changed element, or looks at the changed field
+    assert db.search(q.name == 'he') == [{'name': 'he', 'age': 3}]
+    assert sorted(e['age'] for e in db.search(q.age > 0)) == [2, 3]
+    assert db.cache_stats()['misses'] == misses + 2
+    db.close()
+
+
+def test_entries_expire(tmpdir):
+    db = TinyDB(str(tmpdir.join('db.json')), resident=True, cache_ttl=0.05)
+    db.insert_multiple([{'name': 'he'}])
+    q = Query()
+    db.search(q.name == 'he')
+    assert db.cache_stats()['expirations'] == 0
+    time.sleep(0.1)
+    assert len(db.search(q.name == 'he')) == 1
+    assert db.cache_stats()['expirations'] == 1
+
+
+def test_queries_on_lists_are_not_cached(tmpdir):
+    db = TinyDB(str(tmpdir.join('db.json')), resident=True)
+    db.insert_multiple([{'tags': ['a', 'b']}, {'tags': ['a']}])
+    assert db.search(Query().tags == ['a']) == [{'tags': ['a']}]
+    assert db.search(Query().tags == ['a']) == [{'tags': ['a']}]
@@ -0,0 +1,20 @@
+import pytest
+
+client = pytest.importorskip('client')
+
+
+def test_failed_chunk_reports_the_stored_ones(server):
+    uri = server().uri
+    for connect in (client.client_factory, client.async_client_factory):
+        db = connect('db', uri)
+        with pytest.raises(client.InsertError) as info:
+            answer = db.insert([{'i': 1}, {'i': 2}, 3, {'i': 4}, {'i': 5}],
+                               chunk_size=2)
+            if connect is client.async_client_factory:
+                answer.result()
+        assert 'Element is not a dictionary' in str(info.value)
+        if connect is client.client_factory:
+            assert info.value.eids == [1, 2]
+        else:
+            # Pipelined, the chunk after the failed one was sent as well
+            assert info.value.eids == [3, 4, 5]
@@ -0,0 +1,18 @@
+import pytest
+
+from pykv.database import TinyDB
+from pykv.queries import Query
+
+pytest.importorskip('numpy')
+
+
+def test_special_and_large_numbers(tmpdir):
+    db = TinyDB(str(tmpdir.join('db.json')), resident=True)
+    db.create_column('n')
+    db.insert_multiple([{'n': float('inf')}, {'n': 2 ** 53}, {'n': 3}])
+    q = Query()
+
+    assert db.search(q.n == float('inf')) == [{'n': float('inf')}]
+    assert db.search(q.n == 2 ** 53 + 1) == []
+    assert db.search(q.n == 2 ** 53) == [{'n': 2 ** 53}]
+    assert len(db.search(q.n > 5)) == 2
@@ -0,0 +1,60 @@
+import pytest
+
+from pykv.database import TinyDB
+from pykv.storage import compressedstorage
+from pykv.storage.compressedstorage import CompressedStorage
+from pykv.storage.jsonstorage import JSONStorage
+
+
+def _storage(tmpdir, **kwargs):
+    return CompressedStorage(str(tmpdir.join('db.json')), block_size=4,
+                             **kwargs)
+
+
+def test_round_trip(tmpdir):
+    path = str(tmpdir.join('db.json'))
+    with TinyDB(path, storage=CompressedStorage, block_size=4) as db:
+        db.insert_multiple([{'i': i, 'name': u'\xe9l\xe8ve'} for i in range(10)])
+        db.remove(eids=[3])
+        db.update({'i': -1}, eids=[4])
+
+    with TinyDB(path, storage=CompressedStorage, block_size=4) as db:
+        assert len(db) == 9
+        assert db.get(eid=4) == {'i': -1, 'name': u'\xe9l\xe8ve'}
+        assert db.get(eid=3) is None
+        assert sorted(element.eid for element in db.all()) == [
+            1, 2, 4, 5, 6, 7, 8, 9, 10]
+
+
+def test_blocks_come_and_go_with_their_records(tmpdir):
+    storage = _storage(tmpdir)
+    storage.write(dict((eid, {'i': eid}) for eid in range(1, 6)))
+    assert sorted(storage._load()) == [0, 1]
+
+    storage.apply(None, [('insert', 9, {'i': 9})])
+    assert sorted(storage._load()) == [0, 1, 2]
+    storage.apply(None, [('remove', 4, None), ('remove', 5, None)])
+    assert sorted(storage._load()) == [0, 2]
+    assert sorted(storage.eids()) == [1, 2, 3, 9]
+    assert storage.read_one(9) == {'i': 9}
+    assert storage.read_one(5) is None
+
+
+def test_failed_apply_leaves_the_blocks_alone(tmpdir, monkeypatch):
+    storage = _storage(tmpdir)
+    storage.write({1: {'i': 1}})
+
+    def fail(data, changes):
+        raise IOError('disk full')
+    monkeypatch.setattr(storage.storage, 'apply', fail)
+    with pytest.raises(IOError):
+        storage.apply(None, [('update', 1, {'i': 2}), ('insert', 5, {'i': 5})])
+    assert storage.read() == {1: {'i': 1}}
+
+
+def test_lz4_falls_back_to_zlib(tmpdir, monkeypatch):
+    monkeypatch.setattr(compressedstorage, 'lz4', None)
+    storage = _storage(tmpdir, compression='lz4')
+    storage.write({1: {'i': 1}})
+    assert storage._load()[0]['codec'] == 'zlib'
+    assert CompressedStorage(storage.storage.path).read() == {1: {'i': 1}}
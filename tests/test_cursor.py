@@ -0,0 +1,11 @@
+from pykv.cursor import CursorManager, DEFAULT_BATCH_SIZE
+
+
+def test_fetch_without_batch_size():
+    cursors = CursorManager()
+    page = cursors.open(range(DEFAULT_BATCH_SIZE + 10), 5)
+    assert page['rows'] == [0, 1, 2, 3, 4]
+    page = cursors.fetch(page['cursor'], None)
+    assert len(page['rows']) == DEFAULT_BATCH_SIZE
+    page = cursors.fetch(page['cursor'])
+    assert page == {'cursor': None, 'rows': list(range(1005, 1010))}
@@ -0,0 +1,107 @@
+import threading
+import time
+
+from pykv.database import TinyDB
+from pykv.storage.jsonstorage import JSONStorage
+from pykv.utils import GroupCommit
+
+
+class CountingStorage(JSONStorage):
+    def __init__(self, *args, **kwargs):
+        super(CountingStorage, self).__init__(*args, **kwargs)
+        self.syncs = 0
+        self.check = None
+
+    def sync(self):
+        if self.check is not None:
+            self.check()
+        self.syncs += 1
+        super(CountingStorage, self).sync()
+
+
+def _db(tmpdir, durability, **kwargs):
+    return TinyDB(str(tmpdir.join('db.json')), storage=CountingStorage,
+                  durability=durability, **kwargs)
+
+
+def test_durability_modes(tmpdir):
+    db = _db(tmpdir.mkdir('none'), 'none')
+    db.insert_multiple([{'i': 1}])
+    assert db._storage.syncs == 0
+    db.close()
+
+    db = _db(tmpdir.mkdir('always'), 'always')
+    # Not while other writers are kept waiting
+    db._storage.check = lambda: _assert_unlocked(db._write_lock)
+    db.insert_multiple([{'i': 1}])
+    assert db._storage.syncs == 1
+    db.update({'i': 2}, eids=[1])
+    assert db._storage.syncs == 2
+    db.close()
+
+    db = _db(tmpdir.mkdir('batch'), 'batch', commit_interval=60,
+             commit_writes=2)
+    db.insert_multiple([{'i': 1}])
+    assert db._storage.syncs == 0
+    db.insert_multiple([{'i': 2}])
+    deadline = time.time() + 5
+    while db._storage.syncs == 0 and time.time() < deadline:
+        time.sleep(0.01)
+    assert db._storage.syncs == 1
+    db.close()
+
+
+def _assert_unlocked(lock):
+    taken = []
+    thread = threading.Thread(target=lambda: taken.append(
+        lock.acquire(False) and lock.release() is None))
+    thread.start()
+    thread.join()
+    assert taken == [True]
+
+
+def test_group_commit_covers_tables_opened_in_it(tmpdir):
+    db = _db(tmpdir, 'always')
+    with db.group_commit():
+        table = db.table('users')
+        table.insert_multiple([{'name': 'he'}])
+        assert table._storage.syncs == 0
+    assert table._storage.syncs == 1
+    db.close()
+
+
+def test_ticket_waits_for_a_sync_started_after_it():
+    calls = []
+    release = threading.Event()
+
+    def sync():
+        calls.append(len(calls))
+        release.wait(5)
+
+    committer = GroupCommit(sync)
+    first = threading.Thread(target=committer.wait,
+                             args=(committer.written(),))
+    first.start()
+    while not calls:
+        time.sleep(0.01)
+
+    # Written while that sync runs, it may have missed this write
+    second = threading.Thread(target=committer.wait,
+                              args=(committer.written(),))
+    second.start()
+    time.sleep(0.05)
+    assert second.is_alive()
+    release.set()
+    first.join()
+    second.join()
+    assert calls == [0, 1]
+
+
+def test_close_flushes_pending_writes():
+    calls = []
+    committer = GroupCommit(lambda: calls.append(1), interval=60)
+    committer.written()
+    committer.written()
+    assert calls == []
+    committer.close()
+    assert calls == [1]
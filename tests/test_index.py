@@ -0,0 +1,55 @@
+from pykv.database import TinyDB
+from pykv.queries import Query
+
+
+def _scanned(db):
+    return db.metrics.snapshot()['counters'].get('rows_scanned', 0)
+
+
+def test_indexed_queries_scan_only_candidates(tmpdir):
+    db = TinyDB(str(tmpdir.join('db.json')), resident=True)
+    db.create_index('age')
+    db.create_index(('name',))
+    db.insert_multiple([{'name': 'n{0}'.format(i % 10), 'age': i}
+                        for i in range(100)])
+    q = Query()
+
+    before = _scanned(db)
+    assert len(db.search(q.name == 'n3')) == 10
+    assert _scanned(db) - before == 10
+
+    before = _scanned(db)
+    assert [element['age'] for element in db.search(
+        (q.age >= 90) & (q.name == 'n5'))] == [95]
+    assert _scanned(db) - before == 1
+
+    assert len(db.search((q.age < 3) | (q.age > 97))) == 5
+    assert db.get(q.age == 42)['name'] == 'n2'
+
+
+def test_indexes_follow_writes(tmpdir):
+    db = TinyDB(str(tmpdir.join('db.json')), resident=True)
+    db.create_index('age')
+    db.insert_multiple([{'age': i} for i in range(10)])
+    q = Query()
+
+    db.update({'age': 100}, q.age == 1)
+    db.remove(q.age == 2)
+    assert db.search(q.age == 1) == []
+    assert db.search(q.age == 2) == []
+    assert db.search(q.age > 50) == [{'age': 100}]
+    assert db.count(q.age <= 3) == 2
+
+
+def test_values_the_index_cannot_order(tmpdir):
+    db = TinyDB(str(tmpdir.join('db.json')), resident=True)
+    db.create_index('v')
+    db.insert_multiple([{'v': 1}, {'v': 'a'}, {'v': [1, 2]}, {'v': 3}, {}])
+    q = Query()
+
+    # Lists can't be hashed, the query checks those elements itself
+    before = _scanned(db)
+    assert db.search(q.v == 3) == [{'v': 3}]
+    assert _scanned(db) - before == 2
+    assert db.search(q.v == 'a') == [{'v': 'a'}]
+    assert db.count(q.v.exists()) == 4
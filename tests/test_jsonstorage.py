@@ -0,0 +1,28 @@
+import json
+
+from pykv.database import TinyDB
+from pykv.storage.jsonstorage import JSONStorage
+
+
+def test_resident_table_follows_external_edits(tmpdir):
+    path = str(tmpdir.join('db.json'))
+    db = TinyDB(path, resident=True)
+    db.insert_multiple([{'i': i} for i in range(10)])
+    assert len(db) == 10
+
+    with open(path, 'w') as handle:
+        json.dump({'1': {'i': 0}}, handle)
+
+    assert len(db) == 1
+    assert db.all() == [{'i': 0}]
+    db.close()
+
+
+def test_read_after_own_write_and_external_edit(tmpdir):
+    path = str(tmpdir.join('db.json'))
+    storage = JSONStorage(path)
+    storage.write({'1': {'i': 1}, '2': {'i': 2}})
+    with open(path, 'w') as handle:
+        json.dump({'3': {'i': 3}}, handle)
+    assert storage.read() == {'3': {'i': 3}}
+    storage.close()
@@ -0,0 +1,71 @@
+import json
+import os
+
+from pykv.database import TinyDB
+from pykv.queries import Query
+from pykv.storage.walstorage import WALStorage
+
+
+def _fill(path, **kwargs):
+    with TinyDB(path, **kwargs) as db:
+        db.create_index('i')
+        db.insert_multiple([{'i': i} for i in range(5)])
+        db.remove(eids=[5])
+        db.table('users').insert_multiple([{'name': 'he'}])
+
+
+def test_open_uses_the_saved_metadata(tmpdir):
+    path = str(tmpdir.join('db.json'))
+    _fill(path)
+
+    db = TinyDB(path, resident=True)
+    assert db._table is None
+    assert len(db) == 4
+    assert db._storage.bytes_read == 0
+    assert db.tables() == ['users']
+    assert ('i',) in db._indexes
+    # Ids are not reused even though the last element was removed
+    assert db.insert([{'i': 5}]) == [6]
+    assert db.search(Query().i == 5) == [{'i': 5}]
+    db.close()
+
+
+def test_data_changed_after_close_is_read(tmpdir):
+    path = str(tmpdir.join('db.json'))
+    _fill(path)
+    with open(path, 'w') as handle:
+        json.dump({'1': {'i': 0}, '9': {'i': 8}}, handle)
+
+    db = TinyDB(path)
+    assert len(db) == 2
+    assert db.insert([{'i': 9}]) == [10]
+    db.close()
+
+
+def test_broken_or_missing_metadata_is_ignored(tmpdir):
+    path = str(tmpdir.join('db.json'))
+    _fill(path)
+    with open(path + '.meta', 'w') as handle:
+        handle.write('{"last_id": ')
+    db = TinyDB(path)
+    assert db.insert([{'i': 5}]) == [5]
+    db.close()
+
+    os.remove(path + '.meta')
+    db = TinyDB(path)
+    assert db.insert([{'i': 6}]) == [6]
+    db.close()
+
+
+def test_wal_segments_invalidate_the_metadata(tmpdir):
+    path = str(tmpdir.join('db.json'))
+    _fill(path, storage=WALStorage)
+    segment = sorted(name for name in os.listdir(str(tmpdir))
+                     if name.startswith('db.json.wal.'))[-1]
+    with open(str(tmpdir.join(segment)), 'ab') as handle:
+        handle.write(b'[["insert", 8, {"i": 7}]]\n')
+
+    db = TinyDB(path, storage=WALStorage)
+    assert len(db) == 5
+    assert db.insert([{'i': 8}]) == [9]
+    db.close()
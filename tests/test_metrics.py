@@ -0,0 +1,74 @@
+import re
+
+import pytest
+
+from pykv.database import TinyDB
+from pykv.metrics import BUCKETS, Histogram, Metrics, prometheus
+from pykv.queries import Query
+
+
+def test_histogram_buckets_and_quantiles():
+    histogram = Histogram()
+    for seconds in [0.00005] * 98 + [0.003, 20.0]:
+        histogram.observe(seconds)
+
+    snapshot = histogram.snapshot()
+    assert snapshot['count'] == 100
+    assert snapshot['max'] == 20.0
+    assert snapshot['p50'] == BUCKETS[0]
+    assert snapshot['p99'] == 0.005
+    # Cumulative, the slowest one is past the last bound
+    assert snapshot['buckets'][0] == [BUCKETS[0], 98]
+    assert snapshot['buckets'][-1] == [BUCKETS[-1], 99]
+
+
+def test_stats_count_rows_cache_and_storage(tmpdir):
+    db = TinyDB(str(tmpdir.join('db.json')), resident=True)
+    db.insert_multiple([{'i': i} for i in range(10)])
+    db.table('other').insert_multiple([{'i': 0}])
+    db.search(Query().i < 3)
+    db.search(Query().i < 3)
+
+    stats = db.stats()
+    counters = stats['counters']
+    assert counters['rows_scanned'] == 10
+    assert counters['rows_returned'] == 3
+    assert counters['storage_bytes_written'] > 0
+    assert stats['cache']['hits'] == 1
+    assert stats['cache']['hit_ratio'] == 0.5
+    assert stats['timings']['evaluate']['count'] == 1
+    db.close()
+
+
+def test_prometheus_text_format():
+    metrics = Metrics()
+    metrics.incr('requests', 3)
+    with metrics.timer('decode'):
+        pass
+    stats = metrics.snapshot()
+    stats['cache'] = {'hits': 2}
+    text = prometheus(stats)
+
+    assert text.endswith('\n')
+    lines = text.splitlines()
+    assert lines[:4] == ['# TYPE pykv_requests_total counter',
+                         'pykv_requests_total 3.0',
+                         '# TYPE pykv_cache_hits gauge',
+                         'pykv_cache_hits 2.0']
+    assert '# TYPE pykv_seconds histogram' in lines
+    assert 'pykv_seconds_bucket{phase="decode",le="+Inf"} 1' in lines
+    assert 'pykv_seconds_count{phase="decode"} 1' in lines
+    sample = re.compile(r'^[a-z_]+(\{[a-z]+="[^"]*"(,[a-z]+="[^"]*")*\})? \S+$')
+    for line in lines:
+        assert line.startswith('# TYPE ') or sample.match(line), line
+
+
+def test_stats_request(server):
+    client = pytest.importorskip('client')
+    db = client.client_factory('db', server().uri)
+    db.insert([{'i': 1}])
+
+    stats = db.stats()
+    assert stats['counters']['requests'] >= 2
+    assert stats['timings']['request.insert']['count'] == 1
+    assert 'pykv_requests_total' in db.stats(prometheus=True)
@@ -0,0 +1,54 @@
+import pytest
+
+from pykv.database import ConflictError, TinyDB
+from pykv.queries import Query
+
+
+def test_writes_leave_open_snapshots_alone(tmpdir):
+    db = TinyDB(str(tmpdir.join('db.json')), resident=True)
+    db.insert_multiple([{'i': i} for i in range(10)])
+    q = Query()
+
+    scan = db.iter_search(q.i >= 0)
+    txn = db.begin()
+    db.remove(q.i < 5)
+    db.insert_multiple([{'i': 10}])
+
+    assert sorted(element['i'] for element in scan) == list(range(10))
+    assert txn.count(q.i >= 0) == 10
+    txn.abort()
+    assert sorted(element['i'] for element in db.all()) == list(range(5, 11))
+
+
+def test_write_in_place_without_readers(tmpdir):
+    db = TinyDB(str(tmpdir.join('db.json')), resident=True)
+    db.insert_multiple([{'i': i} for i in range(10)])
+    table = db._read()
+    db.update({'j': 1}, eids=[1])
+    db.remove(eids=[2])
+    assert db._read() is table
+    assert db.get(eid=1) == {'i': 0, 'j': 1}
+    assert db.get(eid=2) is None
+
+
+def test_versions_are_only_kept_for_open_transactions(tmpdir):
+    db = TinyDB(str(tmpdir.join('db.json')), resident=True)
+    db.insert_multiple([{'i': i} for i in range(10)])
+    db.update({'j': 1}, eids=[1, 2])
+    assert db._versions == {}
+
+    old = db.begin()
+    db.update({'j': 2}, eids=[1, 2])
+    txn = db.begin()
+    txn.update({'j': 3}, eids=[3])
+    old.abort()
+    db.update({'j': 4}, eids=[3])
+    db.insert_multiple([{'i': i} for i in range(2000)])
+    # Older than every open transaction
+    assert 1 not in db._versions and 2 not in db._versions
+    assert db._versions[3] > txn.version
+
+    with pytest.raises(ConflictError):
+        txn.commit()
+    db.insert_multiple([{'i': -1}])
+    assert db._versions == {}
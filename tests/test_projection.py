@@ -0,0 +1,66 @@
+import pytest
+
+from pykv.database import TinyDB
+from pykv.queries import Query, project
+
+ELEMENT = {'name': 'he', 'age': {'x': 1, 'y': 2}, 'tags': ['a', 'b']}
+
+
+def test_project_paths():
+    assert project(ELEMENT, ['name', 'age.x']) == {'name': 'he', 'age': {'x': 1}}
+    # Lists of keys, positions index into lists
+    assert project(ELEMENT, [['age', 'y'], ['tags', 1]]) == {
+        'age': {'y': 2}, 'tags': {1: 'b'}}
+    # Missing fields are left out rather than set to None
+    assert project(ELEMENT, ['nope', 'age.z', 'name.first']) == {}
+    assert project(ELEMENT, []) == {}
+
+
+def test_parent_field_wins_over_a_child():
+    assert project(ELEMENT, ['age', 'age.x']) == {'age': {'x': 1, 'y': 2}}
+    assert project(ELEMENT, ['age.x', 'age']) == {'age': {'x': 1, 'y': 2}}
+
+
+def test_plain_string_and_empty_paths():
+    assert project(ELEMENT, 'age.y') == {'age': {'y': 2}}
+    # An empty string is the key '', only an empty path is refused
+    assert project({'': 1, 'a': {'': 2}}, ['', 'a.']) == {'': 1, 'a': {'': 2}}
+    for fields in [[[]], ['name', ()]]:
+        with pytest.raises(ValueError):
+            project(ELEMENT, fields)
+
+
+def test_search_keeps_eids_and_cached_elements(tmpdir):
+    db = TinyDB(str(tmpdir.join('db.json')), resident=True)
+    db.insert_multiple([ELEMENT, {'name': 'she'}])
+
+    rows = db.search(Query().name == 'he', fields=['age.x'])
+    assert rows == [{'age': {'x': 1}}]
+    assert rows[0].eid == 1
+    # The whole element is still what a plain search returns
+    assert db.search(Query().name == 'he') == [ELEMENT]
+    assert list(db.iter_search(Query().name.exists(), fields=['name'])) == [
+        {'name': 'he'}, {'name': 'she'}]
+
+    txn = db.begin()
+    txn.insert([{'name': 'it', 'age': {'x': 3}}])
+    assert [row.eid for row in txn.search(Query().age.x == 3, fields=['name'])] == [3]
+    assert txn.search(Query().age.x >= 1, fields=['age.x']) == [
+        {'age': {'x': 1}}, {'age': {'x': 3}}]
+    txn.abort()
+    db.close()
+
+
+def test_client_search_fields(server):
+    client = pytest.importorskip('client')
+    from pykv.queriesinfo import Query as ClientQuery
+
+    db = client.client_factory('db', server().uri)
+    db.insert([{'i': i, 'pad': 'x', 'n': {'a': i, 'b': 0}} for i in range(5)])
+
+    assert db.search(ClientQuery().i == 1, fields='n.a') == [{'n': {'a': 1}}]
+    assert db.search(ClientQuery().i < 2, fields=['i', 'nope']) == [
+        {'i': 0}, {'i': 1}]
+    # Also through a server side cursor
+    rows = db.search(ClientQuery().i >= 0, batch_size=2, fields=['i'])
+    assert list(rows) == [{'i': i} for i in range(5)]
@@ -0,0 +1,63 @@
+import pytest
+
+from pykv import protocol
+
+
+def _codecs():
+    return [codec for codec in (protocol.JSON, protocol.MSGPACK)
+            if codec is not None]
+
+
+def test_long_results_go_in_row_frames():
+    rows = [{'i': i} for i in range(protocol.ROWS_PER_FRAME * 2 + 1)]
+    for codec in _codecs():
+        frames = protocol.encode_reply(codec, rows, request_id=7)
+        assert len(frames) == 2 + 3
+        header = protocol.decode_reply(frames)
+        assert header['id'] == 7
+        assert header['result'] == rows
+
+        header = protocol.decode_reply(protocol.encode_reply(codec, [1, 2]))
+        assert header == {'result': [1, 2]}
+
+
+def test_unencodable_results_and_errors():
+    header = protocol.decode_reply(
+        protocol.encode_reply(protocol.JSON, set([1])))
+    assert header['result'] == str(set([1]))
+
+    header = protocol.decode_reply(
+        protocol.encode_error(protocol.JSON, ValueError('bad'), 3))
+    assert header == {'id': 3, 'error': 'ValueError: bad'}
+
+
+def test_unknown_codec_is_refused_with_the_known_ones():
+    with pytest.raises(ValueError):
+        protocol.split_request([b'X', b'{}'])
+    assert protocol.split_request([b'{}']) == (None, b'{}')
+
+    header = protocol.decode_reply(protocol.encode_unsupported('no X'))
+    assert sorted(header['codecs']) == sorted(
+        codec.tag.decode('ascii') for codec in _codecs())
+
+
+class OtherCodec(protocol.JSONCodec):
+    tag = b'X'
+
+
+def test_client_falls_back_to_json(server):
+    client = pytest.importorskip('client')
+    zmq = pytest.importorskip('zmq')
+    uri = server().uri
+
+    socket = zmq.Context().socket(zmq.REQ)
+    socket.connect(uri)
+    db = client.Client('db', socket, codec=OtherCodec())
+    assert db.insert([{'i': 1}]) == [1]
+    assert db.codec is protocol.JSON
+
+    pipelined = client.async_client_factory('db', uri)
+    pipelined.codec = OtherCodec()
+    futures = [pipelined.insert([{'i': i}]) for i in range(2, 4)]
+    assert [future.result() for future in futures] == [[2], [3]]
+    assert pipelined.codec is protocol.JSON
@@ -0,0 +1,44 @@
+import copy
+
+from pykv.compiler import QueryCompiler
+from pykv.database import TinyDB
+from pykv.queries import Query, QueryOps
+from pykv.queriesinfo import Query as QueryInfo
+
+
+def test_list_position_past_the_end_is_missing(tmpdir):
+    db = TinyDB(str(tmpdir.join('db.json')), resident=True)
+    db.create_index(('tags', 1))
+    db.insert_multiple([{'tags': ['a']}, {'tags': ['a', 'b']}])
+
+    assert db.search(Query().tags[1] == 'b') == [{'tags': ['a', 'b']}]
+    plan = QueryCompiler().compile((QueryInfo().tags[1] == 'b').ast)
+    assert db.search(plan) == [{'tags': ['a', 'b']}]
+    rows = db.aggregate(group_by=[('tags', 1)])
+    assert sorted(rows, key=lambda row: str(row['tags.1'])) == [
+        {'tags.1': None, 'count': 1}, {'tags.1': 'b', 'count': 1}]
+
+
+def test_removals_and_copy_on_write_ops_copy_nothing_deep(tmpdir, monkeypatch):
+    db = TinyDB(str(tmpdir.join('db.json')), resident=True)
+    db.insert_multiple([{'i': i, 'tags': ['a']} for i in range(6)])
+    q = Query()
+    scan = db.iter_search(q.i >= 0)
+
+    def deepcopy(value, memo=None):
+        raise AssertionError('deep copy')
+    monkeypatch.setattr(copy, 'deepcopy', deepcopy)
+
+    assert db.update(QueryOps().delete, q.i == 0) == [1]
+    assert db.remove(q.i == 1) == [2]
+    txn = db.begin()
+    txn.remove(q.i == 2)
+    txn.update(QueryOps().push('tags', 'b'), q.i == 3)
+    txn.update({'j': 1}, q.i == 4)
+    txn.commit()
+    monkeypatch.undo()
+
+    assert sorted(element['i'] for element in scan) == list(range(6))
+    assert db.all() == [{'i': 3, 'tags': ['a', 'b']},
+                        {'i': 4, 'tags': ['a'], 'j': 1},
+                        {'i': 5, 'tags': ['a']}]
@@ -0,0 +1,70 @@
+import os
+
+from pykv.database import TinyDB
+from pykv.storage.recordstorage import RecordStorage
+
+
+def test_reopen_reads_single_records(tmpdir):
+    path = str(tmpdir.join('db.rec'))
+    with TinyDB(path, storage=RecordStorage) as db:
+        db.insert_multiple([{'i': i, 'pad': 'x' * 50} for i in range(100)])
+        db.update({'i': -1}, eids=[7])
+        db.remove(eids=[8])
+
+    storage = RecordStorage(path)
+    assert sorted(storage.eids()) == [eid for eid in range(1, 101) if eid != 8]
+    assert storage.bytes_read == 0
+    assert storage.read_one(7) == {'i': -1, 'pad': 'x' * 50}
+    assert storage.read_one(8) is None
+    assert 0 < storage.bytes_read < 100
+    storage.close()
+
+
+def test_appends_after_the_saved_index_and_torn_tail(tmpdir):
+    path = str(tmpdir.join('db.rec'))
+    storage = RecordStorage(path)
+    storage.write({1: {'i': 1}})
+    storage.close()
+
+    # Appended by a run that crashed before saving the index, the last
+    # line only half written
+    with open(path, 'ab') as handle:
+        handle.write(b'2 {"i": 2}\n1 null\n3 {"i"')
+
+    storage = RecordStorage(path)
+    assert storage.read() == {2: {'i': 2}}
+    storage.apply(None, [('insert', 3, {'i': 3})])
+    assert storage.read() == {2: {'i': 2}, 3: {'i': 3}}
+    storage.close()
+
+    with open(path, 'rb') as handle:
+        assert handle.read().endswith(b'3 {"i": 3}\n')
+
+
+def test_index_of_a_replaced_file_is_ignored(tmpdir):
+    path = str(tmpdir.join('db.rec'))
+    storage = RecordStorage(path)
+    storage.write({1: {'i': 1}, 2: {'i': 2}})
+    storage.close()
+
+    os.remove(path)
+    with open(path, 'wb') as handle:
+        handle.write(b'5 {"i": 5}\n')
+
+    storage = RecordStorage(path)
+    assert storage.read() == {5: {'i': 5}}
+    storage.close()
+
+
+def test_compaction_drops_dead_records(tmpdir):
+    path = str(tmpdir.join('db.rec'))
+    storage = RecordStorage(path, compact_threshold=100)
+    storage.write(dict((eid, {'i': eid}) for eid in range(1, 11)))
+    for n in range(20):
+        storage.apply(None, [('update', 1, {'i': n})])
+
+    assert storage._dead * 2 <= storage._size
+    assert os.path.getsize(path) == storage._size < 400
+    assert storage.read_one(1) == {'i': 19}
+    assert len(storage.read()) == 10
+    storage.close()
@@ -0,0 +1,65 @@
+import time
+
+import pytest
+
+from conftest import free_uri
+from pykv.database import TinyDB
+from pykv.queriesinfo import Query
+
+zmq = pytest.importorskip('zmq')
+client = pytest.importorskip('client')
+
+from pykv.replication import ReplicationLog
+
+
+def _wait_until(check, timeout=20):
+    deadline = time.time() + timeout
+    while not check():
+        assert time.time() < deadline
+        time.sleep(0.05)
+
+
+def test_sync_sends_missing_entries_or_a_snapshot(tmpdir):
+    db = TinyDB(str(tmpdir.join('db.json')), resident=True)
+    log = ReplicationLog(db, free_uri(), size=2)
+    for i in range(3):
+        db.insert_multiple([{'i': i}])
+
+    answer = log.sync(1, log.epoch)
+    assert [entry['seq'] for entry in answer['entries']] == [2, 3]
+    assert log.sync(3, log.epoch)['entries'] == []
+
+    # Too far behind, or a follower of an earlier run of the primary
+    for since, epoch in [(0, log.epoch), (3, 'earlier'), (None, None)]:
+        answer = log.sync(since, epoch)
+        assert answer['seq'] == 3
+        assert [table['last_id'] for table in answer['tables']] == [3]
+    log.close()
+    db.close()
+
+
+def test_replica_follows_primary_through_restarts(server):
+    log_uri = free_uri()
+    primary = server('primary.json', '--resident', '--replication-uri', log_uri)
+    replica = server('replica.json', '--resident', '--follow', primary.uri,
+                     '--follow-log', log_uri)
+    writer = client.client_factory('db', primary.uri)
+    reader = client.client_factory('db', replica.uri)
+
+    writer.insert([{'i': 0}])
+    _wait_until(lambda: len(reader) == 1)
+    with pytest.raises(client.ServerError) as info:
+        reader.insert([{'i': 1}])
+    assert 'Read-only replica' in str(info.value)
+
+    # A new epoch, the replica starts over from a snapshot
+    primary.stop()
+    primary.start()
+    writer.insert([{'i': 1}])
+    _wait_until(lambda: len(reader) == 2)
+
+    replica.stop()
+    writer.insert([{'i': 2}])
+    replica.start()
+    _wait_until(lambda: len(reader) == 3)
+    assert sorted(row['i'] for row in reader.search(Query().i >= 0)) == [0, 1, 2]
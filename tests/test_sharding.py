@@ -0,0 +1,66 @@
+import pytest
+
+from pykv.queriesinfo import Query
+
+client = pytest.importorskip('client')
+
+
+def _shard_keys(sharded):
+    return dict((uri, sorted(row['_key'] for row in
+                             c.search(sharded._everything()).result()))
+                for uri, c in sharded.clients.items())
+
+
+def _check_placement(sharded):
+    for uri, keys in _shard_keys(sharded).items():
+        for key in keys:
+            assert sharded.ring.node_for(key) == uri
+
+
+def test_add_remove_and_rebalance(server):
+    first, second, third = server('a.json'), server('b.json'), server('c.json')
+    sharded = client.ShardedClient('db', [first.uri, second.uri], batch_size=7)
+    keys = sharded.insert([{'_key': 'k{0}'.format(i), 'i': i} for i in range(100)])
+    assert len(sharded) == 100
+    _check_placement(sharded)
+
+    # A pinned key only goes to its shard
+    owner = sharded.ring.node_for('k5')
+    assert sharded._targets(Query()._key == 'k5') == [owner]
+    assert sharded.search(Query()._key == 'k5') == [{'_key': 'k5', 'i': 5}]
+
+    moved = sharded.add_node(third.uri)
+    assert 0 < moved < 100
+    assert len(sharded) == 100
+    _check_placement(sharded)
+    assert sorted(row['_key'] for row in sharded.search(Query().i >= 0)) == sorted(keys)
+
+    assert sharded.rebalance() == 0
+
+    count = len(sharded.clients[second.uri])
+    assert sharded.remove_node(second.uri) == count
+    assert set(sharded.clients) == set([first.uri, third.uri])
+    assert len(sharded) == 100
+    _check_placement(sharded)
+
+
+def test_failed_move_is_reported(server, monkeypatch):
+    first, second = server('a.json'), server('b.json')
+    sharded = client.ShardedClient('db', [first.uri], batch_size=10)
+    sharded.insert([{'_key': 'k{0}'.format(i)} for i in range(30)])
+    sharded._connect(second.uri)
+
+    class Failed(object):
+        def result(self):
+            return 'Traceback: disk full'
+
+    # The old shard refuses to drop the copied records
+    monkeypatch.setattr(sharded.clients[first.uri], 'remove',
+                        lambda queryinfo: Failed())
+    with pytest.raises(client.ShardMoveError) as info:
+        sharded.rebalance()
+    error = info.value
+    assert error.moved == 0
+    assert error.duplicated
+    assert set(_shard_keys(sharded)[second.uri]) == set(error.duplicated)
+    assert len(sharded.clients[first.uri]) == 30
@@ -0,0 +1,16 @@
+from pykv.database import TinyDB
+
+
+def test_drop_table_of_an_earlier_run(tmpdir):
+    path = str(tmpdir.join('db.json'))
+    with TinyDB(path) as db:
+        db.table('users').insert_multiple([{'name': 'he'}])
+
+    with TinyDB(path) as db:
+        assert db.tables() == ['users']
+        db.drop_table('users')
+        assert db.tables() == []
+        assert db.table('users').all() == []
+
+    with TinyDB(path) as db:
+        assert db.table('users').all() == []
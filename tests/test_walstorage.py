@@ -0,0 +1,62 @@
+import os
+
+from pykv.database import TinyDB
+from pykv.storage.walstorage import WALStorage
+
+
+def _segment(path):
+    return sorted(name for name in os.listdir(os.path.dirname(path))
+                  if '.wal.' in name)[-1]
+
+
+def test_torn_tail_is_truncated(tmpdir):
+    path = str(tmpdir.join('db.json'))
+    with TinyDB(path, storage=WALStorage) as db:
+        db.insert_multiple({'i': i} for i in range(150))
+
+    # A crash in the middle of appending the next record
+    segment = os.path.join(str(tmpdir), _segment(path))
+    with open(segment, 'ab') as handle:
+        handle.write(b'["insert", 151, {"i"')
+
+    with TinyDB(path, storage=WALStorage) as db:
+        assert len(db) == 150
+        db.insert([{'i': 999}])
+
+    with open(segment, 'rb') as handle:
+        for line in handle:
+            assert line.endswith(b'\n')
+
+    with TinyDB(path, storage=WALStorage) as db:
+        assert len(db) == 151
+        assert len(db.all()) == 151
+        assert db.get(eid=151)['i'] == 999
+
+
+def test_torn_batch_is_dropped_whole(tmpdir):
+    path = str(tmpdir.join('db.json'))
+    with TinyDB(path, storage=WALStorage) as db:
+        db.insert_multiple({'i': i} for i in range(10))
+
+    # The crash hits after the first records of a bulk insert were logged
+    segment = os.path.join(str(tmpdir), _segment(path))
+    with open(segment, 'ab') as handle:
+        handle.write(b'[["insert", 11, {"i": 10}], ["insert", 12, {"i": 11}], '
+                     b'["insert", 13, {"i"')
+
+    with TinyDB(path, storage=WALStorage) as db:
+        assert len(db.all()) == 10
+        assert db.get(eid=11) is None
+
+
+def test_single_change_lines_still_replay(tmpdir):
+    path = str(tmpdir.join('db.json'))
+    with TinyDB(path, storage=WALStorage) as db:
+        db.insert_multiple({'i': i} for i in range(2))
+
+    segment = os.path.join(str(tmpdir), _segment(path))
+    with open(segment, 'ab') as handle:
+        handle.write(b'["insert", 3, {"i": 2}]\n["remove", 1, null]\n')
+
+    with TinyDB(path, storage=WALStorage) as db:
+        assert sorted(element['i'] for element in db.all()) == [1, 2]